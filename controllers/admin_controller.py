@@ -7,6 +7,8 @@ application settings, and viewing application stats.
 @author: Rory Olsen (rolsen, Gleap LLC 2014)
 @license: GNU GPLv3
 """
+import json
+
 import flask
 
 try:
@@ -14,6 +16,8 @@ try:
 except:
     import services
 
+import util
+
 # Create a Flask blueprint to split the Flask routes amoung multiple files.
 blueprint = flask.Blueprint(
     'admin',
@@ -115,5 +119,18 @@ def update_settings():
 
 
 @blueprint.route('/stats')
+@util.require_login(admin=True)
 def index_stats():
-    raise NotImplementedError
+    """Get application stats through the JSON-REST API.
+
+    @return: JSON-encoded document with the most viewed listings (their name,
+        slugs and views) under "popular_listings".
+    @rtype: str
+    """
+    return json.dumps(
+        {
+            'popular_listings':
+                services.view_counter_service.list_popular_listings()
+        },
+        default=services.listing_model.json_default
+    )
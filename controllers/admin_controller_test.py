@@ -3,12 +3,64 @@
 @author: Rory Olsen (rolsen, Gleap LLC 2014)
 @license: GNU GPLv3
 """
+import json
+
 import mox
 
+try:
+    from tinyclassified import tiny_classified
+    from tinyclassified import services
+except:
+    import tiny_classified
+    import services
+
 import admin_controller
+import util
 
 class AdminControllerTests(mox.MoxTestBase):
 
+    def setUp(self):
+        mox.MoxTestBase.setUp(self)
+        app = tiny_classified.get_app()
+        app.debug = True
+        self.app = app.test_client()
+
     # TODO: Test real things
     def test_truth(self):
         self.assertTrue(True)
+
+    def test_index_stats(self):
+        popular_listings = [{'name': 'TestName', 'views': 3}]
+
+        self.mox.StubOutWithMock(util, 'check_active_requirement')
+        util.check_active_requirement().AndReturn(True)
+        self.mox.StubOutWithMock(util, 'check_admin_requirement')
+        util.check_admin_requirement(True).AndReturn(True)
+
+        self.mox.StubOutWithMock(
+            services.view_counter_service,
+            'list_popular_listings'
+        )
+        services.view_counter_service.list_popular_listings().AndReturn(
+            popular_listings
+        )
+
+        self.mox.ReplayAll()
+
+        response = self.app.get('/admin/stats')
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(
+            {'popular_listings': popular_listings},
+            json.loads(response.data)
+        )
+
+    def test_index_stats_not_admin(self):
+        self.mox.StubOutWithMock(util, 'check_active_requirement')
+        util.check_active_requirement().AndReturn(True)
+        self.mox.StubOutWithMock(util, 'check_admin_requirement')
+        util.check_admin_requirement(True).AndReturn(False)
+
+        self.mox.ReplayAll()
+
+        response = self.app.get('/admin/stats')
+        self.assertEqual(302, response.status_code)
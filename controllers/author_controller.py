@@ -73,9 +73,7 @@ def show_user_ui():
 @blueprint.route('/categories.json')
 @util.require_login()
 def get_categories():
-    tags = services.listing_service.index_tags()
-    return json.dumps(services.listing_service.collect_index_dict(
-        tags,
+    return json.dumps(services.listing_service.get_categories(
         home_only=False
     ))
 
@@ -97,7 +95,10 @@ def read(email):
     listing = services.listing_service.read_by_email(email)
 
     result_dict = listing
-    return json.dumps(result_dict, default=json_util.default)
+    return json.dumps(
+        result_dict,
+        default=services.listing_model.json_default
+    )
 
 
 @blueprint.route('/content/<type>', methods=['PUT', 'POST'])
@@ -119,7 +120,10 @@ def update(type):
     services.listing_service.update(listing)
 
     result_dict = listing
-    return json.dumps(result_dict, default=json_util.default)
+    return json.dumps(
+        result_dict,
+        default=services.listing_model.json_default
+    )
 
 
 @blueprint.route('/content/<email>', methods=['DELETE'])
@@ -138,4 +142,47 @@ def delete(email):
     services.listing_service.delete(listing)
 
     result_dict = listing
-    return json.dumps(result_dict, default=json_util.default)
+    return json.dumps(
+        result_dict,
+        default=services.listing_model.json_default
+    )
+
+
+@blueprint.route('/archive/<email>')
+@util.require_login()
+def read_archived(email):
+    """Get the user's most recently archived listing through the JSON-REST API.
+
+    @return: JSON-encoded document describing the archived listing.
+    @rtype: str
+    """
+    if not is_admin() or email == '_current':
+        email = flask.session.get(util.SESS_EMAIL, None).lower()
+    listing = services.archive_service.read_archived_by_email(email)
+
+    if listing == None:
+        flask.abort(404)
+
+    return json.dumps(listing, default=services.listing_model.json_default)
+
+
+@blueprint.route('/archive/<email>/restore', methods=['POST'])
+@util.require_login()
+def restore(email):
+    """Restore the user's most recently archived listing.
+
+    @return: JSON-encoded document describing the restored listing.
+    @rtype: str
+    """
+    if not is_admin() or email == '_current':
+        email = flask.session.get(util.SESS_EMAIL, None).lower()
+
+    try:
+        listing = services.archive_service.restore_by_email(email)
+    except ValueError:
+        flask.abort(409)
+
+    if listing == None:
+        flask.abort(404)
+
+    return json.dumps(listing, default=services.listing_model.json_default)
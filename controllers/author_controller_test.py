@@ -87,3 +87,63 @@ class AuthorControllerTests(mox.MoxTestBase):
 
         response = self.app.get('/author/content/_current')
         self.assertEqual(200, response.status_code)
+
+    def test_read_archived(self):
+        self.setup_logged_in()
+
+        self.mox.StubOutWithMock(
+            services.archive_service,
+            'read_archived_by_email'
+        )
+        services.archive_service.read_archived_by_email(TEST_EMAIL).AndReturn(
+            TEST_LISTING
+        )
+
+        self.mox.ReplayAll()
+
+        response = self.app.get('/author/archive/_current')
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(TEST_LISTING, json.loads(response.data))
+
+    def test_read_archived_not_found(self):
+        self.setup_logged_in()
+
+        self.mox.StubOutWithMock(
+            services.archive_service,
+            'read_archived_by_email'
+        )
+        services.archive_service.read_archived_by_email(TEST_EMAIL).AndReturn(
+            None
+        )
+
+        self.mox.ReplayAll()
+
+        response = self.app.get('/author/archive/_current')
+        self.assertEqual(404, response.status_code)
+
+    def test_restore(self):
+        self.setup_logged_in()
+
+        self.mox.StubOutWithMock(services.archive_service, 'restore_by_email')
+        services.archive_service.restore_by_email(TEST_EMAIL).AndReturn(
+            TEST_LISTING
+        )
+
+        self.mox.ReplayAll()
+
+        response = self.app.post('/author/archive/_current/restore')
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(TEST_LISTING, json.loads(response.data))
+
+    def test_restore_name_taken(self):
+        self.setup_logged_in()
+
+        self.mox.StubOutWithMock(services.archive_service, 'restore_by_email')
+        services.archive_service.restore_by_email(TEST_EMAIL).AndRaise(
+            ValueError('Listing with name TestName already exists.')
+        )
+
+        self.mox.ReplayAll()
+
+        response = self.app.post('/author/archive/_current/restore')
+        self.assertEqual(409, response.status_code)
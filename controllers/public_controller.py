@@ -6,9 +6,11 @@ browsing listings.
 @author: Rory Olsen (rolsen, Gleap LLC 2014)
 @license: GNU GPLv3
 """
+import json
+import time
+
 import flask
 import jinja2
-import markdown
 
 # Optimally, it would be nice to have "is_module" controlled by the configs, but
 # they may not be available when this module is imported.
@@ -35,6 +37,80 @@ blueprint = flask.Blueprint(
 )
 
 
+STALE_WARNING = '110 - "Response is Stale"'
+
+DEFAULT_REQUEST_DEADLINE_MS = 3000
+
+# Errors after which a public page is served stale (or as a 503) rather than
+# failing with a 500.
+FALLBACK_ERRORS = (
+    services.circuit_breaker_service.DATABASE_UNAVAILABLE_ERRORS +
+    (services.deadline_service.DeadlineExceeded,)
+)
+
+
+@blueprint.before_request
+def set_request_deadline():
+    """Limit the database time of public requests to a deadline.
+
+    The deadline is PUBLIC_REQUEST_DEADLINE_MS after the request starts.
+    """
+    services.deadline_service.set_timeout(tiny_classified.get_config().get(
+        'PUBLIC_REQUEST_DEADLINE_MS',
+        DEFAULT_REQUEST_DEADLINE_MS
+    ))
+
+
+@blueprint.teardown_request
+def clear_request_deadline(exception):
+    services.deadline_service.clear_deadline()
+
+
+def render_with_stale_fallback(render):
+    """Render a public page, serving its last good rendering if the db is down.
+
+    Pages rendered for anonymous visitors are kept in the stale page cache by
+    request path. If rendering fails because the database is unavailable (or
+    its circuit breaker is open), the kept page is served with Warning and Age
+    headers instead. The same happens if the request runs out of time (see
+    set_request_deadline). Without a kept page the response is a 503 which
+    asks clients to retry once the circuit breaker would let reads through
+    again (MONGO_BREAKER_RESET_SECONDS).
+
+    @param render: Function without arguments which renders the page and
+        returns its HTML or None if the page was not found.
+    @type render: function
+    @return: The rendered page, a stale page response or None if not found.
+    @rtype: str or flask.Response
+    """
+    cache = services.cache_service.get_stale_page_cache()
+    key = flask.request.full_path
+
+    try:
+        html = render()
+    except FALLBACK_ERRORS:
+        (found, page) = cache.get(key)
+        if not found:
+            retry_after = tiny_classified.get_config().get(
+                'MONGO_BREAKER_RESET_SECONDS',
+                services.circuit_breaker_service.DEFAULT_RESET_TIMEOUT
+            )
+            flask.abort(flask.Response(
+                'Service Unavailable',
+                status=503,
+                headers={'Retry-After': str(int(retry_after))}
+            ))
+
+        response = flask.make_response(page['html'])
+        response.headers['Warning'] = STALE_WARNING
+        response.headers['Age'] = str(int(time.time() - page['rendered_at']))
+        return response
+
+    if html and not util.check_active_requirement():
+        cache.put(key, {'html': html, 'rendered_at': time.time()})
+    return html
+
+
 @blueprint.route('/confirm_delete')
 def confirm_delete():
     config = tiny_classified.get_config()
@@ -58,21 +134,33 @@ def confirm_delete():
 def index():
     """List all listings tags.
 
+    @return: HTML with the listing tags index.
+    @rtype: str
+    """
+    return render_with_stale_fallback(render_index)
+
+
+def render_index():
+    """Render the listing tags index.
+
     @return: HTML with the listing tags index.
     @rtype: str
     """
     config = tiny_classified.get_config()
 
-    tags = services.listing_service.index_tags()
-    categories = services.listing_service.collect_index_dict(
-        tags,
-        home_only=True
-    )
+    counts = services.listing_service.get_category_counts(home_only=True)
 
     url_base = tiny_classified.get_config()['LISTING_URL_BASE']
 
-    html_categories = [render_html_category(url_base, cat, subcats)
-        for cat, subcats in categories.iteritems()]
+    html_categories = [
+        render_html_category(
+            url_base,
+            cat,
+            sorted(cat_counts['subcategories']),
+            counts=cat_counts
+        )
+        for cat, cat_counts in counts.iteritems()
+    ]
 
     temp_vals = tiny_classified.render_common_template_vals()
     temp_vals.update(temp_vals_extra)
@@ -91,7 +179,8 @@ def index():
     )
 
 
-def render_html_category(listing_url_base, category, subcategories):
+def render_html_category(listing_url_base, category, subcategories,
+    counts=None):
     """Render the html for a single category of tags.
 
     @param listing_url_base: The base url.
@@ -100,11 +189,23 @@ def render_html_category(listing_url_base, category, subcategories):
     @type category: str
     @param subcategories: The category's subcategories.
     @type subcategories: iterable over str
+    @keyword counts: The category's entry from
+        listing_service.get_category_counts or None to not show counts.
+    @type counts: dict
     @return: The HTML for a single category
     @rtype: str
     """
+    subcategory_counts = {}
+    category_count = None
+    if counts != None:
+        subcategory_counts = counts['subcategories']
+        category_count = counts['count']
+
     prep = util.prepare_subcategory
-    prep_subcats = [prep(listing_url_base, category, x) for x in subcategories]
+    prep_subcats = [
+        prep(listing_url_base, category, x, subcategory_counts.get(x, None))
+        for x in subcategories
+    ]
 
     temp_vals = tiny_classified.render_common_template_vals()
     temp_vals.update(temp_vals_extra)
@@ -112,31 +213,29 @@ def render_html_category(listing_url_base, category, subcategories):
     return flask.render_template(
         'public/index_category_inner.html',
         category=category,
+        category_count=category_count,
         subcategories=prep_subcats,
         listing_url_base=listing_url_base,
         **temp_vals
     )
 
 
-def index_listings_by_slug_programmatic(slug, parent_template, temp_vals, home):
-    listings = services.listing_service.list_by_slug(slug)
-
+def index_listings_by_slug_programmatic(slug, parent_template, temp_vals, home,
+    page_token=None):
     slug_split = slug.split('/')
     category = slug_split[0]
 
     config = tiny_classified.get_config()
 
-    if listings.count() == 0:
-        return None
+    # Only the detail page needs entire listings; category pages use summaries.
+    if services.listing_service.check_is_qualified_slug(slug):
+        listing = services.listing_service.read_by_slug(slug)
+        if not listing:
+            return None
 
-    listing = listings[0]
-    is_qualified = services.listing_service.check_is_qualified(listing, slug)
+        services.view_counter_service.record_view(listing['_id'])
+        about = services.listing_service.get_about_html(listing)
 
-    about = listing.get('about', None)
-    if about:
-        about = markdown.markdown(about)
-
-    if listings.count() == 1 and is_qualified:
         return flask.render_template(
             'public/listing_chrome.html',
             base_url=config['BASE_URL'],
@@ -148,39 +247,111 @@ def index_listings_by_slug_programmatic(slug, parent_template, temp_vals, home):
             admin=util.check_admin_requirement(True),
             **temp_vals
         )
-    else:
-        tags = listings.distinct('tags')
-        tags = services.listing_service.collect_index_dict(tags, home_only=home)
 
-        if len(slug_split) > 1:
-            subcategories = []
-            selected_subcategory = {'name': slug_split[1]}
-        else:
-            subcategories = tags[category]
-            selected_subcategory = None
+    # Unknown categories are routed to a 404 without querying the database.
+    if not services.listing_service.check_has_listings(slug):
+        return None
 
-        url_base = config['LISTING_URL_BASE']
+    # The page, its featured listings and its subcategories all come from the
+    # category's materialized summary in a single read.
+    summary = services.listing_service.read_category_summary(slug)
+    if summary == None:
+        return None
 
-        listings = list(listings)
-        featured_listings = sorted(filter(
-            lambda x: x.get('featured', False),
-            listings
-        ), key=lambda x: x['name'])
+    try:
+        page = services.listing_service.get_summary_page(
+            summary,
+            page_token=page_token
+        )
+    except ValueError:
+        return None
 
-        prep = util.prepare_subcategory
-        return flask.render_template(
-            'public/category_chrome.html',
-            base_url=config['BASE_URL'],
-            parent_template=parent_template,
-            category=category,
-            listings=listings,
-            featured_listings=featured_listings,
-            subcategories=[prep(url_base, category, x) for x in subcategories],
-            selected_subcategory=selected_subcategory,
-            listing_url_base=url_base,
-            **temp_vals
+    listings = page['listings']
+    if len(listings) == 0:
+        return None
+
+    if len(slug_split) > 1:
+        subcategories = []
+        selected_subcategory = {'name': slug_split[1]}
+    elif home and category in config['NO_FRONT_PAGE_CATEGORIES']:
+        subcategories = []
+        selected_subcategory = None
+    else:
+        subcategories = summary['subcategories']
+        selected_subcategory = None
+
+    url_base = config['LISTING_URL_BASE']
+
+    featured_listings = summary['featured']
+
+    next_page_url = None
+    if page['next_page_token']:
+        next_page_url = '%s/%s?page=%s' % (
+            url_base,
+            slug,
+            page['next_page_token']
         )
 
+    prep = util.prepare_subcategory
+    return flask.render_template(
+        'public/category_chrome.html',
+        base_url=config['BASE_URL'],
+        parent_template=parent_template,
+        category=category,
+        listings=listings,
+        featured_listings=featured_listings,
+        subcategories=[prep(url_base, category, x) for x in subcategories],
+        selected_subcategory=selected_subcategory,
+        listing_url_base=url_base,
+        first_page_url=('%s/%s' % (url_base, slug)) if page_token else None,
+        next_page_url=next_page_url,
+        **temp_vals
+    )
+
+
+@blueprint.route('/near.json')
+def list_near():
+    """List the published listings nearest to a point.
+
+    Takes the point as the "lat" and "lng" query parameters (in degrees) and
+    optionally a category / subcategory slug to search under as "category", a
+    maximum distance in kilometers as "radius" and a page number (from 0) as
+    "page".
+
+    Like the public pages, the last good result is served if the database is
+    unavailable (see render_with_stale_fallback).
+
+    @return: JSON-encoded document with the listings, each with its distance
+        in meters under "distance", nearest first, under "listings" and the
+        number of the next page (or null) under "next_page".
+    @rtype: str
+    """
+    args = flask.request.args
+    try:
+        latitude = float(args['lat'])
+        longitude = float(args['lng'])
+        radius = args.get('radius', None)
+        if radius != None:
+            radius = float(radius) * 1000
+        page = int(args.get('page', 0))
+    except (KeyError, ValueError):
+        flask.abort(400)
+
+    def render():
+        try:
+            result = services.listing_service.list_near(
+                latitude,
+                longitude,
+                slug=args.get('category', None),
+                radius=radius,
+                page=page
+            )
+        except ValueError:
+            flask.abort(400)
+        return json.dumps(result, default=services.listing_model.json_default)
+
+    return render_with_stale_fallback(render)
+
 
 @blueprint.route('/<path:slug>')
 def index_listings_by_slug(slug):
@@ -202,11 +373,14 @@ def index_listings_by_slug(slug):
         'tinyclassified_base.html'
     )
 
-    result = index_listings_by_slug_programmatic(
-        slug,
-        parent_template,
-        temp_vals,
-        True
+    result = render_with_stale_fallback(
+        lambda: index_listings_by_slug_programmatic(
+            slug,
+            parent_template,
+            temp_vals,
+            True,
+            page_token=flask.request.args.get('page', None)
+        )
     )
 
     if not result:
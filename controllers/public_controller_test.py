@@ -4,7 +4,11 @@
 @license: GNU GPLv3
 """
 import copy
+import json
+import time
+
 import mox
+from pymongo import errors
 
 try:
     from tinyclassified import tiny_classified
@@ -46,23 +50,22 @@ TEST_LISTINGS = [
     TEST_LISTING_2
 ]
 
-TEST_TAGS = [
-    TEST_LISTING_1['tags'],
-    TEST_LISTING_2['tags']
-]
-
-TEST_COLLECTED_TAGS_CATEGORY = {
-    'cat1': ['subcat1', 'subcat2']
+TEST_CATEGORY_SUMMARY = {
+    '_id': 'cat1',
+    'listings': TEST_LISTINGS,
+    'featured': [],
+    'subcategories': ['subcat1', 'subcat2']
 }
 
-TEST_TAGLIST = [
-    {'altcategory': ['altsubcat1', 'altsubcat2']},
-    {'altcategory': ['altsubcat2', 'altsubcat3']},
-    {'category': ['subcat2', 'subcat3']}
-]
-TEST_INDEX_CATEGORIES = {
-    'altcategory': ['altsubcat1', 'altsubcat2', 'altsubcat3'],
-    'category': ['subcat2', 'subcat3']
+TEST_INDEX_COUNTS = {
+    'altcategory': {
+        'count': 2,
+        'subcategories': {'altsubcat1': 1, 'altsubcat2': 2, 'altsubcat3': 1}
+    },
+    'category': {
+        'count': 1,
+        'subcategories': {'subcat2': 1, 'subcat3': 1}
+    }
 }
 
 class PublicControllerTests(mox.MoxTestBase):
@@ -73,30 +76,37 @@ class PublicControllerTests(mox.MoxTestBase):
         app.debug = True
         self.orig_app = app
         self.app = app.test_client()
+        self.stale_page_cache = services.cache_service.LRUCache(
+            10,
+            1024 * 1024,
+            60
+        )
+        services.cache_service.CACHES['stale_page'] = self.stale_page_cache
 
     def test_index_listings(self):
         expected_htmls = ['testhtml', 'otherone']
 
-        self.mox.StubOutWithMock(services.listing_service, 'index_tags')
-        services.listing_service.index_tags().AndReturn(TEST_TAGLIST)
-
-        self.mox.StubOutWithMock(services.listing_service, 'collect_index_dict')
-        services.listing_service.collect_index_dict(
-            TEST_TAGLIST,
+        self.mox.StubOutWithMock(
+            services.listing_service,
+            'get_category_counts'
+        )
+        services.listing_service.get_category_counts(
             home_only=True
-        ).AndReturn(TEST_INDEX_CATEGORIES)
+        ).AndReturn(TEST_INDEX_COUNTS)
 
         self.mox.StubOutWithMock(public_controller, 'render_html_category')
         public_controller.render_html_category(
             mox.IsA(str),
             'altcategory',
-            ['altsubcat1', 'altsubcat2', 'altsubcat3']
+            ['altsubcat1', 'altsubcat2', 'altsubcat3'],
+            counts=TEST_INDEX_COUNTS['altcategory']
         ).InAnyOrder().AndReturn('testhmtl')
 
         public_controller.render_html_category(
             mox.IsA(str),
             'category',
-            ['subcat2', 'subcat3']
+            ['subcat2', 'subcat3'],
+            counts=TEST_INDEX_COUNTS['category']
         ).InAnyOrder().AndReturn('otherone')
 
         self.mox.ReplayAll()
@@ -107,6 +117,107 @@ class PublicControllerTests(mox.MoxTestBase):
         self.assertTrue('testhmtl' in result.data)
         self.assertTrue('otherone' in result.data)
 
+    def test_index_keeps_page_for_stale_fallback(self):
+        self.mox.StubOutWithMock(
+            services.listing_service,
+            'get_category_counts'
+        )
+        services.listing_service.get_category_counts(
+            home_only=True
+        ).AndReturn(TEST_INDEX_COUNTS)
+        services.listing_service.get_category_counts(
+            home_only=True
+        ).AndRaise(errors.ServerSelectionTimeoutError('test'))
+
+        self.mox.ReplayAll()
+
+        result = self.app.get('/')
+        self.assertEqual(200, result.status_code)
+        self.assertFalse('Warning' in result.headers)
+        fresh_html = result.data
+
+        result = self.app.get('/')
+        self.assertEqual(200, result.status_code)
+        self.assertEqual(fresh_html, result.data)
+        self.assertEqual(public_controller.STALE_WARNING,
+            result.headers['Warning'])
+        self.assertEqual('0', result.headers['Age'])
+
+    def test_index_listings_by_slug_stale_fallback(self):
+        self.stale_page_cache.put(
+            '/cat1?page=token',
+            {'html': 'stale page', 'rendered_at': time.time() - 120}
+        )
+
+        self.mox.StubOutWithMock(
+            public_controller,
+            'index_listings_by_slug_programmatic'
+        )
+        public_controller.index_listings_by_slug_programmatic(
+            'cat1',
+            mox.IsA(str),
+            mox.IsA(dict),
+            True,
+            page_token='token'
+        ).AndRaise(services.circuit_breaker_service.CircuitOpenError())
+
+        self.mox.ReplayAll()
+
+        result = self.app.get('/cat1?page=token')
+        self.assertEqual(200, result.status_code)
+        self.assertEqual('stale page', result.data)
+        self.assertEqual('120', result.headers['Age'])
+
+    def test_index_unavailable_without_stale_page(self):
+        self.mox.StubOutWithMock(
+            services.listing_service,
+            'get_category_counts'
+        )
+        services.listing_service.get_category_counts(
+            home_only=True
+        ).AndRaise(errors.AutoReconnect('test'))
+
+        self.mox.ReplayAll()
+
+        result = self.app.get('/')
+        self.assertEqual(503, result.status_code)
+        self.assertEqual(
+            str(services.circuit_breaker_service.DEFAULT_RESET_TIMEOUT),
+            result.headers['Retry-After']
+        )
+
+    def test_index_sets_request_deadline(self):
+        self.mox.StubOutWithMock(
+            services.listing_service,
+            'get_category_counts'
+        )
+        services.listing_service.get_category_counts(
+            home_only=True
+        ).WithSideEffects(
+            lambda home_only: self.assertTrue(
+                services.deadline_service.get_remaining_ms() > 0)
+        ).AndReturn(TEST_INDEX_COUNTS)
+
+        self.mox.ReplayAll()
+
+        result = self.app.get('/')
+        self.assertEqual(200, result.status_code)
+        self.assertEqual(None, services.deadline_service.get_deadline())
+
+    def test_index_unavailable_after_deadline(self):
+        self.mox.StubOutWithMock(
+            services.listing_service,
+            'get_category_counts'
+        )
+        services.listing_service.get_category_counts(
+            home_only=True
+        ).AndRaise(services.deadline_service.DeadlineExceeded())
+
+        self.mox.ReplayAll()
+
+        result = self.app.get('/')
+        self.assertEqual(503, result.status_code)
+
     def test_render_html_category(self):
         test_base_url = 'test_base_url.com'
         test_category = 'category'
@@ -126,17 +237,36 @@ class PublicControllerTests(mox.MoxTestBase):
             'href="test_base_url.com/category/altsubcat2"' in result)
         self.assertTrue(
             'href="test_base_url.com/category/altsubcat3"' in result)
+        self.assertFalse('subcategory-count' in result)
+
+    def test_render_html_category_counts(self):
+        with self.orig_app.test_request_context('/'):
+            result = public_controller.render_html_category(
+                'test_base_url.com',
+                'altcategory',
+                ['altsubcat1', 'altsubcat2', 'altsubcat3'],
+                counts=TEST_INDEX_COUNTS['altcategory']
+            )
+
+        self.assertTrue('<span class="category-count">(2)</span>' in result)
+        self.assertTrue('<span class="subcategory-count">(2)</span>' in result)
+        self.assertEqual(2, result.count('<span class="subcategory-count">(1)'))
 
     def test_index_listings_by_slug_category(self):
-        test_cursor = test_util.TestCursor(TEST_LISTINGS)
         category = 'cat1'
 
         self.mox.StubOutWithMock(
             services.listing_service,
-            'list_by_slug'
+            'check_has_listings'
+        )
+        services.listing_service.check_has_listings(category).AndReturn(True)
+
+        self.mox.StubOutWithMock(
+            services.listing_service,
+            'read_category_summary'
         )
-        services.listing_service.list_by_slug(category).AndReturn(
-            test_cursor
+        services.listing_service.read_category_summary(category).AndReturn(
+            TEST_CATEGORY_SUMMARY
         )
 
         self.mox.StubOutWithMock(
@@ -147,17 +277,10 @@ class PublicControllerTests(mox.MoxTestBase):
             False
         )
 
-        self.mox.StubOutWithMock(services.listing_service, 'collect_index_dict')
-        services.listing_service.collect_index_dict(
-            TEST_TAGS,
-            home_only=True
-        ).AndReturn(TEST_COLLECTED_TAGS_CATEGORY)
-
         self.mox.ReplayAll()
 
         result = self.app.get('/cat1')
         self.assertEqual(200, result.status_code)
-        self.assertEqual('tags', test_cursor.distinct_param)
 
         # Test that expected URLs are in the HTML
         res_html = result.get_data()
@@ -165,18 +288,25 @@ class PublicControllerTests(mox.MoxTestBase):
         self.assertTrue('/cat1/subcat2' in res_html)
         self.assertTrue('/cat1/subcat1/TestName1' in res_html)
         self.assertTrue('/cat1/subcat1/TestName2' in res_html)
+        self.assertFalse('featured-listings-display' in res_html)
 
     def test_index_listings_by_slug_category_and_subcategory(self):
-        test_cursor = test_util.TestCursor(TEST_LISTINGS)
         url = 'cat1/subcat1'
 
         self.mox.StubOutWithMock(
             services.listing_service,
-            'list_by_slug'
+            'check_has_listings'
         )
-        services.listing_service.list_by_slug(url).AndReturn(
-            test_cursor
+        services.listing_service.check_has_listings(url).AndReturn(True)
+
+        summary = copy.deepcopy(TEST_CATEGORY_SUMMARY)
+        summary['_id'] = url
+        summary['subcategories'] = []
+        self.mox.StubOutWithMock(
+            services.listing_service,
+            'read_category_summary'
         )
+        services.listing_service.read_category_summary(url).AndReturn(summary)
 
         self.mox.StubOutWithMock(
             services.listing_service,
@@ -186,17 +316,10 @@ class PublicControllerTests(mox.MoxTestBase):
             False
         )
 
-        self.mox.StubOutWithMock(services.listing_service, 'collect_index_dict')
-        services.listing_service.collect_index_dict(
-            TEST_TAGS,
-            home_only=True
-        ).AndReturn(TEST_COLLECTED_TAGS_CATEGORY)
-
         self.mox.ReplayAll()
 
         result = self.app.get('/' + url)
         self.assertEqual(200, result.status_code)
-        self.assertEqual('tags', test_cursor.distinct_param)
 
         # Test that expected URLs are in the HTML
         res_html = result.get_data()
@@ -207,15 +330,187 @@ class PublicControllerTests(mox.MoxTestBase):
         # Expected text
         self.assertTrue('Clear Filters' in res_html)
 
+    def test_index_listings_by_slug_category_next_page(self):
+        category = 'cat1'
+
+        self.mox.StubOutWithMock(
+            services.listing_service,
+            'check_has_listings'
+        )
+        services.listing_service.check_has_listings(category).AndReturn(True)
+
+        summary = copy.deepcopy(TEST_CATEGORY_SUMMARY)
+        summary['featured'] = [TEST_LISTING_2]
+        self.mox.StubOutWithMock(
+            services.listing_service,
+            'read_category_summary'
+        )
+        services.listing_service.read_category_summary(category).AndReturn(
+            summary
+        )
+
+        self.mox.StubOutWithMock(
+            services.listing_service,
+            'get_summary_page'
+        )
+        services.listing_service.get_summary_page(
+            summary,
+            page_token='prevtoken'
+        ).AndReturn({'listings': TEST_LISTINGS, 'next_page_token': 'token'})
+
+        self.mox.ReplayAll()
+
+        result = self.app.get('/cat1?page=prevtoken')
+        self.assertEqual(200, result.status_code)
+
+        res_html = result.get_data()
+        self.assertTrue('/cat1?page=token' in res_html)
+        self.assertTrue('first-page-link' in res_html)
+        self.assertTrue('featured-listings-display' in res_html)
+
+    def test_index_listings_by_slug_category_bad_page_token(self):
+        self.mox.StubOutWithMock(
+            services.listing_service,
+            'check_has_listings'
+        )
+        services.listing_service.check_has_listings('cat1').AndReturn(True)
+
+        self.mox.StubOutWithMock(
+            services.listing_service,
+            'read_category_summary'
+        )
+        services.listing_service.read_category_summary('cat1').AndReturn(
+            TEST_CATEGORY_SUMMARY
+        )
+
+        self.mox.ReplayAll()
+
+        result = self.app.get('/cat1?page=%ff')
+        self.assertEqual(404, result.status_code)
+
+    def test_index_listings_by_slug_category_empty(self):
+        self.mox.StubOutWithMock(
+            services.listing_service,
+            'check_has_listings'
+        )
+        services.listing_service.check_has_listings('unknown').AndReturn(False)
+
+        # Unknown categories are not looked up in the database.
+        self.mox.StubOutWithMock(
+            services.listing_service,
+            'read_category_summary'
+        )
+
+        self.mox.ReplayAll()
+
+        result = self.app.get('/unknown')
+        self.assertEqual(404, result.status_code)
+
     def test_index_listings_by_slug_individual(self):
         url = 'cat1/subcat1/TestName1'
+        listing = dict(TEST_LISTING_1, _id='testid1')
+
+        self.mox.StubOutWithMock(services.listing_service, 'read_by_slug')
+        services.listing_service.read_by_slug(url).AndReturn(listing)
 
         self.mox.StubOutWithMock(services.listing_service, 'list_by_slug')
-        services.listing_service.list_by_slug(url).AndReturn(
-            test_util.TestCursor([TEST_LISTING_1])
-        )
+
+        self.mox.StubOutWithMock(services.view_counter_service, 'record_view')
+        services.view_counter_service.record_view('testid1')
 
         self.mox.ReplayAll()
 
         result = self.app.get('/' + url)
         self.assertEqual(200, result.status_code)
+        self.assertTrue('About test listing 1' in result.get_data())
+
+    def test_index_listings_by_slug_individual_not_found(self):
+        url = 'cat1/subcat1/Unknown'
+
+        self.mox.StubOutWithMock(services.listing_service, 'read_by_slug')
+        services.listing_service.read_by_slug(url).AndReturn(None)
+
+        self.mox.StubOutWithMock(services.listing_service, 'list_by_slug')
+
+        self.mox.ReplayAll()
+
+        result = self.app.get('/' + url)
+        self.assertEqual(404, result.status_code)
+
+    def test_list_near(self):
+        self.mox.StubOutWithMock(services.listing_service, 'list_near')
+        services.listing_service.list_near(
+            47.6,
+            -122.3,
+            slug='cat1',
+            radius=2500,
+            page=1
+        ).AndReturn({'listings': [{'name': 'test', 'distance': 12.5}],
+            'next_page': 2})
+
+        self.mox.ReplayAll()
+
+        result = self.app.get(
+            '/near.json?lat=47.6&lng=-122.3&category=cat1&radius=2.5&page=1')
+        self.assertEqual(200, result.status_code)
+        self.assertEqual(
+            {'listings': [{'name': 'test', 'distance': 12.5}], 'next_page': 2},
+            json.loads(result.get_data())
+        )
+
+    def test_list_near_stale_fallback(self):
+        url = '/near.json?lat=47.6&lng=-122.3'
+        self.mox.StubOutWithMock(services.listing_service, 'list_near')
+        services.listing_service.list_near(
+            47.6,
+            -122.3,
+            slug=None,
+            radius=None,
+            page=0
+        ).AndReturn({'listings': [], 'next_page': None})
+        services.listing_service.list_near(
+            47.6,
+            -122.3,
+            slug=None,
+            radius=None,
+            page=0
+        ).MultipleTimes().AndRaise(
+            services.circuit_breaker_service.CircuitOpenError())
+
+        self.mox.ReplayAll()
+
+        fresh_json = self.app.get(url).get_data()
+        result = self.app.get(url)
+        self.assertEqual(200, result.status_code)
+        self.assertEqual(fresh_json, result.get_data())
+        self.assertEqual(public_controller.STALE_WARNING,
+            result.headers['Warning'])
+
+        result = self.app.get(url + '&page=0')
+        self.assertEqual(503, result.status_code)
+        self.assertTrue('Retry-After' in result.headers)
+
+    def test_list_near_invalid(self):
+        self.mox.StubOutWithMock(services.listing_service, 'list_near')
+        services.listing_service.list_near(
+            91.0,
+            -122.3,
+            slug=None,
+            radius=None,
+            page=0
+        ).AndRaise(ValueError('test'))
+
+        self.mox.ReplayAll()
+
+        self.assertEqual(
+            400,
+            self.app.get('/near.json?lng=-122.3').status_code
+        )
+        self.assertEqual(
+            400,
+            self.app.get('/near.json?lat=north&lng=-122.3').status_code
+        )
+        self.assertEqual(
+            400,
+            self.app.get('/near.json?lat=91&lng=-122.3').status_code
+        )
@@ -54,6 +54,12 @@ class TestDBAdapter():
     def get_listings_collection(self):
         return self.collection
 
+    def get_listing_by_email(self, author_email):
+        return self.collection.find_one({'author_email': author_email})
+
+    def delete_listing(self, listing_id):
+        self.collection.remove(listing_id)
+
 
 def check_dict(expected_dict, test_dict):
     """Check that two dictionaries are the same for each key in the first dict.
@@ -120,7 +120,7 @@ def remove_element_by_id(items, item_id, idAttribute='_id'):
 
 
 
-def prepare_subcategory(listing_url_base, category, subcategory):
+def prepare_subcategory(listing_url_base, category, subcategory, count=None):
     """Preprare a subcategory for a view by calculating its URL.
 
     @param listing_url_base: The base url.
@@ -129,12 +129,16 @@ def prepare_subcategory(listing_url_base, category, subcategory):
     @type category: str
     @param subcategory: The view-appropriate subcategory name.
     @type subcategory: str
-    @return: subcategory url and subcategory name
+    @keyword count: The number of listings in the subcategory or None if not
+        known.
+    @type count: int
+    @return: subcategory url, subcategory name and listing count
     @rtype: dict
     """
     return {
         'url': '/'.join((listing_url_base, category, subcategory)),
-        'name': subcategory
+        'name': subcategory,
+        'count': count
     }
 
 
@@ -1,6 +1,7 @@
 """Parses and filters CSV data into the tiny_classified listings collection.
 """
 import csv
+import datetime
 import os
 import sys
 
@@ -187,6 +188,30 @@ def set_as_is_featured(file_data, row, field_key, field_value):
     row['output']['featured'] = field_value != ''
 
 
+@strip_field_value
+def set_as_expires_on(file_data, row, field_key, field_value):
+    """Expire a listing by its expiration, expired flag or deletion date.
+
+    Expired and deleted listings are kept, and moved to the listing archive
+    the next time it is swept, instead of being imported as live listings.
+    """
+    if field_key == 'isexpired':
+        if field_value != 't':
+            return
+        expires_on = datetime.datetime.utcnow()
+    elif not field_value:
+        return
+    else:
+        expires_on = services.migration_service.parse_date(field_value)
+        if expires_on == None:
+            print "Could not parse %s: %s" % (field_key, field_value)
+            return
+
+    current = row['output'].get('expires_on')
+    if current == None or expires_on < current:
+        row['output']['expires_on'] = expires_on
+
+
 FIELD_STRATEGIES = {
     'company': add_as_string_to('name', get='text'),
     'address': set_as_address_subfield('street'),
@@ -235,10 +260,10 @@ FIELD_STRATEGIES = {
     'displayorder': complain_if_found,
     'country': set_as_address_subfield('country'),
     'isapproved': ignore,
-    'datedeleted': ignore,
+    'datedeleted': set_as_expires_on,
     'introduction': ignore,
-    'expires_on': ignore,
-    'isexpired': ignore,
+    'expires_on': set_as_expires_on,
+    'isexpired': set_as_expires_on,
     'datepublished': ignore,
     'avgrating': ignore,
     'ratingcount': ignore,
@@ -525,10 +550,6 @@ def parse_data_files(data_dir=DATA_DIR, file_tags=FILE_AND_TAG_ASSOCIATIONS):
     return data
 
 
-def create_listing(listing):
-    services.listing_service.create(listing)
-
-
 def main():
     """Main function that imports all data.
 
@@ -546,13 +567,15 @@ def main():
     print "Clearing the collection:", mongo_listing_collection.count()
 
     print "Adding listings..."
+    listings = []
     for file_key, file_data in data.iteritems():
         for row in file_data['rows']:
-            output = row['output']
-            listing = output
-
-            create_listing(listing)
+            listings.append(row['output'])
 
+    results = services.listing_service.create_many(listings)
+    for listing, error in zip(listings, results):
+        if error:
+            print "Could not add %s: %s" % (listing.get('name'), error)
 
     print "Saving ['meta'] : {'name': '_tinyclassified', 'next_author_id'}..."
     get_database()['meta'].save({'name': '_tinyclassified', 'next_author_id': IncrementingNumber.get()})
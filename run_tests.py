@@ -1,9 +1,19 @@
 import unittest
 
+from services.archive_service_test import *
+from services.cache_service_test import *
+from services.category_index_service_test import *
+from services.circuit_breaker_service_test import *
 from services.db_service_test import *
+from services.deadline_service_test import *
 from services.email_service_test import *
+from services.instrumentation_service_test import *
+from services.listing_model_test import *
 from services.listing_service_test import *
+from services.memory_db_service_test import *
+from services.migration_service_test import *
 from services.user_service_test import *
+from services.view_counter_service_test import *
 
 from controllers.admin_controller_test import *
 from controllers.author_controller_test import *
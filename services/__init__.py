@@ -1,13 +1,27 @@
 """services/__init__.py"""
 
+import archive_service as archive_internal
+import cache_service as cache_internal
+import circuit_breaker_service as circuit_breaker_internal
 import db_service as db_internal
+import deadline_service as deadline_internal
 import email_service as email_internal
+import listing_model as listing_model_internal
 import listing_service as listing_internal
+import migration_service as migration_internal
 #import public_service as public_internal
 import user_service as user_internal
+import view_counter_service as view_counter_internal
 
+archive_service = archive_internal
+cache_service = cache_internal
+circuit_breaker_service = circuit_breaker_internal
 db_service = db_internal
+deadline_service = deadline_internal
 email_service = email_internal
+listing_model = listing_model_internal
 listing_service = listing_internal
+migration_service = migration_internal
 #public_service = public_internal
 user_service = user_internal
+view_counter_service = view_counter_internal
@@ -0,0 +1,174 @@
+"""Service for archiving expired and long unpublished listings.
+
+Listings past their expires_on, or unpublished for ARCHIVE_UNPUBLISHED_DAYS,
+are moved from the listing collection to the listing_archive collection by
+archive_listings so that the listing and public_listing collections, their
+indices and the caches only hold the live listings. It is run from one place
+on a schedule (see setup_db.py archive) rather than by every app process.
+Archived listings can be restored.
+
+@license: GNU GPLv3
+"""
+import datetime
+
+try:
+    from tinyclassified import tiny_classified
+except:
+    import tiny_classified
+
+import category_index_service
+import listing_service
+
+DEFAULT_ARCHIVE_BATCH_SIZE = 100
+DEFAULT_ARCHIVE_UNPUBLISHED_DAYS = 90
+
+ARCHIVE_REASON_EXPIRED = 'expired'
+ARCHIVE_REASON_UNPUBLISHED = 'unpublished'
+
+
+def get_batch_size():
+    """Get the number of listings archived at a time.
+
+    @return: The configured batch size.
+    @rtype: int
+    """
+    return tiny_classified.get_config().get(
+        'ARCHIVE_BATCH_SIZE',
+        DEFAULT_ARCHIVE_BATCH_SIZE
+    )
+
+
+def get_unpublished_days():
+    """Get the number of days after which unpublished listings are archived.
+
+    @return: The configured number of days or None not to archive listings
+        for being unpublished.
+    @rtype: int
+    """
+    return tiny_classified.get_config().get(
+        'ARCHIVE_UNPUBLISHED_DAYS',
+        DEFAULT_ARCHIVE_UNPUBLISHED_DAYS
+    )
+
+
+def get_archive_reason(listing, now):
+    """Get why a listing found by the sweeper is archived.
+
+    @param listing: The listing to archive.
+    @type listing: dict
+    @param now: The time of the sweep.
+    @type now: datetime.datetime
+    @return: ARCHIVE_REASON_EXPIRED or ARCHIVE_REASON_UNPUBLISHED.
+    @rtype: str
+    """
+    expires_on = listing.get('expires_on', None)
+    if expires_on != None and expires_on <= now:
+        return ARCHIVE_REASON_EXPIRED
+    return ARCHIVE_REASON_UNPUBLISHED
+
+
+def archive_listings(now=None, batch_size=None):
+    """Archive the listings which expired or have long been unpublished.
+
+    @keyword now: The time to archive as of or None for the current time.
+    @type now: datetime.datetime
+    @keyword batch_size: The number of listings to archive at a time or None
+        for ARCHIVE_BATCH_SIZE.
+    @type batch_size: int
+    @return: The number of listings archived.
+    @rtype: int
+    """
+    if now == None:
+        now = datetime.datetime.utcnow()
+    if batch_size == None:
+        batch_size = get_batch_size()
+
+    unpublished_before = None
+    unpublished_days = get_unpublished_days()
+    if unpublished_days != None:
+        unpublished_before = now - datetime.timedelta(days=unpublished_days)
+
+    db_adapter = tiny_classified.get_db_adapter()
+    count = 0
+    after_id = None
+    while True:
+        listings = db_adapter.list_archivable_listings(
+            now,
+            unpublished_before,
+            after_id=after_id,
+            limit=batch_size
+        )
+        for listing in listings:
+            listing['archived_on'] = now
+            listing['archive_reason'] = get_archive_reason(listing, now)
+
+        archived_ids = set(db_adapter.archive_listings(listings))
+        archived = [x for x in listings if x['_id'] in archived_ids]
+        slugs = []
+        for listing in archived:
+            slugs.extend(listing.get('slugs', []))
+            listing_service.invalidate_cached_listing(listing)
+            category_index_service.remove_listing(listing['_id'])
+        listing_service.refresh_category_summaries(slugs)
+        count += len(archived)
+
+        if len(listings) < batch_size:
+            return count
+        after_id = listings[-1]['_id']
+
+
+def read_archived_by_email(email):
+    """Find the most recently archived listing of an author.
+
+    @param email: The email address of the author.
+    @type email: str
+    @return: The archived listing, with when and why it was archived under
+        "archived_on" and "archive_reason", or None if there is none.
+    @rtype: dict or None
+    """
+    return tiny_classified.get_db_adapter().get_archived_listing_by_email(email)
+
+
+def restore_by_email(email, now=None):
+    """Move the most recently archived listing of an author back to listings.
+
+    The expiration date of a listing which expired is removed and a listing
+    which was unpublished is given ARCHIVE_UNPUBLISHED_DAYS from now before it
+    is archived again.
+
+    @param email: The email address of the author.
+    @type email: str
+    @keyword now: The time to restore as of or None for the current time.
+    @type now: datetime.datetime
+    @return: The restored listing or None if the author has no archived
+        listing.
+    @rtype: dict or None
+    @raise ValueError: If the author has a listing or another listing has the
+        archived listing's name.
+    """
+    if now == None:
+        now = datetime.datetime.utcnow()
+
+    db_adapter = tiny_classified.get_db_adapter()
+    listing = db_adapter.get_archived_listing_by_email(email)
+    if listing == None:
+        return None
+
+    if db_adapter.get_listing_by_email(email):
+        raise ValueError('Author %s already has a listing.' % email)
+    if db_adapter.get_listing_by_name(listing['name']):
+        raise ValueError(
+            'Listing with name %s already exists.' % listing['name']
+        )
+
+    listing.pop('archived_on', None)
+    listing.pop('archive_reason', None)
+    listing.pop('unpublished_on', None)
+    expires_on = listing.get('expires_on', None)
+    if expires_on != None and expires_on <= now:
+        del listing['expires_on']
+
+    listing_service.update(listing)
+    db_adapter.delete_archived_listing(listing['_id'])
+    return listing
+
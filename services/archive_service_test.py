@@ -0,0 +1,165 @@
+"""Tests for archive_service.
+
+@license: GNU GPLv3
+"""
+import datetime
+
+import mox
+
+try:
+    from tinyclassified import tiny_classified
+except:
+    import tiny_classified
+
+import archive_service
+import cache_service
+import category_index_service
+import listing_service
+import memory_db_service
+
+NOW = datetime.datetime(2015, 6, 1)
+
+
+def make_listing(name, **fields):
+    listing = {
+        'author_email': '%s@example.com' % name.lower(),
+        'name': name,
+        'about': 'About %s' % name,
+        'tags': {'Food': ['Pizza']},
+        'is_published': True
+    }
+    listing_service.calculate_slugs(listing)
+    listing.update(fields)
+    return listing
+
+
+class ArchiveServiceTests(mox.MoxTestBase):
+
+    def setUp(self):
+        mox.MoxTestBase.setUp(self)
+        self.original_db_adapter = tiny_classified.get_db_adapter()
+        self.db_adapter = memory_db_service.MemoryDBAdapter()
+        tiny_classified.set_db_adapter(self.db_adapter)
+        cache_service.CACHES['listing'] = cache_service.LRUCache(0, 0, 0)
+        category_index_service.reset()
+
+        for listing in [
+            make_listing('Alpha'),
+            make_listing('Bravo', expires_on=NOW - datetime.timedelta(1)),
+            make_listing('Charlie', expires_on=NOW + datetime.timedelta(1)),
+            make_listing(
+                'Delta',
+                is_published=False,
+                unpublished_on=NOW - datetime.timedelta(100)
+            ),
+            make_listing(
+                'Echo',
+                is_published=False,
+                unpublished_on=NOW - datetime.timedelta(10)
+            )
+        ]:
+            self.db_adapter.upsert_listing(listing)
+            listing_service.publish(listing)
+        listing_service.rebuild_category_summaries()
+
+    def tearDown(self):
+        tiny_classified.set_db_adapter(self.original_db_adapter)
+        category_index_service.reset()
+        mox.MoxTestBase.tearDown(self)
+
+    def get_names(self, listings):
+        return sorted(x['name'] for x in listings)
+
+    def test_archive_listings(self):
+        self.assertEqual(2, archive_service.archive_listings(
+            now=NOW,
+            batch_size=1
+        ))
+
+        self.assertEqual(
+            ['Alpha', 'Charlie', 'Echo'],
+            self.get_names(self.db_adapter.index_listings())
+        )
+        self.assertEqual(
+            ['Alpha', 'Charlie'],
+            self.get_names(self.db_adapter.index_listings(public=True))
+        )
+        summary = listing_service.read_category_summary('Food')
+        self.assertEqual(
+            ['Alpha', 'Charlie'],
+            self.get_names(summary['listings'])
+        )
+
+        archived = archive_service.read_archived_by_email('bravo@example.com')
+        self.assertEqual(NOW, archived['archived_on'])
+        self.assertEqual(
+            archive_service.ARCHIVE_REASON_EXPIRED,
+            archived['archive_reason']
+        )
+        archived = archive_service.read_archived_by_email('delta@example.com')
+        self.assertEqual(
+            archive_service.ARCHIVE_REASON_UNPUBLISHED,
+            archived['archive_reason']
+        )
+
+        self.assertEqual(0, archive_service.archive_listings(now=NOW))
+
+    def test_archive_listings_skips_changed_listings(self):
+        original_archive = self.db_adapter.archive_listings
+
+        def publish_then_archive(listings):
+            listing = self.db_adapter.get_listing_by_name('Delta')
+            listing['is_published'] = True
+            listing_service.update(listing)
+            return original_archive(listings)
+
+        self.db_adapter.archive_listings = publish_then_archive
+        self.assertEqual(1, archive_service.archive_listings(now=NOW))
+
+        self.assertTrue(self.db_adapter.get_listing_by_name('Delta'))
+        self.assertEqual(
+            None,
+            archive_service.read_archived_by_email('delta@example.com')
+        )
+
+    def test_restore_by_email(self):
+        bravo_id = self.db_adapter.get_listing_by_name('Bravo')['_id']
+        self.db_adapter.increment_listing_views({bravo_id: 7})
+        archive_service.archive_listings(now=NOW)
+
+        listing = archive_service.restore_by_email('bravo@example.com', NOW)
+        self.assertFalse('expires_on' in listing)
+        self.assertFalse('archived_on' in listing)
+        restored = self.db_adapter.get_listing_by_name('Bravo')
+        self.assertEqual(listing['_id'], restored['_id'])
+        self.assertEqual(7, restored['views'])
+        self.assertEqual(
+            7,
+            self.db_adapter.get_listing_by_id(restored['_id'], public=True)[
+                'views']
+        )
+        self.assertEqual(
+            None,
+            archive_service.read_archived_by_email('bravo@example.com')
+        )
+
+        listing = archive_service.restore_by_email('delta@example.com', NOW)
+        self.assertTrue(listing['unpublished_on'] > NOW)
+
+        self.assertEqual(
+            None,
+            archive_service.restore_by_email('alpha@example.com', NOW)
+        )
+
+    def test_restore_by_email_name_taken(self):
+        archive_service.archive_listings(now=NOW)
+        listing_service.create(make_listing(
+            'Bravo',
+            author_email='other@example.com'
+        ))
+
+        with self.assertRaises(ValueError):
+            archive_service.restore_by_email('bravo@example.com', NOW)
+        self.assertTrue(
+            archive_service.read_archived_by_email('bravo@example.com')
+        )
@@ -0,0 +1,299 @@
+"""Bounded, expiring in-process caches for service layer reads.
+
+@license: GNU GPLv3
+"""
+import collections
+import threading
+import time
+
+import bson
+
+try:
+    from tinyclassified import tiny_classified
+except:
+    import tiny_classified
+
+import listing_model
+
+DEFAULT_LISTING_CACHE_MAX_ENTRIES = 0
+DEFAULT_LISTING_CACHE_MAX_BYTES = 16 * 1024 * 1024
+DEFAULT_LISTING_CACHE_TTL = 300
+
+DEFAULT_STALE_PAGE_CACHE_MAX_ENTRIES = 500
+DEFAULT_STALE_PAGE_CACHE_MAX_BYTES = 64 * 1024 * 1024
+DEFAULT_STALE_PAGE_CACHE_TTL = 24 * 60 * 60
+
+CACHES = {
+    'listing': None,
+    'stale_page': None
+}
+
+
+def encode_bson(value):
+    """Encode a value for an LRUCache as BSON.
+
+    @param value: The BSON serializable value to store.
+    @type value: object
+    @return: The encoded value and its size.
+    @rtype: tuple
+    """
+    data = bson.BSON.encode({'value': value})
+    return (data, len(data))
+
+
+def decode_bson(data):
+    """Decode a value encoded by encode_bson.
+
+    @param data: The encoded value.
+    @type data: str
+    @return: The value.
+    @rtype: object
+    """
+    return bson.BSON(data).decode()['value']
+
+
+class LRUCache:
+    """Least recently used cache bounded by entry count, size and age.
+
+    Values are stored encoded (by default as BSON) so that their size is known
+    and so that every hit returns a fresh copy which callers are free to
+    modify. Entries may be tagged (for example with the ids of the listings
+    they contain) so that writes can invalidate exactly the entries they
+    affect.
+    """
+
+    def __init__(self, max_entries, max_bytes, ttl, encode=encode_bson,
+        decode=decode_bson):
+        """Create a new empty cache.
+
+        @param max_entries: The maximum number of entries to keep. A cache with
+            a maximum of 0 entries stores nothing.
+        @type max_entries: int
+        @param max_bytes: The maximum total size of the encoded entries.
+        @type max_bytes: int
+        @param ttl: The number of seconds an entry stays valid.
+        @type ttl: float
+        @keyword encode: Function which returns the form in which to store a
+            value and its size in bytes.
+        @type encode: function
+        @keyword decode: Function which returns a fresh copy of a value from
+            its stored form.
+        @type decode: function
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.encode = encode
+        self.decode = decode
+        self.lock = threading.RLock()
+        self.entries = collections.OrderedDict()
+        self.tags = {}
+        self.size = 0
+        self.generation = 0
+
+    def get(self, key):
+        """Get an entry if it is present and has not expired.
+
+        @param key: The key of the entry to get.
+        @type key: hashable
+        @return: Pair of a flag indicating if the entry was found and the
+            entry's value (or None if not found).
+        @rtype: tuple
+        """
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry == None:
+                return (False, None)
+
+            (expires_at, data, size, tags) = entry
+            if expires_at <= time.time():
+                self.discard_entry(key, entry)
+                return (False, None)
+
+            # Re-insert to mark the entry as the most recently used.
+            self.entries[key] = entry
+
+        return (True, self.decode(data))
+
+    def put(self, key, value, tags=(), generation=None):
+        """Add or replace an entry.
+
+        @param key: The key of the entry to add.
+        @type key: hashable
+        @param value: The value to cache, which must be BSON serializable
+            unless the cache was created with another encode function.
+        @type value: object
+        @keyword tags: Tags through which the entry can be invalidated.
+        @type tags: iterable over hashable
+        @keyword generation: If given, the value of self.generation when the
+            value was read. The entry is not added if anything was invalidated
+            since then because the value could already be stale.
+        @type generation: int
+        """
+        if self.max_entries <= 0:
+            return
+
+        (data, size) = self.encode(value)
+        if size > self.max_bytes:
+            return
+
+        tags = frozenset(tags)
+        with self.lock:
+            if generation != None and generation != self.generation:
+                return
+
+            old_entry = self.entries.pop(key, None)
+            if old_entry != None:
+                self.discard_entry(key, old_entry)
+
+            self.entries[key] = (time.time() + self.ttl, data, size, tags)
+            self.size += size
+            for tag in tags:
+                self.tags.setdefault(tag, set()).add(key)
+
+            while (len(self.entries) > self.max_entries or
+                self.size > self.max_bytes):
+                oldest_key, oldest_entry = self.entries.popitem(last=False)
+                self.discard_entry(oldest_key, oldest_entry)
+
+    def read_through(self, key, read, get_tags=lambda value: ()):
+        """Get an entry, reading and caching it if it is not present.
+
+        Reads which find nothing (None) are not cached so that something
+        written since by another process is found by the next read.
+
+        @param key: The key of the entry to get.
+        @type key: hashable
+        @param read: Function without arguments which reads the value.
+        @type read: function
+        @keyword get_tags: Function which returns the tags of a read value.
+        @type get_tags: function
+        @return: The cached or newly read value.
+        @rtype: object
+        """
+        (found, value) = self.get(key)
+        if found:
+            return value
+
+        generation = self.generation
+        value = read()
+        if value != None and self.max_entries > 0:
+            self.put(key, value, get_tags(value), generation)
+        return value
+
+    def invalidate(self, key):
+        """Remove an entry if present.
+
+        @param key: The key of the entry to remove.
+        @type key: hashable
+        """
+        with self.lock:
+            self.generation += 1
+            entry = self.entries.pop(key, None)
+            if entry != None:
+                self.discard_entry(key, entry)
+
+    def invalidate_tag(self, tag):
+        """Remove all entries with a tag.
+
+        @param tag: The tag of the entries to remove.
+        @type tag: hashable
+        """
+        with self.lock:
+            self.generation += 1
+            for key in list(self.tags.get(tag, ())):
+                self.invalidate(key)
+
+    def invalidate_matching(self, predicate):
+        """Remove all entries with keys matching a predicate.
+
+        @param predicate: Function which returns True for keys to remove.
+        @type predicate: function
+        """
+        with self.lock:
+            self.generation += 1
+            for key in [key for key in self.entries if predicate(key)]:
+                self.invalidate(key)
+
+    def clear(self):
+        """Remove all entries."""
+        with self.lock:
+            self.generation += 1
+            self.entries.clear()
+            self.tags.clear()
+            self.size = 0
+
+    def discard_entry(self, key, entry):
+        """Update the size and tag bookkeeping for a removed entry.
+
+        @param key: The key of the removed entry.
+        @type key: hashable
+        @param entry: The removed (expires_at, data, size, tags) entry.
+        @type entry: tuple
+        """
+        (expires_at, data, size, tags) = entry
+        self.size -= size
+        for tag in tags:
+            keys = self.tags.get(tag, None)
+            if keys != None:
+                keys.discard(key)
+                if not keys:
+                    del self.tags[tag]
+
+
+def get_listing_cache():
+    """Get the process wide cache for listing reads.
+
+    The cache is created on first use from LISTING_CACHE_MAX_ENTRIES,
+    LISTING_CACHE_MAX_BYTES and LISTING_CACHE_TTL. It is disabled (stores
+    nothing) unless LISTING_CACHE_MAX_ENTRIES is set. Writes invalidate the
+    cache of the process making them; other processes see them once the
+    entries expire. Listings are kept as listing_model.Listing so that the
+    cache can hold many of them and hits are not decoded until they are used.
+
+    @return: The listing cache.
+    @rtype: LRUCache
+    """
+    if CACHES['listing'] == None:
+        config = tiny_classified.get_config()
+        CACHES['listing'] = LRUCache(
+            config.get(
+                'LISTING_CACHE_MAX_ENTRIES',
+                DEFAULT_LISTING_CACHE_MAX_ENTRIES
+            ),
+            config.get(
+                'LISTING_CACHE_MAX_BYTES',
+                DEFAULT_LISTING_CACHE_MAX_BYTES
+            ),
+            config.get('LISTING_CACHE_TTL', DEFAULT_LISTING_CACHE_TTL),
+            encode=listing_model.encode_for_cache,
+            decode=listing_model.copy_value
+        )
+    return CACHES['listing']
+
+
+def get_stale_page_cache():
+    """Get the process wide cache of the last good rendering of public pages.
+
+    Pages are only read from this cache when the database is unavailable, so
+    entries are kept for much longer than listing cache entries. The cache is
+    created on first use from STALE_PAGE_CACHE_MAX_ENTRIES,
+    STALE_PAGE_CACHE_MAX_BYTES and STALE_PAGE_CACHE_TTL.
+
+    @return: The stale page cache.
+    @rtype: LRUCache
+    """
+    if CACHES['stale_page'] == None:
+        config = tiny_classified.get_config()
+        CACHES['stale_page'] = LRUCache(
+            config.get(
+                'STALE_PAGE_CACHE_MAX_ENTRIES',
+                DEFAULT_STALE_PAGE_CACHE_MAX_ENTRIES
+            ),
+            config.get(
+                'STALE_PAGE_CACHE_MAX_BYTES',
+                DEFAULT_STALE_PAGE_CACHE_MAX_BYTES
+            ),
+            config.get('STALE_PAGE_CACHE_TTL', DEFAULT_STALE_PAGE_CACHE_TTL)
+        )
+    return CACHES['stale_page']
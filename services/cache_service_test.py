@@ -0,0 +1,141 @@
+"""Tests for cache_service.
+
+@license: GNU GPLv3
+"""
+import time
+
+import mox
+
+try:
+    from tinyclassified import tiny_classified
+except:
+    import tiny_classified
+
+import cache_service
+import listing_model
+
+TEST_VALUE = {'name': 'TestName', 'slugs': ['cat/subcat/TestName']}
+
+
+class LRUCacheTests(mox.MoxTestBase):
+
+    def setUp(self):
+        mox.MoxTestBase.setUp(self)
+        self.cache = cache_service.LRUCache(2, 1024, 60)
+
+    def test_get_missing(self):
+        self.assertEqual((False, None), self.cache.get('missing'))
+
+    def test_put_get_returns_copy(self):
+        self.cache.put('key', TEST_VALUE)
+
+        (found, value) = self.cache.get('key')
+        self.assertTrue(found)
+        self.assertEqual(TEST_VALUE, value)
+
+        value['name'] = 'Changed'
+        self.assertEqual(TEST_VALUE, self.cache.get('key')[1])
+
+    def test_put_none(self):
+        self.cache.put('key', None)
+        self.assertEqual((True, None), self.cache.get('key'))
+
+    def test_expired(self):
+        self.mox.StubOutWithMock(time, 'time')
+        time.time().AndReturn(100)
+        time.time().AndReturn(161)
+
+        self.mox.ReplayAll()
+
+        self.cache.put('key', TEST_VALUE)
+        self.assertEqual((False, None), self.cache.get('key'))
+        self.assertEqual(0, self.cache.size)
+
+    def test_evicts_least_recently_used_by_count(self):
+        self.cache.put('first', 1)
+        self.cache.put('second', 2)
+        self.cache.get('first')
+        self.cache.put('third', 3)
+
+        self.assertEqual((True, 1), self.cache.get('first'))
+        self.assertEqual((False, None), self.cache.get('second'))
+        self.assertEqual((True, 3), self.cache.get('third'))
+
+    def test_evicts_least_recently_used_by_bytes(self):
+        cache = cache_service.LRUCache(10, 100, 60)
+        cache.put('first', 'a' * 40)
+        cache.put('second', 'b' * 40)
+
+        self.assertEqual((False, None), cache.get('first'))
+        self.assertEqual((True, 'b' * 40), cache.get('second'))
+        self.assertTrue(cache.size <= 100)
+
+    def test_put_too_large(self):
+        self.cache.put('key', 'a' * 2048)
+        self.assertEqual((False, None), self.cache.get('key'))
+
+    def test_disabled(self):
+        cache = cache_service.LRUCache(0, 1024, 60)
+        cache.put('key', TEST_VALUE)
+        self.assertEqual((False, None), cache.get('key'))
+
+    def test_invalidate_tag(self):
+        self.cache.put('first', 1, tags=['a', 'b'])
+        self.cache.put('second', 2, tags=['b'])
+
+        self.cache.invalidate_tag('a')
+        self.assertEqual((False, None), self.cache.get('first'))
+        self.assertEqual((True, 2), self.cache.get('second'))
+        self.assertEqual({'b': set(['second'])}, self.cache.tags)
+
+    def test_invalidate_matching(self):
+        self.cache.put(('list', 'cat'), 1)
+        self.cache.put(('slug', 'cat/sub/name'), 2)
+
+        self.cache.invalidate_matching(lambda key: key[0] == 'list')
+        self.assertEqual((False, None), self.cache.get(('list', 'cat')))
+        self.assertEqual((True, 2), self.cache.get(('slug', 'cat/sub/name')))
+
+    def test_put_after_invalidation_ignored(self):
+        generation = self.cache.generation
+        self.cache.invalidate('key')
+        self.cache.put('key', 'stale', generation=generation)
+        self.assertEqual((False, None), self.cache.get('key'))
+
+    def test_read_through(self):
+        reads = []
+        def read():
+            reads.append(True)
+            return TEST_VALUE
+
+        self.assertEqual(TEST_VALUE, self.cache.read_through('key', read))
+        self.assertEqual(TEST_VALUE, self.cache.read_through('key', read))
+        self.assertEqual(1, len(reads))
+
+    def test_read_through_does_not_cache_misses(self):
+        reads = []
+        def read():
+            reads.append(True)
+            return None
+
+        self.assertEqual(None, self.cache.read_through('key', read))
+        self.assertEqual(None, self.cache.read_through('key', read))
+        self.assertEqual(2, len(reads))
+
+    def test_listing_cache_keeps_listings(self):
+        cache = cache_service.LRUCache(
+            2,
+            1024,
+            60,
+            encode=listing_model.encode_for_cache,
+            decode=listing_model.copy_value
+        )
+        listing = dict(TEST_VALUE, _id='someid')
+        cache.put('key', listing)
+
+        (found, value) = cache.get('key')
+        self.assertTrue(isinstance(value, listing_model.Listing))
+        self.assertEqual(listing, value)
+
+        value['slugs'].append('cat/other/TestName')
+        self.assertEqual(listing, cache.get('key')[1])
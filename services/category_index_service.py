@@ -0,0 +1,442 @@
+"""In-process index of listing categories, their counts and listing slugs.
+
+Building the category tree from distinct('tags') on every page view costs a
+database round trip plus a merge over every tag dict, and finding the listing
+for a URL costs a query even when there is none. Instead the tree and a routing
+table from slugs to listing ids are built once per process from the listings'
+tags and slugs and then kept up to date as listings are written through
+listing_service. Only published listings are indexed.
+
+Writes made by other processes are picked up when the index is rebuilt, in the
+background every CATEGORY_INDEX_TTL seconds, so until then the index may miss
+their slugs and categories. Routing therefore only trusts the index for what it
+finds and looks up anything else in the database (see
+listing_service.read_by_slug and check_has_listings).
+
+@license: GNU GPLv3
+"""
+import copy
+import logging
+import threading
+import time
+
+try:
+    from tinyclassified import tiny_classified
+except:
+    import tiny_classified
+
+import db_service
+import deadline_service
+
+DEFAULT_CATEGORY_INDEX_TTL = 60
+INDEX_FIELDS = ['tags', 'slugs']
+
+INDEXES = {
+    'category': None,
+    'rebuild_thread': None,
+    'generation': 0,
+    'pending_writes': None
+}
+INDEXES_LOCK = threading.Lock()
+
+
+def get_slug_prefixes(slug):
+    """Get the category and category / subcategory prefixes of a slug.
+
+    @param slug: A qualified listing slug.
+    @type slug: str
+    @return: The normalized category and category / subcategory slugs which
+        route to the listing.
+    @rtype: list of str
+    """
+    parts = db_service.normalize_slug(slug).split('/', 2)
+    return [parts[0], '/'.join(parts[:2])]
+
+
+def get_listing_entry(listing):
+    """Get what the index keeps about a listing.
+
+    @param listing: The listing whose tags and slugs to read.
+    @type listing: dict
+    @return: Set of categories, set of (category, subcategory) pairs and set
+        of qualified slugs.
+    @rtype: tuple
+    """
+    tags = listing.get('tags', None) or {}
+    categories = frozenset(tags.iterkeys())
+    pairs = frozenset(
+        (category, subcategory)
+        for category, subcategories in tags.iteritems()
+        for subcategory in subcategories
+    )
+    slugs = frozenset(listing.get('slugs', None) or [])
+    return (categories, pairs, slugs)
+
+
+class CategoryIndex:
+    """Listing counts by category and subcategory and listing ids by slug.
+
+    Writes cost O(number of tags and slugs of the listing written). Slug
+    lookups are dict reads. The category dicts returned by reads are computed
+    once after each change and shared until the next, so reads between writes
+    are O(1). Callers must not modify anything returned.
+    """
+
+    def __init__(self, listings=()):
+        """Create a new index.
+
+        @keyword listings: The listings to start with. Each needs "_id",
+            "tags" and "slugs" (INDEX_FIELDS) but no other fields.
+        @type listings: iterable over dict
+        """
+        self.lock = threading.RLock()
+        self.category_counts = {}
+        self.subcategory_counts = {}
+        self.listing_entries = {}
+        self.listing_id_by_slug = {}
+        self.listing_ids_by_prefix = {}
+        self.views = {}
+        self.built_at = time.time()
+        for listing in listings:
+            self.update_listing(listing)
+
+    def change_count(self, counts, key, amount):
+        """Change a count, dropping it from counts once it reaches zero."""
+        count = counts.get(key, 0) + amount
+        if count > 0:
+            counts[key] = count
+        else:
+            counts.pop(key, None)
+
+    def apply(self, listing_id, entry, amount):
+        """Add or remove a listing's counts and routes.
+
+        @param listing_id: The "_id" of the listing.
+        @type listing_id: bson.objectid.ObjectId
+        @param entry: The listing's entry from get_listing_entry.
+        @type entry: tuple
+        @param amount: 1 to add the listing or -1 to remove it.
+        @type amount: int
+        """
+        (categories, subcategory_pairs, slugs) = entry
+        for category in categories:
+            self.change_count(self.category_counts, category, amount)
+        for (category, subcategory) in subcategory_pairs:
+            counts = self.subcategory_counts.setdefault(category, {})
+            self.change_count(counts, subcategory, amount)
+            if not counts:
+                del self.subcategory_counts[category]
+
+        for slug in slugs:
+            if amount > 0:
+                self.listing_id_by_slug[slug] = listing_id
+            elif self.listing_id_by_slug.get(slug, None) == listing_id:
+                del self.listing_id_by_slug[slug]
+
+            for prefix in get_slug_prefixes(slug):
+                listing_ids = self.listing_ids_by_prefix.setdefault(
+                    prefix,
+                    set()
+                )
+                if amount > 0:
+                    listing_ids.add(listing_id)
+                else:
+                    listing_ids.discard(listing_id)
+                    if not listing_ids:
+                        del self.listing_ids_by_prefix[prefix]
+
+    def update_listing(self, listing):
+        """Count a new listing or recount a changed one.
+
+        @param listing: The listing, which must have an "_id".
+        @type listing: dict
+        """
+        listing_id = listing['_id']
+        entry = get_listing_entry(listing)
+        with self.lock:
+            old_entry = self.listing_entries.get(listing_id, None)
+            if old_entry == entry:
+                return
+            if old_entry != None:
+                self.apply(listing_id, old_entry, -1)
+            self.apply(listing_id, entry, 1)
+            self.listing_entries[listing_id] = entry
+            self.views = {}
+
+    def remove_listing(self, listing_id):
+        """Stop counting a deleted listing.
+
+        @param listing_id: The "_id" of the deleted listing.
+        @type listing_id: bson.objectid.ObjectId
+        """
+        with self.lock:
+            old_entry = self.listing_entries.pop(listing_id, None)
+            if old_entry != None:
+                self.apply(listing_id, old_entry, -1)
+                self.views = {}
+
+    def get_view(self, name, home_only):
+        """Get a computed view of the index, computing it if needed.
+
+        @param name: Either "categories" or "counts".
+        @type name: str
+        @param home_only: If True, leave out NO_FRONT_PAGE_CATEGORIES.
+        @type home_only: bool
+        @return: The view.
+        @rtype: dict
+        """
+        with self.lock:
+            view = self.views.get((name, home_only), None)
+            if view != None:
+                return view
+
+            to_ignore = ()
+            if home_only:
+                to_ignore = tiny_classified.get_config()[
+                    'NO_FRONT_PAGE_CATEGORIES']
+
+            view = {}
+            for category, count in self.category_counts.iteritems():
+                if category in to_ignore:
+                    continue
+                subcategories = self.subcategory_counts.get(category, {})
+                if name == 'categories':
+                    view[category] = sorted(subcategories)
+                else:
+                    view[category] = {
+                        'count': count,
+                        'subcategories': dict(subcategories)
+                    }
+
+            self.views[(name, home_only)] = view
+            return view
+
+    def get_categories(self, home_only=True):
+        """Get the categories with the names of their subcategories.
+
+        @keyword home_only: If True, leave out NO_FRONT_PAGE_CATEGORIES.
+        @type home_only: bool
+        @return: Dict from category to its sorted subcategories like
+            listing_service.collect_index_dict returns.
+        @rtype: dict
+        """
+        return self.get_view('categories', home_only)
+
+    def get_counts(self, home_only=True):
+        """Get the number of listings in each category and subcategory.
+
+        @keyword home_only: If True, leave out NO_FRONT_PAGE_CATEGORIES.
+        @type home_only: bool
+        @return: Dict from category to a dict with the category's "count" and
+            "subcategories", a dict from subcategory to count.
+        @rtype: dict
+        """
+        return self.get_view('counts', home_only)
+
+    def get_listing_id(self, qualified_slug):
+        """Get the listing routed to by a qualified slug.
+
+        @param qualified_slug: The qualified slug, matched exactly.
+        @type qualified_slug: str
+        @return: The "_id" of the listing or None if no listing has the slug.
+        @rtype: bson.objectid.ObjectId
+        """
+        return self.listing_id_by_slug.get(qualified_slug, None)
+
+    def get_listing_ids(self, slug):
+        """Get the listings under a category or category / subcategory slug.
+
+        @param slug: The category or category / subcategory slug, matched
+            case-insensitively.
+        @type slug: str
+        @return: The "_id"s of the listings under the slug. Empty if there are
+            none.
+        @rtype: frozenset
+        """
+        with self.lock:
+            return frozenset(self.listing_ids_by_prefix.get(
+                db_service.normalize_slug(slug).rstrip('/'),
+                ()
+            ))
+
+    def has_listings(self, slug):
+        """Check if there are listings under a category or subcategory slug.
+
+        @param slug: The category or category / subcategory slug, matched
+            case-insensitively.
+        @type slug: str
+        @return: True if at least one listing is under the slug.
+        @rtype: bool
+        """
+        slug = db_service.normalize_slug(slug).rstrip('/')
+        return slug in self.listing_ids_by_prefix
+
+
+def build_category_index(adapter):
+    """Build a new category index from the listings in the database.
+
+    @param adapter: The database adapter to read the listings through.
+    @type adapter: db_service.DBAdapter
+    @return: The new index.
+    @rtype: CategoryIndex
+    """
+    return CategoryIndex(adapter.index_listings(
+        fields=INDEX_FIELDS,
+        public=True
+    ))
+
+
+def rebuild_category_index(adapter, generation):
+    """Build a new category index and replace the current one with it.
+
+    If the build fails the current index keeps being used and the next
+    rebuild is attempted CATEGORY_INDEX_TTL later. Writes made through this
+    process while the index was being built are applied to the new index
+    before it is used, and it is dropped if the index was reset meanwhile.
+
+    @param adapter: The database adapter to read the listings through.
+    @type adapter: db_service.DBAdapter
+    @param generation: The value of INDEXES['generation'] when the rebuild
+        was started.
+    @type generation: int
+    """
+    try:
+        index = build_category_index(adapter)
+    except Exception:
+        logging.exception('Could not rebuild the category index.')
+        with INDEXES_LOCK:
+            INDEXES['pending_writes'] = None
+            if INDEXES['category'] != None:
+                INDEXES['category'].built_at = time.time()
+        return
+
+    with INDEXES_LOCK:
+        if INDEXES['generation'] == generation:
+            for (listing_id, listing) in INDEXES['pending_writes'] or []:
+                apply_write(index, listing_id, listing)
+            INDEXES['category'] = index
+            INDEXES['pending_writes'] = None
+
+
+def rebuild_in_background():
+    """Start rebuild_category_index on a daemon thread unless one is running.
+
+    @return: The running rebuild thread.
+    @rtype: threading.Thread
+    """
+    with INDEXES_LOCK:
+        generation = INDEXES['generation']
+        thread = INDEXES['rebuild_thread']
+        if thread == None or not thread.is_alive() or \
+            thread.generation != generation:
+            thread = threading.Thread(
+                target=rebuild_category_index,
+                args=(tiny_classified.get_db_adapter(), generation),
+                name='category_index'
+            )
+            thread.generation = generation
+            thread.daemon = True
+            INDEXES['pending_writes'] = []
+            thread.start()
+            INDEXES['rebuild_thread'] = thread
+        return thread
+
+
+def get_category_index(wait=True):
+    """Get the process wide category index, building it if needed.
+
+    An index older than CATEGORY_INDEX_TTL keeps being returned while a new
+    one is built in the background, so requests never wait for a rebuild.
+
+    @keyword wait: If the index has not been built yet, True to wait for it
+        (until the current thread's deadline, if any) and False to return None
+        at once.
+    @type wait: bool
+    @return: The category index or None if it is not built yet and wait is
+        False.
+    @rtype: CategoryIndex
+    @raise deadline_service.DeadlineExceeded: Raised if waiting and the index
+        could not be built before the deadline.
+    """
+    index = INDEXES['category']
+    if index == None:
+        thread = rebuild_in_background()
+        if not wait:
+            return None
+
+        remaining_ms = deadline_service.get_remaining_ms()
+        thread.join(None if remaining_ms == None else remaining_ms / 1000.0)
+        index = INDEXES['category']
+        if index == None:
+            raise deadline_service.DeadlineExceeded(
+                'The category index could not be built.')
+        return index
+
+    ttl = tiny_classified.get_config().get(
+        'CATEGORY_INDEX_TTL',
+        DEFAULT_CATEGORY_INDEX_TTL
+    )
+    if time.time() - index.built_at >= ttl:
+        rebuild_in_background()
+    return index
+
+
+def apply_write(index, listing_id, listing):
+    """Update a category index after a listing is saved or deleted.
+
+    @param index: The index to update.
+    @type index: CategoryIndex
+    @param listing_id: The "_id" of the listing.
+    @type listing_id: bson.objectid.ObjectId
+    @param listing: The saved listing or None if it was deleted. Only
+        published listings are indexed, so a listing which is not published
+        is removed from the index.
+    @type listing: dict or None
+    """
+    if listing != None and listing.get('is_published', False):
+        index.update_listing(listing)
+    else:
+        index.remove_listing(listing_id)
+
+
+def record_write(listing_id, listing):
+    """Apply a write to the category index and to any index being built.
+
+    @param listing_id: The "_id" of the listing.
+    @type listing_id: bson.objectid.ObjectId
+    @param listing: The saved listing or None if it was deleted.
+    @type listing: dict or None
+    """
+    with INDEXES_LOCK:
+        if INDEXES['pending_writes'] != None:
+            INDEXES['pending_writes'].append(
+                (listing_id, copy.deepcopy(listing)))
+        if INDEXES['category'] != None:
+            apply_write(INDEXES['category'], listing_id, listing)
+
+
+def update_listing(listing):
+    """Update the category index, if built, after a listing is saved.
+
+    @param listing: The saved listing.
+    @type listing: dict
+    """
+    if listing.get('_id', None) != None:
+        record_write(listing['_id'], listing)
+
+
+def remove_listing(listing_id):
+    """Update the category index, if built, after a listing is deleted.
+
+    @param listing_id: The "_id" of the deleted listing.
+    @type listing_id: bson.objectid.ObjectId
+    """
+    record_write(listing_id, None)
+
+
+def reset():
+    """Discard the category index so that it is rebuilt on next use."""
+    with INDEXES_LOCK:
+        INDEXES['generation'] += 1
+        INDEXES['category'] = None
+        INDEXES['pending_writes'] = None
@@ -0,0 +1,254 @@
+"""Tests for category_index_service.
+
+@license: GNU GPLv3
+"""
+import mox
+from pymongo import errors
+
+try:
+    from tinyclassified import tiny_classified
+except:
+    import tiny_classified
+
+import category_index_service
+import deadline_service
+import listing_service
+import memory_db_service
+
+TEST_LISTINGS = [
+    {'_id': 1, 'tags': {'Food': ['Pizza']}, 'slugs': ['Food/Pizza/A']},
+    {
+        '_id': 2,
+        'tags': {'Food': ['Pizza', 'Tacos']},
+        'slugs': ['Food/Pizza/B', 'Food/Tacos/B']
+    },
+    {
+        '_id': 3,
+        'tags': {'Shops': ['Books'], 'Food': ['Cafes']},
+        'slugs': ['Shops/Books/C', 'Food/Cafes/C']
+    }
+]
+
+
+class CategoryIndexTests(mox.MoxTestBase):
+
+    def setUp(self):
+        mox.MoxTestBase.setUp(self)
+        self.config = tiny_classified.get_config()
+        self.original_ignored = self.config['NO_FRONT_PAGE_CATEGORIES']
+        self.config['NO_FRONT_PAGE_CATEGORIES'] = ['Shops']
+        self.index = category_index_service.CategoryIndex(TEST_LISTINGS)
+
+    def tearDown(self):
+        self.config['NO_FRONT_PAGE_CATEGORIES'] = self.original_ignored
+        mox.MoxTestBase.tearDown(self)
+
+    def test_get_categories(self):
+        self.assertEqual(
+            {'Food': ['Cafes', 'Pizza', 'Tacos'], 'Shops': ['Books']},
+            self.index.get_categories(home_only=False)
+        )
+        self.assertEqual(
+            {'Food': ['Cafes', 'Pizza', 'Tacos']},
+            self.index.get_categories(home_only=True)
+        )
+
+    def test_get_counts(self):
+        self.assertEqual(
+            {
+                'Food': {
+                    'count': 3,
+                    'subcategories': {'Cafes': 1, 'Pizza': 2, 'Tacos': 1}
+                },
+                'Shops': {'count': 1, 'subcategories': {'Books': 1}}
+            },
+            self.index.get_counts(home_only=False)
+        )
+
+    def test_reads_are_shared_until_change(self):
+        categories = self.index.get_categories()
+        self.assertTrue(categories is self.index.get_categories())
+
+        self.index.update_listing({'_id': 4, 'tags': {'Food': ['Bars']}})
+        self.assertFalse(categories is self.index.get_categories())
+
+    def test_update_listing_moves_counts(self):
+        self.index.update_listing({'_id': 2, 'tags': {'Shops': ['Toys']}})
+        self.assertEqual(
+            {
+                'Food': {
+                    'count': 2,
+                    'subcategories': {'Cafes': 1, 'Pizza': 1}
+                },
+                'Shops': {
+                    'count': 2,
+                    'subcategories': {'Books': 1, 'Toys': 1}
+                }
+            },
+            self.index.get_counts(home_only=False)
+        )
+
+    def test_remove_listing_drops_empty_categories(self):
+        self.index.remove_listing(3)
+        self.index.remove_listing(3)
+        self.index.remove_listing('unknown')
+        self.assertEqual(
+            {'Food': ['Pizza', 'Tacos']},
+            self.index.get_categories(home_only=False)
+        )
+
+    def test_routes(self):
+        self.assertEqual(2, self.index.get_listing_id('Food/Tacos/B'))
+        self.assertEqual(None, self.index.get_listing_id('food/tacos/b'))
+        self.assertEqual(None, self.index.get_listing_id('Food/Tacos/A'))
+        self.assertEqual(
+            frozenset([1, 2, 3]),
+            self.index.get_listing_ids('food')
+        )
+        self.assertEqual(
+            frozenset([1, 2]),
+            self.index.get_listing_ids('Food/Pizza/')
+        )
+        self.assertTrue(self.index.has_listings('Shops/Books'))
+        self.assertFalse(self.index.has_listings('Shop'))
+
+    def test_update_listing_moves_routes(self):
+        self.index.update_listing({
+            '_id': 2,
+            'tags': {'Food': ['Tacos']},
+            'slugs': ['Food/Tacos/B2']
+        })
+        self.assertEqual(None, self.index.get_listing_id('Food/Pizza/B'))
+        self.assertEqual(2, self.index.get_listing_id('Food/Tacos/B2'))
+        self.assertEqual(
+            frozenset([1]),
+            self.index.get_listing_ids('Food/Pizza')
+        )
+
+        self.index.remove_listing(2)
+        self.assertEqual(None, self.index.get_listing_id('Food/Tacos/B2'))
+        self.assertFalse(self.index.has_listings('Food/Tacos'))
+
+    def test_listing_without_tags(self):
+        self.index.update_listing({'_id': 4, 'tags': []})
+        self.index.remove_listing(4)
+        self.assertEqual(3, self.index.get_counts()['Food']['count'])
+
+
+class CategoryIndexServiceTests(mox.MoxTestBase):
+
+    def setUp(self):
+        mox.MoxTestBase.setUp(self)
+        self.original_db_adapter = tiny_classified.get_db_adapter()
+        self.adapter = memory_db_service.MemoryDBAdapter()
+        tiny_classified.set_db_adapter(self.adapter)
+        category_index_service.reset()
+
+    def tearDown(self):
+        category_index_service.reset()
+        tiny_classified.set_db_adapter(self.original_db_adapter)
+        mox.MoxTestBase.tearDown(self)
+
+    def create(self, name, tags):
+        listing = {'author_email': '%s@example.com' % name, 'name': name,
+            'tags': tags, 'is_published': True}
+        listing_service.create(listing)
+        return listing
+
+    def test_listing_service_writes_update_index(self):
+        self.create('Alpha', {'Food': ['Pizza']})
+        self.assertEqual(
+            {'Food': ['Pizza']},
+            listing_service.get_categories(home_only=False)
+        )
+
+        bravo = self.create('Bravo', {'Food': ['Tacos']})
+        bravo['tags'] = {'Shops': ['Books']}
+        listing_service.update(bravo)
+        self.assertEqual(
+            {'Food': ['Pizza'], 'Shops': ['Books']},
+            listing_service.get_categories(home_only=False)
+        )
+
+        bravo['is_published'] = False
+        listing_service.update(bravo)
+        counts = listing_service.get_category_counts(home_only=False)
+        self.assertEqual(
+            {'Food': {'count': 1, 'subcategories': {'Pizza': 1}}},
+            counts
+        )
+
+    def test_rebuilds_after_ttl(self):
+        self.create('Alpha', {'Food': ['Pizza']})
+        index = category_index_service.get_category_index()
+
+        # Written by another process, so not seen until the rebuild.
+        listing = {'name': 'Bravo', 'tags': {'Bars': ['Pub']}}
+        self.adapter.upsert_listing(listing)
+        self.adapter.upsert_public_listing(listing)
+        self.assertTrue(index is category_index_service.get_category_index())
+
+        index.built_at -= category_index_service.DEFAULT_CATEGORY_INDEX_TTL
+        self.assertTrue(index is category_index_service.get_category_index())
+        category_index_service.INDEXES['rebuild_thread'].join()
+        self.assertEqual(
+            ['Bars', 'Food'],
+            sorted(category_index_service.get_category_index().get_categories(
+                home_only=False
+            ))
+        )
+
+    def test_rebuild_keeps_concurrent_writes(self):
+        alpha = self.create('Alpha', {'Food': ['Pizza']})
+        index = category_index_service.get_category_index()
+        index.built_at -= category_index_service.DEFAULT_CATEGORY_INDEX_TTL
+        original_build = category_index_service.build_category_index
+
+        def build_then_unpublish(adapter):
+            new_index = original_build(adapter)
+            alpha['is_published'] = False
+            listing_service.update(alpha)
+            return new_index
+
+        self.mox.StubOutWithMock(category_index_service,
+            'build_category_index')
+        category_index_service.build_category_index(
+            mox.IgnoreArg()).WithSideEffects(build_then_unpublish)
+        self.mox.ReplayAll()
+
+        category_index_service.get_category_index()
+        category_index_service.INDEXES['rebuild_thread'].join()
+        self.assertFalse(index is category_index_service.get_category_index())
+        self.assertEqual({}, listing_service.get_categories(home_only=False))
+
+    def test_keeps_index_when_rebuild_fails(self):
+        index = category_index_service.get_category_index()
+        index.built_at -= category_index_service.DEFAULT_CATEGORY_INDEX_TTL
+
+        self.mox.StubOutWithMock(category_index_service,
+            'build_category_index')
+        category_index_service.build_category_index(mox.IgnoreArg()).AndRaise(
+            errors.AutoReconnect('test'))
+        self.mox.ReplayAll()
+
+        self.assertTrue(index is category_index_service.get_category_index())
+        category_index_service.INDEXES['rebuild_thread'].join()
+        self.assertTrue(index is category_index_service.get_category_index())
+        category_index_service.INDEXES['rebuild_thread'].join()
+
+    def test_first_build_fails(self):
+        self.mox.StubOutWithMock(category_index_service,
+            'build_category_index')
+        category_index_service.build_category_index(mox.IgnoreArg()).AndRaise(
+            errors.AutoReconnect('test'))
+        category_index_service.build_category_index(mox.IgnoreArg()).AndRaise(
+            errors.AutoReconnect('test'))
+        self.mox.ReplayAll()
+
+        self.assertEqual(
+            None,
+            category_index_service.get_category_index(wait=False)
+        )
+        category_index_service.INDEXES['rebuild_thread'].join()
+        with self.assertRaises(deadline_service.DeadlineExceeded):
+            category_index_service.get_category_index()
@@ -0,0 +1,204 @@
+"""Circuit breaker which fails database reads fast while mongodb is unhealthy.
+
+When reads keep failing or taking too long, waiting for the driver timeout on
+every request only ties up workers. After MONGO_BREAKER_FAILURES consecutive
+failed or slow reads the breaker opens and reads raise CircuitOpenError right
+away so that callers can fall back (for example to a stale page). After
+MONGO_BREAKER_RESET_SECONDS one probe read is let through (half-open): the
+breaker closes if it succeeds and opens again if it does not.
+
+@license: GNU GPLv3
+"""
+import functools
+import threading
+import time
+
+from pymongo import errors
+
+try:
+    from tinyclassified import tiny_classified
+except:
+    import tiny_classified
+
+DEFAULT_FAILURE_THRESHOLD = 5
+DEFAULT_LATENCY_THRESHOLD_MS = 2000
+DEFAULT_RESET_TIMEOUT = 30
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+BREAKERS = {
+    'read': None
+}
+BREAKERS_LOCK = threading.Lock()
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of making a call while the breaker is open."""
+    pass
+
+
+# Errors which indicate that the database (or the connection to it) is down
+# rather than a problem with the call itself.
+DATABASE_FAILURE_ERRORS = (errors.ConnectionFailure,)
+
+# Errors raised when a read runs out of its request's time budget (maxTimeMS,
+# see deadline_service). An expensive request fails on its own without
+# counting against the database, so that a few of them cannot open the breaker
+# for every other request.
+REQUEST_TIMEOUT_ERRORS = (errors.ExecutionTimeout,)
+
+# Errors after which callers should fall back instead of failing.
+DATABASE_UNAVAILABLE_ERRORS = (
+    DATABASE_FAILURE_ERRORS +
+    REQUEST_TIMEOUT_ERRORS +
+    (CircuitOpenError,)
+)
+
+
+class CircuitBreaker:
+    """Circuit breaker with failure and latency thresholds."""
+
+    def __init__(self, failure_threshold, latency_threshold_ms, reset_timeout):
+        """Create a new closed circuit breaker.
+
+        @param failure_threshold: The number of consecutive failed or slow
+            calls after which the breaker opens.
+        @type failure_threshold: int
+        @param latency_threshold_ms: Calls taking longer than this many
+            milliseconds count as failures. None to only count errors.
+        @type latency_threshold_ms: float
+        @param reset_timeout: The number of seconds the breaker stays open
+            before letting a probe call through.
+        @type reset_timeout: float
+        """
+        self.failure_threshold = failure_threshold
+        self.latency_threshold_ms = latency_threshold_ms
+        self.reset_timeout = reset_timeout
+        self.lock = threading.Lock()
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def get_state(self):
+        """Get the state of the breaker, moving from open to half-open if due.
+
+        @return: CLOSED, OPEN or HALF_OPEN.
+        @rtype: str
+        """
+        with self.lock:
+            if (self.state == OPEN and
+                time.time() - self.opened_at >= self.reset_timeout):
+                self.state = HALF_OPEN
+                self.probing = False
+            return self.state
+
+    def before_call(self):
+        """Check that a call may be made.
+
+        @raise CircuitOpenError: Raised if the breaker is open or if it is
+            half-open and another call is already probing.
+        """
+        state = self.get_state()
+        with self.lock:
+            if state == OPEN:
+                raise CircuitOpenError('Database circuit breaker is open.')
+            if state == HALF_OPEN:
+                if self.probing:
+                    raise CircuitOpenError(
+                        'Database circuit breaker is probing.')
+                self.probing = True
+
+    def record_success(self, duration_ms):
+        """Record a call which did not raise.
+
+        @param duration_ms: How long the call took in milliseconds.
+        @type duration_ms: float
+        """
+        if (self.latency_threshold_ms != None and
+            duration_ms > self.latency_threshold_ms):
+            self.record_failure()
+            return
+
+        with self.lock:
+            self.state = CLOSED
+            self.failures = 0
+            self.probing = False
+
+    def record_failure(self):
+        """Record a call which failed or was too slow."""
+        with self.lock:
+            self.failures += 1
+            self.probing = False
+            if self.state == HALF_OPEN or (
+                self.failures >= self.failure_threshold):
+                self.state = OPEN
+                self.opened_at = time.time()
+
+    def call(self, function, *args, **kwargs):
+        """Make a call through the breaker.
+
+        Only DATABASE_FAILURE_ERRORS count as failures. Other errors (like a
+        bad query or REQUEST_TIMEOUT_ERRORS) are raised without affecting the
+        breaker.
+
+        @param function: The function to call.
+        @type function: function
+        @return: The value returned by the function.
+        @rtype: object
+        @raise CircuitOpenError: Raised without calling the function if the
+            breaker is open.
+        """
+        self.before_call()
+        start = time.time()
+        try:
+            result = function(*args, **kwargs)
+        except DATABASE_FAILURE_ERRORS:
+            self.record_failure()
+            raise
+        except:
+            with self.lock:
+                self.probing = False
+            raise
+        self.record_success((time.time() - start) * 1000)
+        return result
+
+
+def get_read_breaker():
+    """Get the process wide circuit breaker for database reads.
+
+    The breaker is created on first use from MONGO_BREAKER_FAILURES,
+    MONGO_BREAKER_LATENCY_MS and MONGO_BREAKER_RESET_SECONDS.
+
+    @return: The read circuit breaker.
+    @rtype: CircuitBreaker
+    """
+    with BREAKERS_LOCK:
+        if BREAKERS['read'] == None:
+            config = tiny_classified.get_config()
+            BREAKERS['read'] = CircuitBreaker(
+                config.get('MONGO_BREAKER_FAILURES', DEFAULT_FAILURE_THRESHOLD),
+                config.get(
+                    'MONGO_BREAKER_LATENCY_MS',
+                    DEFAULT_LATENCY_THRESHOLD_MS
+                ),
+                config.get('MONGO_BREAKER_RESET_SECONDS', DEFAULT_RESET_TIMEOUT)
+            )
+        return BREAKERS['read']
+
+
+def guarded_read(method):
+    """Decorate an adapter read method so that it goes through the breaker.
+
+    @param method: The adapter method to decorate.
+    @type method: function
+    @return: The decorated method.
+    @rtype: function
+    """
+    @functools.wraps(method)
+    def guarded_method(self, *args, **kwargs):
+        return get_read_breaker().call(method, self, *args, **kwargs)
+
+    return guarded_method
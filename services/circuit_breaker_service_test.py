@@ -0,0 +1,118 @@
+"""Tests for circuit_breaker_service.
+
+@license: GNU GPLv3
+"""
+import time
+
+import mox
+from pymongo import errors
+
+import circuit_breaker_service
+
+
+def fail():
+    raise errors.AutoReconnect('test')
+
+
+class CircuitBreakerTests(mox.MoxTestBase):
+
+    def setUp(self):
+        mox.MoxTestBase.setUp(self)
+        self.breaker = circuit_breaker_service.CircuitBreaker(2, 100, 30)
+
+    def open_breaker(self):
+        for i in range(2):
+            with self.assertRaises(errors.AutoReconnect):
+                self.breaker.call(fail)
+
+    def test_call_returns_result(self):
+        result = self.breaker.call(lambda x, y=0: x + y, 1, y=2)
+        self.assertEqual(3, result)
+        self.assertEqual(circuit_breaker_service.CLOSED,
+            self.breaker.get_state())
+
+    def test_opens_after_consecutive_failures(self):
+        with self.assertRaises(errors.AutoReconnect):
+            self.breaker.call(fail)
+        self.assertEqual(circuit_breaker_service.CLOSED,
+            self.breaker.get_state())
+
+        with self.assertRaises(errors.AutoReconnect):
+            self.breaker.call(fail)
+        self.assertEqual(circuit_breaker_service.OPEN,
+            self.breaker.get_state())
+
+        with self.assertRaises(circuit_breaker_service.CircuitOpenError):
+            self.breaker.call(lambda: self.fail('Should not be called.'))
+
+    def test_success_resets_failures(self):
+        with self.assertRaises(errors.AutoReconnect):
+            self.breaker.call(fail)
+        self.breaker.call(lambda: None)
+        with self.assertRaises(errors.AutoReconnect):
+            self.breaker.call(fail)
+        self.assertEqual(circuit_breaker_service.CLOSED,
+            self.breaker.get_state())
+
+    def test_slow_calls_count_as_failures(self):
+        self.mox.StubOutWithMock(time, 'time')
+        for start in [0, 10]:
+            time.time().AndReturn(start)
+            time.time().AndReturn(start + 0.5)
+        time.time().AndReturn(11)
+        self.mox.ReplayAll()
+
+        self.breaker.call(lambda: None)
+        self.breaker.call(lambda: None)
+        self.assertEqual(circuit_breaker_service.OPEN, self.breaker.state)
+
+    def test_other_errors_do_not_count(self):
+        for i in range(3):
+            with self.assertRaises(errors.OperationFailure):
+                self.breaker.call(self.raise_operation_failure)
+        self.assertEqual(circuit_breaker_service.CLOSED,
+            self.breaker.get_state())
+
+    def raise_operation_failure(self):
+        raise errors.OperationFailure('bad query')
+
+    def test_request_timeouts_do_not_count(self):
+        for i in range(3):
+            with self.assertRaises(errors.ExecutionTimeout):
+                self.breaker.call(self.raise_execution_timeout)
+        self.assertEqual(circuit_breaker_service.CLOSED,
+            self.breaker.get_state())
+
+    def raise_execution_timeout(self):
+        raise errors.ExecutionTimeout('operation exceeded time limit')
+
+    def test_half_open_probe_success_closes(self):
+        self.open_breaker()
+        self.breaker.opened_at -= 30
+        self.assertEqual(circuit_breaker_service.HALF_OPEN,
+            self.breaker.get_state())
+
+        self.breaker.call(lambda: None)
+        self.assertEqual(circuit_breaker_service.CLOSED,
+            self.breaker.get_state())
+
+    def test_half_open_probe_failure_reopens(self):
+        self.open_breaker()
+        self.breaker.opened_at -= 30
+
+        with self.assertRaises(errors.AutoReconnect):
+            self.breaker.call(fail)
+        self.assertEqual(circuit_breaker_service.OPEN,
+            self.breaker.get_state())
+
+    def test_half_open_allows_one_probe(self):
+        self.open_breaker()
+        self.breaker.opened_at -= 30
+
+        def probe():
+            with self.assertRaises(circuit_breaker_service.CircuitOpenError):
+                self.breaker.call(lambda: None)
+
+        self.breaker.call(probe)
+        self.assertEqual(circuit_breaker_service.CLOSED,
+            self.breaker.get_state())
@@ -3,16 +3,33 @@
 @author: Rory Olsen (rolsen, Gleap LLC 2014)
 @license: GNU GPLv3
 """
-import pymongo
+import os
 import re
+import threading
+
+import pymongo
+from bson import codec_options
+from bson import raw_bson
+from pymongo import errors
+from pymongo import monitoring
+from pymongo import read_preferences
+from pymongo import write_concern
 
 try:
     from tinyclassified import tiny_classified
 except:
     import tiny_classified
 
+import circuit_breaker_service
+import deadline_service
+import instrumentation_service
+
 LISTINGS_COLLECTION_NAME = 'listing'
+PUBLIC_LISTINGS_COLLECTION_NAME = 'public_listing'
 USERS_COLLECTION_NAME = 'user'
+CATEGORY_SUMMARIES_COLLECTION_NAME = 'category_summary'
+META_COLLECTION_NAME = 'meta'
+LISTING_ARCHIVE_COLLECTION_NAME = 'listing_archive'
 
 MINIMUM_REQUIRED_LISTING_FIELDS = [
     'author_email',
@@ -26,34 +43,397 @@ ALLOWED_LISTING_FIELDS = [
     'author_email',
     'name',
     'slugs',
+    'slugs_normalized',
     'about',
+    'about_html',
+    'about_renderer_version',
     'tags',
+    'categories',
+    'tag_pairs',
     'is_published',
     'contact_id_next',
     'contact_infos',
     'address',
     'latitude',
     'longitude',
+    'location',
     'datecreated',
     'datemodified',
     'listingtype',
     'featured',
+    'thumbnail_url',
+    'expires_on',
+    'unpublished_on',
+    'views'
+]
+
+# Fields of published listings copied to the public read model. Drafts and
+# authoring only fields (is_published, contact_id_next and import metadata)
+# are never seen by public pages.
+PUBLIC_LISTING_FIELDS = [
+    'author_email',
+    'name',
+    'slugs',
+    'slugs_normalized',
+    'about',
+    'about_html',
+    'about_renderer_version',
+    'tags',
+    'categories',
+    'tag_pairs',
+    'contact_infos',
+    'address',
+    'latitude',
+    'longitude',
+    'location',
+    'featured',
+    'thumbnail_url',
+    'views'
+]
+
+# Fields needed to show a listing in a category page's table of listings.
+LISTING_SUMMARY_FIELDS = [
+    'name',
+    'slugs',
+    'tags',
+    'featured',
     'thumbnail_url'
 ]
 
 MINIMUM_REQUIRED_USER_FIELDS = ['email', 'password_hash', 'is_admin']
 
+REGEX_METACHARACTERS = '\\^$.|?*+()[]{}'
+
+DEFAULT_BULK_BATCH_SIZE = 500
+NOT_ATTEMPTED_MESSAGE = 'Not attempted after an earlier error.'
+
+DEFAULT_MAX_POOL_SIZE = 100
+DEFAULT_WAIT_QUEUE_TIMEOUT_MS = 1000
+DEFAULT_CONNECT_TIMEOUT_MS = 5000
+# Upper bound on waiting for any one reply. Queries made with a request
+# deadline are limited further by maxTimeMS (see deadline_service).
+DEFAULT_SOCKET_TIMEOUT_MS = 10000
+
+# Public reads (anonymous browsing) may go to secondaries as long as they are
+# not more than this many seconds behind the primary. Mongodb requires at least
+# 90 seconds. A max staleness of -1 means no maximum.
+DEFAULT_PUBLIC_READ_PREFERENCE = 'secondaryPreferred'
+DEFAULT_PUBLIC_MAX_STALENESS_SECONDS = 90
+
+# Named write concern profiles, each a dict of
+# pymongo.write_concern.WriteConcern options. MONGO_WRITE_CONCERNS in the
+# config may override any of them.
+# - bulk: bulk import writes. Acknowledged by the primary only (not w=0, which
+#   would hide duplicate names and other per-listing errors) and not journaled.
+# - auth: user and password changes. Must survive a primary failover.
+# - delete: admin deletes. Journaled before they are acknowledged.
+WRITE_CONCERN_BULK = 'bulk'
+WRITE_CONCERN_AUTH = 'auth'
+WRITE_CONCERN_DELETE = 'delete'
+DEFAULT_WRITE_CONCERNS = {
+    WRITE_CONCERN_BULK: {'w': 1, 'j': False},
+    WRITE_CONCERN_AUTH: {'w': 'majority', 'j': True, 'wtimeout': 5000},
+    WRITE_CONCERN_DELETE: {'j': True}
+}
+
+# Codec options for reads which are only cached (see listing_model): documents
+# come back as the BSON received from the server instead of being decoded.
+RAW_CODEC_OPTIONS = codec_options.CodecOptions(
+    document_class=raw_bson.RawBSONDocument
+)
+
+READ_PREFERENCE_MODES = {
+    'primary': read_preferences.Primary,
+    'primaryPreferred': read_preferences.PrimaryPreferred,
+    'secondary': read_preferences.Secondary,
+    'secondaryPreferred': read_preferences.SecondaryPreferred,
+    'nearest': read_preferences.Nearest
+}
+
+# Indices to create for each collection as (key, index options) pairs. These
+# are applied once through DBAdapter.ensure_indices (see setup_db.py) rather
+# than on every collection access.
+INDICES = {
+    LISTINGS_COLLECTION_NAME: [
+        ('name', {'unique': True}),
+        ('slugs', {}),
+        ([
+            ('slugs_normalized', pymongo.ASCENDING),
+            ('name', pymongo.ASCENDING)
+        ], {}),
+        ('author_email', {}),
+        ('tags', {}),
+        ('is_published', {}),
+        ('featured', {}),
+        ('expires_on', {'sparse': True}),
+        ('unpublished_on', {'sparse': True})
+    ],
+    # Category and subcategory pages are sorted by name, so their indices end
+    # with the name.
+    PUBLIC_LISTINGS_COLLECTION_NAME: [
+        ('slugs', {}),
+        ([
+            ('slugs_normalized', pymongo.ASCENDING),
+            ('name', pymongo.ASCENDING)
+        ], {}),
+        ([
+            ('categories', pymongo.ASCENDING),
+            ('name', pymongo.ASCENDING)
+        ], {}),
+        ([
+            ('tag_pairs.cat', pymongo.ASCENDING),
+            ('tag_pairs.sub', pymongo.ASCENDING),
+            ('name', pymongo.ASCENDING)
+        ], {}),
+        ('tags', {}),
+        ('featured', {}),
+        ([('views', pymongo.DESCENDING)], {'sparse': True}),
+        # The only geospatial index, used by $geoNear. Listings without a
+        # location are left out of it.
+        ([
+            ('location', pymongo.GEOSPHERE),
+            ('categories', pymongo.ASCENDING)
+        ], {})
+    ],
+    USERS_COLLECTION_NAME: [
+        ('email', {'unique': True})
+    ],
+    META_COLLECTION_NAME: [
+        ('name', {'unique': True})
+    ],
+    LISTING_ARCHIVE_COLLECTION_NAME: [
+        ([
+            ('author_email', pymongo.ASCENDING),
+            ('archived_on', pymongo.DESCENDING)
+        ], {})
+    ]
+}
+
+def normalize_slug(slug):
+    """Normalize a slug for case-insensitive matching.
+
+    @param slug: The slug to normalize.
+    @type slug: str
+    @return: The casefolded slug.
+    @rtype: str
+    """
+    return slug.lower()
+
+
+def get_replacement_update(document, fields):
+    """Build an update which replaces a document but keeps its view count.
+
+    Views are only ever added to by increment_listing_views, so a listing
+    written by an edit keeps the saved count instead of the one it was read
+    with. The document's count is only used when the update inserts.
+
+    @param document: The new document, with its "_id".
+    @type document: dict
+    @param fields: All the fields which the document may have.
+    @type fields: list of str
+    @return: The update to pass to update_one with upsert=True.
+    @rtype: dict
+    """
+    update = {
+        '$set': dict(
+            (k, v) for (k, v) in document.iteritems()
+            if k != '_id' and k != 'views'
+        )
+    }
+    unset = dict(
+        (k, '') for k in fields
+        if k != '_id' and k != 'views' and not k in document
+    )
+    if unset:
+        update['$unset'] = unset
+    if 'views' in document:
+        update['$setOnInsert'] = {'views': document['views']}
+    return update
+
+
+def get_public_listing_update(listing):
+    """Get the update which writes the public copy of a listing.
+
+    @param listing: The saved listing. Only its PUBLIC_LISTING_FIELDS are
+        copied.
+    @type listing: dict
+    @return: The update (see get_replacement_update), which keeps the views
+        of an existing copy.
+    @rtype: dict
+    """
+    public_listing = {'_id': listing['_id']}
+    for field in PUBLIC_LISTING_FIELDS:
+        if field in listing:
+            public_listing[field] = listing[field]
+    return get_replacement_update(public_listing, PUBLIC_LISTING_FIELDS)
+
+
+def escape_regex(value):
+    """Escape all regular expression metacharacters in a string.
+
+    @param value: The string to match literally.
+    @type value: str
+    @return: The string with every metacharacter backslash escaped.
+    @rtype: str
+    """
+    return ''.join(
+        '\\' + char if char in REGEX_METACHARACTERS else char
+        for char in value
+    )
+
+
+class PoolUsageListener(monitoring.ConnectionPoolListener):
+    """Connection pool event listener which keeps running usage counts."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = {
+            'open': 0,
+            'checked_out': 0,
+            'checkouts': 0,
+            'checkout_failures': 0,
+            'wait_queue_timeouts': 0
+        }
+
+    def increment(self, name, amount=1):
+        with self.lock:
+            self.counts[name] += amount
+
+    def get_counts(self):
+        """Get a snapshot of the pool usage counts.
+
+        @return: Currently open and checked out connections along with the
+            number of checkouts, failed checkouts and wait queue timeouts
+            since the client was created.
+        @rtype: dict
+        """
+        with self.lock:
+            return dict(self.counts)
+
+    def pool_created(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        self.increment('open')
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        self.increment('open', -1)
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_check_out_failed(self, event):
+        self.increment('checkout_failures')
+        if event.reason == monitoring.ConnectionCheckOutFailedReason.TIMEOUT:
+            self.increment('wait_queue_timeouts')
+
+    def connection_checked_out(self, event):
+        self.increment('checked_out')
+        self.increment('checkouts')
+
+    def connection_checked_in(self, event):
+        self.increment('checked_out', -1)
+
+
 class DBAdapter:
     """Dependency inversion adapter to make db access suck less."""
 
     def __init__(self):
         """Create a new database adapater around the database engine.
 
-        @param client: The native database wrapper to adapt.
-        @type client: flask.ext.pymongo.PyMongo
+        The underlying pymongo.MongoClient is created lazily and once per
+        process so that an adapter built before a pre-fork WSGI server (like
+        gunicorn or uwsgi) forks never shares its sockets between workers.
+        """
+        self.client_lock = threading.Lock()
+        self.client = None
+        self.client_pid = None
+        self.pool_listener = None
+        self.collections = {}
+
+
+    def create_client(self, pool_listener):
+        """Create a new client configured with the pool settings in the config.
+
+        @param pool_listener: The listener to report the new client's
+            connection pool events to.
+        @type pool_listener: PoolUsageListener
+        @return: New client which does not connect until its first operation.
+        @rtype: pymongo.MongoClient
         """
         app_config = tiny_classified.get_config()
-        self.client = pymongo.mongo_client.MongoClient(app_config['MONGO_URI'])
+        return pymongo.mongo_client.MongoClient(
+            app_config['MONGO_URI'],
+            maxPoolSize=app_config.get(
+                'MONGO_MAX_POOL_SIZE',
+                DEFAULT_MAX_POOL_SIZE
+            ),
+            waitQueueTimeoutMS=app_config.get(
+                'MONGO_WAIT_QUEUE_TIMEOUT_MS',
+                DEFAULT_WAIT_QUEUE_TIMEOUT_MS
+            ),
+            connectTimeoutMS=app_config.get(
+                'MONGO_CONNECT_TIMEOUT_MS',
+                DEFAULT_CONNECT_TIMEOUT_MS
+            ),
+            socketTimeoutMS=app_config.get(
+                'MONGO_SOCKET_TIMEOUT_MS',
+                DEFAULT_SOCKET_TIMEOUT_MS
+            ),
+            event_listeners=[
+                pool_listener,
+                instrumentation_service.CommandCaptureListener()
+            ],
+            connect=False
+        )
+
+
+    def get_client(self):
+        """Get the client for the current process, creating it if needed.
+
+        A client inherited from a parent process is abandoned (not closed, as
+        its sockets still belong to the parent) and replaced by a new one.
+        Threads racing to create the client create it once, under client_lock.
+        The pid is set last so that a thread which sees the current pid without
+        the lock also sees the new client, listener and collections.
+
+        @return: The client owned by the current process.
+        @rtype: pymongo.MongoClient
+        """
+        pid = os.getpid()
+        if self.client is None or self.client_pid != pid:
+            with self.client_lock:
+                if self.client is None or self.client_pid != pid:
+                    pool_listener = PoolUsageListener()
+                    client = self.create_client(pool_listener)
+                    self.collections = {}
+                    self.pool_listener = pool_listener
+                    self.client = client
+                    self.client_pid = pid
+        return self.client
+
+
+    def get_pool_usage(self):
+        """Report connection pool usage for the current process.
+
+        @return: The process id, configured maximum pool size and the usage
+            counts collected by PoolUsageListener.
+        @rtype: dict
+        """
+        client = self.get_client()
+        usage = self.pool_listener.get_counts()
+        usage['pid'] = self.client_pid
+        usage['max_pool_size'] = client.max_pool_size
+        return usage
 
 
     def get_database(self):
@@ -63,31 +443,243 @@ class DBAdapter:
         @rtype: pymongo.database
         """
         app_config = tiny_classified.get_config()
-        return self.client[app_config['MONGO_DATABASE_NAME']]
+        return self.get_client()[app_config['MONGO_DATABASE_NAME']]
+
+
+    def get_public_read_preference(self):
+        """Get the read preference for public (anonymous browsing) reads.
+
+        The mode is read from MONGO_PUBLIC_READ_PREFERENCE and the maximum
+        staleness from MONGO_PUBLIC_MAX_STALENESS_SECONDS.
+
+        @return: The read preference to use for public reads.
+        @rtype: pymongo.read_preferences.ServerMode
+        """
+        app_config = tiny_classified.get_config()
+        mode = app_config.get(
+            'MONGO_PUBLIC_READ_PREFERENCE',
+            DEFAULT_PUBLIC_READ_PREFERENCE
+        )
+        if mode == 'primary':
+            return read_preferences.Primary()
 
+        max_staleness = app_config.get(
+            'MONGO_PUBLIC_MAX_STALENESS_SECONDS',
+            DEFAULT_PUBLIC_MAX_STALENESS_SECONDS
+        )
+        return READ_PREFERENCE_MODES[mode](max_staleness=max_staleness)
 
-    def get_listings_collection(self):
+
+    def get_write_concern(self, profile):
+        """Get the write concern for a named profile.
+
+        @param profile: The name of the profile like WRITE_CONCERN_BULK.
+        @type profile: str
+        @return: The write concern described by MONGO_WRITE_CONCERNS or, if
+            the profile is not configured there, DEFAULT_WRITE_CONCERNS.
+        @rtype: pymongo.write_concern.WriteConcern
+        """
+        profiles = tiny_classified.get_config().get('MONGO_WRITE_CONCERNS', {})
+        options = profiles.get(profile, DEFAULT_WRITE_CONCERNS[profile])
+        return write_concern.WriteConcern(**options)
+
+
+    def get_collection(self, collection_name, public=False,
+        write_concern_profile=None, raw=False):
+        """Get a database collection, reusing the handle after the first call.
+
+        @param collection_name: The name of the collection to get.
+        @type collection_name: str
+        @keyword public: If True, get a handle for public reads which may be
+            served by secondaries (see get_public_read_preference). Otherwise
+            reads go to the primary so that they see all earlier writes.
+        @type public: bool
+        @keyword write_concern_profile: The name of the write concern profile
+            for writes through the handle (see get_write_concern) or None to
+            use the client's default write concern.
+        @type write_concern_profile: str
+        @keyword raw: If True, get a handle which returns documents as
+            bson.raw_bson.RawBSONDocument (see RAW_CODEC_OPTIONS).
+        @type raw: bool
+        @return: The mongodb database collection with the given name.
+        @rtype: pymongo.collection
+        """
+        self.get_client()
+        key = (collection_name, public, write_concern_profile, raw)
+        collection = self.collections.get(key, None)
+        if collection is None:
+            collection = self.get_database()[collection_name]
+            if public:
+                collection = collection.with_options(
+                    read_preference=self.get_public_read_preference()
+                )
+            if write_concern_profile != None:
+                collection = collection.with_options(
+                    write_concern=self.get_write_concern(write_concern_profile)
+                )
+            if raw:
+                collection = collection.with_options(
+                    codec_options=RAW_CODEC_OPTIONS
+                )
+            self.collections[key] = collection
+        return collection
+
+
+    def get_listings_collection(self, public=False,
+        write_concern_profile=None):
         """Get the database collection for listing information.
 
+        @keyword public: If True, get a handle for public reads which may be
+            served by secondaries with bounded staleness.
+        @type public: bool
+        @keyword write_concern_profile: The name of the write concern profile
+            to use for writes or None for the default.
+        @type write_concern_profile: str
         @return: The mongodb database collection used to store listing
             information.
         @rtype: pymongo.collection
         """
-        listing_collection = self.get_database()[LISTINGS_COLLECTION_NAME]
-        listing_collection.ensure_index('name', unique=True)
-        return listing_collection
+        return self.get_collection(
+            LISTINGS_COLLECTION_NAME,
+            public=public,
+            write_concern_profile=write_concern_profile
+        )
+
+
+    def get_public_listings_collection(self, public=False, raw=False,
+        write_concern_profile=None):
+        """Get the database collection of published listings.
+
+        This is the public read model: a copy of each published listing limited
+        to PUBLIC_LISTING_FIELDS, kept up to date by listing_service.
+
+        @keyword public: If True, get a handle for public reads which may be
+            served by secondaries with bounded staleness.
+        @type public: bool
+        @keyword raw: If True, read documents as RawBSONDocument.
+        @type raw: bool
+        @keyword write_concern_profile: The name of the write concern profile
+            to use for writes or None for the default.
+        @type write_concern_profile: str
+        @return: The mongodb database collection of published listings.
+        @rtype: pymongo.collection
+        """
+        return self.get_collection(
+            PUBLIC_LISTINGS_COLLECTION_NAME,
+            public=public,
+            write_concern_profile=write_concern_profile,
+            raw=raw
+        )
+
+
+    def get_category_summaries_collection(self, public=False, raw=False):
+        """Get the database collection of category summaries.
+
+        @keyword public: If True, get a handle for public reads which may be
+            served by secondaries with bounded staleness.
+        @type public: bool
+        @keyword raw: If True, read documents as RawBSONDocument.
+        @type raw: bool
+        @return: The mongodb database collection used to store one summary
+            document per category and subcategory.
+        @rtype: pymongo.collection
+        """
+        return self.get_collection(
+            CATEGORY_SUMMARIES_COLLECTION_NAME,
+            public=public,
+            raw=raw
+        )
 
 
-    def get_users_collection(self):
+    def get_meta_collection(self):
+        """Get the database collection of named bookkeeping documents.
+
+        @return: The mongodb database collection of documents like migration
+            progress, each with a unique "name".
+        @rtype: pymongo.collection
+        """
+        return self.get_collection(META_COLLECTION_NAME)
+
+
+    def get_listing_archive_collection(self, write_concern_profile=None):
+        """Get the database collection of archived listings.
+
+        @keyword write_concern_profile: The name of the write concern profile
+            to use (see DEFAULT_WRITE_CONCERNS) or None for the default write
+            concern.
+        @type write_concern_profile: str
+        @return: The mongodb database collection of expired and long
+            unpublished listings moved out of the listing collection.
+        @rtype: pymongo.collection
+        """
+        return self.get_collection(
+            LISTING_ARCHIVE_COLLECTION_NAME,
+            write_concern_profile=write_concern_profile
+        )
+
+
+    def get_users_collection(self, write_concern_profile=None):
         """Get the database collection for user information.
 
+        @keyword write_concern_profile: The name of the write concern profile
+            to use for writes or None for the default.
+        @type write_concern_profile: str
         @return: The mongodb database collection used to store user information.
         @rtype: pymongo.collection
         """
+        return self.get_collection(
+            USERS_COLLECTION_NAME,
+            write_concern_profile=write_concern_profile
+        )
+
+
+    @instrumentation_service.instrumented
+    def ensure_indices(self):
+        """Create the indices described in INDICES for every collection.
+
+        Index creation is idempotent but costs a round trip per index so this
+        should be run once at startup or from setup_db.py, not per request.
+        """
+        for collection_name, indices in INDICES.iteritems():
+            collection = self.get_collection(collection_name)
+            for key, options in indices:
+                collection.create_index(key, **options)
+
+
+    def get_time_limit(self, option_name='max_time_ms'):
+        """Get the query options limiting a query to the request deadline.
+
+        @keyword option_name: The name of the option as taken by the pymongo
+            method to be called: max_time_ms for find and find_one or
+            maxTimeMS for commands like distinct.
+        @type option_name: str
+        @return: Keyword arguments for the pymongo method. Empty if there is no
+            deadline for the current thread.
+        @rtype: dict
+        @raise deadline_service.DeadlineExceeded: Raised if the deadline has
+            already passed.
+        """
+        max_time_ms = deadline_service.get_remaining_ms()
+        if max_time_ms == None:
+            return {}
+        return {option_name: max_time_ms}
+
 
-        users_collection = self.get_database()[USERS_COLLECTION_NAME]
-        users_collection.ensure_index('email', unique=True)
-        return users_collection
+    def limit_time(self, cursor):
+        """Limit a cursor to the request deadline.
+
+        @param cursor: The cursor to limit.
+        @type cursor: pymongo.cursor.Cursor
+        @return: The cursor, limited with max_time_ms if there is a deadline
+            for the current thread.
+        @rtype: pymongo.cursor.Cursor
+        @raise deadline_service.DeadlineExceeded: Raised if the deadline has
+            already passed.
+        """
+        max_time_ms = deadline_service.get_remaining_ms()
+        if max_time_ms == None:
+            return cursor
+        return cursor.max_time_ms(max_time_ms)
 
 
     def ensure_required_fields(self, record, fields):
@@ -120,27 +712,97 @@ class DBAdapter:
                 raise ValueError('%s not allowed in this record.' % field)
 
 
-    def index_listings(self):
+    @instrumentation_service.instrumented
+    @circuit_breaker_service.guarded_read
+    def index_listings(self, fields=None, public=False):
         """List / index all listings.
 
+        @keyword fields: The only fields to return for each listing or None to
+            return entire listings.
+        @type fields: list of str
+        @keyword public: If True, list the published listings from the public
+            read model. The read may be served by a secondary.
+        @type public: bool
         @return: all listings
-        @rtype: iterable over dicts
+        @rtype: list of dict
         """
-        return self.get_listings_collection().find()
+        if public:
+            collection = self.get_public_listings_collection(public=True)
+        else:
+            collection = self.get_listings_collection()
+        return list(self.limit_time(collection.find({}, fields)))
 
 
-    def get_listing_by_slug(self, listing_slug):
+    @instrumentation_service.instrumented
+    @circuit_breaker_service.guarded_read
+    def get_listing_by_id(self, listing_id, public=False, raw=False,
+        primary=False):
+        """Gets a listing by its _id.
+
+        @param listing_id: The _id of the listing.
+        @type listing_id: bson.objectid.ObjectId
+        @keyword public: If True, only find published listings, in their
+            public shape, and allow the read to be served by a secondary and
+            miss recent writes. Use for anonymous browsing only.
+        @type public: bool
+        @keyword raw: If True and public, return the listing as a
+            RawBSONDocument without decoding it.
+        @type raw: bool
+        @keyword primary: If True and public, read from the primary so that
+            the read sees all earlier writes.
+        @type primary: bool
+        @return: The matching listing or None
+        @rtype: dict or None
+        """
+        if public:
+            collection = self.get_public_listings_collection(
+                public=not primary,
+                raw=raw
+            )
+        else:
+            collection = self.get_listings_collection()
+        return collection.find_one(
+            {'_id': listing_id},
+            **self.get_time_limit()
+        )
+
+
+    @instrumentation_service.instrumented
+    @circuit_breaker_service.guarded_read
+    def get_listing_by_slug(self, listing_slug, public=False, raw=False,
+        primary=False):
         """Gets a listing which matches the given slug.
 
         @param listing_slug: The slug to match to a listing.
         @type listing_slug: str
+        @keyword public: If True, only find published listings, in their
+            public shape, and allow the read to be served by a secondary and
+            miss recent writes. Use for anonymous browsing only.
+        @type public: bool
+        @keyword raw: If True and public, return the listing as a
+            RawBSONDocument without decoding it.
+        @type raw: bool
+        @keyword primary: If True and public, read from the primary so that
+            the read sees all earlier writes.
+        @type primary: bool
         @return: The matching listing or None
         @rtype: dict or None
         """
-        collection = self.get_listings_collection()
-        return collection.find_one({'slugs': listing_slug})
+        if public:
+            collection = self.get_public_listings_collection(
+                public=not primary,
+                raw=raw
+            )
+        else:
+            collection = self.get_listings_collection()
+        return collection.find_one(
+            {'slugs': listing_slug},
+            **self.get_time_limit()
+        )
 
 
+    @instrumentation_service.instrumented
+    @circuit_breaker_service.guarded_read
     def get_listing_by_name(self, listing_name):
         """Gets a listing which matches the given name.
 
@@ -150,32 +812,139 @@ class DBAdapter:
         @rtype: dict or None
         """
         collection = self.get_listings_collection()
-        return collection.find_one({'name': listing_name})
+        return collection.find_one(
+            {'name': listing_name},
+            **self.get_time_limit()
+        )
+
 
+    @instrumentation_service.instrumented
+    @circuit_breaker_service.guarded_read
+    def get_listing_by_email(self, author_email):
+        """Gets a listing written by the given author.
 
-    def list_listings_by_slug(self, listing_slug):
+        @param author_email: The email address of the listing's author.
+        @type author_email: str
+        @return: The matching listing or None
+        @rtype: dict or None
+        """
+        collection = self.get_listings_collection()
+        return collection.find_one(
+            {'author_email': author_email},
+            **self.get_time_limit()
+        )
+
+
+    def get_slug_query(self, listing_slug):
+        """Build the query for listings with slugs beginning with a slug.
+
+        Matching is case-insensitive. Category and category / subcategory slugs
+        match the normalized categories and tag_pairs fields exactly. Other
+        slugs are matched with an anchored, case-sensitive prefix over
+        slugs_normalized. Either way the query is an index scan.
+
+        @param listing_slug: The slug to match
+        @type listing_slug: str
+        @return: The query to pass to find / distinct / aggregate.
+        @rtype: dict
+        """
+        slug = normalize_slug(listing_slug)
+        parts = slug.split('/', 2)
+        if len(parts) == 3 and parts[2]:
+            return {'slugs_normalized': re.compile('^' + escape_regex(slug))}
+
+        if not parts[0]:
+            return {}
+        if len(parts) == 1 or not parts[1]:
+            return {'categories': parts[0]}
+        return {'tag_pairs': {'$elemMatch': {'cat': parts[0], 'sub': parts[1]}}}
+
+
+    @instrumentation_service.instrumented
+    @circuit_breaker_service.guarded_read
+    def list_listings_by_slug(self, listing_slug, fields=None, after_name=None,
+        limit=None, public=True, raw=False):
         """List the listings that have slugs that begin with the specified slug.
 
+        Listings are ordered by name so that pages can be requested by the last
+        name seen (keyset pagination) instead of skipping over earlier pages.
+        Only published listings are listed, from the public read model.
+
         @param listing_slug: The slug to match
         @type listing_slug: str
+        @keyword fields: The only fields to return for each listing (like
+            LISTING_SUMMARY_FIELDS) or None to return entire listings.
+        @type fields: list of str
+        @keyword after_name: Only return listings with names after this one.
+        @type after_name: str
+        @keyword limit: The maximum number of listings to return or None for
+            no limit.
+        @type limit: int
+        @keyword public: If True (the default), the read may be served by a
+            secondary and miss recent writes.
+        @type public: bool
+        @keyword raw: If True, return the listings as RawBSONDocument without
+            decoding them.
+        @type raw: bool
         @return: The matching listings.
-        @rtype: iterable over dicts
+        @rtype: list of dict
         """
-        collection = self.get_listings_collection()
-        listing_slug = listing_slug.replace('(', '\(')
-        listing_slug = listing_slug.replace(')', '\)')
-        regex = re.compile('^' + listing_slug, re.IGNORECASE)
-        return collection.find({'slugs': regex})
+        collection = self.get_public_listings_collection(
+            public=public,
+            raw=raw
+        )
+        query = self.get_slug_query(listing_slug)
+        if after_name != None:
+            query['name'] = {'$gt': after_name}
+
+        listings = self.limit_time(collection.find(query, fields))
+        listings = listings.sort('name', pymongo.ASCENDING)
+        if limit:
+            listings = listings.limit(limit)
+        return list(listings)
+
 
+    @instrumentation_service.instrumented
+    @circuit_breaker_service.guarded_read
+    def list_featured_listings_by_slug(self, listing_slug, fields=None,
+        limit=None, public=True):
+        """List featured listings that have slugs beginning with a slug.
 
+        Only published listings are listed, from the public read model.
+
+        @param listing_slug: The slug to match
+        @type listing_slug: str
+        @keyword fields: The only fields to return for each listing or None to
+            return entire listings.
+        @type fields: list of str
+        @keyword limit: The maximum number of listings to return or None for
+            no limit.
+        @type limit: int
+        @keyword public: If True (the default), the read may be served by a
+            secondary and miss recent writes.
+        @type public: bool
+        @return: The matching featured listings ordered by name.
+        @rtype: list of dict
+        """
+        collection = self.get_public_listings_collection(public=public)
+        query = self.get_slug_query(listing_slug)
+        query['featured'] = True
+        listings = self.limit_time(collection.find(query, fields))
+        listings = listings.sort('name', pymongo.ASCENDING)
+        if limit:
+            listings = listings.limit(limit)
+        return list(listings)
+
+
+    @instrumentation_service.instrumented
     def upsert_listing(self, listing):
         """Updates or inserts a listing.
 
         Updates or inserts a listing, with checks for listing validity.
 
         @param listing: The listing to insert or update. If listing has an "_id"
-            then the existing listing with that "_id" is updated, otherwise a
-            new listing is inserted.
+            then the existing listing with that "_id" is replaced, except for
+            its views, otherwise a new listing is inserted.
         @type listing: dict
         """
         # This is something that we don't care about for now, but may want to
@@ -184,9 +953,368 @@ class DBAdapter:
 
         self.ensure_limited_fields(listing, ALLOWED_LISTING_FIELDS)
         collection = self.get_listings_collection()
-        collection.save(listing)
+        if listing.get('_id', None) == None:
+            collection.insert_one(listing)
+        else:
+            collection.update_one(
+                {'_id': listing['_id']},
+                get_replacement_update(listing, ALLOWED_LISTING_FIELDS),
+                upsert=True
+            )
+
 
+    @instrumentation_service.instrumented
+    def bulk_upsert_listings(self, listings,
+        batch_size=DEFAULT_BULK_BATCH_SIZE, ordered=False,
+        write_concern_profile=WRITE_CONCERN_BULK):
+        """Updates or inserts many listings using batched bulk writes.
 
+        Listings are checked like in upsert_listing but an invalid listing or
+        a failed write (like a duplicate name) is reported in the results
+        instead of raising, so one bad listing does not stop the rest.
+
+        @param listings: The listings to insert or update. Listings with an
+            "_id" replace the existing listing with that "_id" (except for its
+            views), others are inserted.
+        @type listings: iterable over dict
+        @keyword batch_size: The maximum number of listings per bulk write.
+        @type batch_size: int
+        @keyword ordered: If True, stop at the first error like an ordered
+            bulk write. If False, the server may apply writes in any order and
+            continues past errors.
+        @type ordered: bool
+        @keyword write_concern_profile: The name of the write concern profile
+            for the bulk writes. Defaults to the fast WRITE_CONCERN_BULK.
+        @type write_concern_profile: str
+        @return: One entry per listing, in the order given: None if the listing
+            was written or a message describing why it was not.
+        @rtype: list
+        """
+        collection = self.get_listings_collection(
+            write_concern_profile=write_concern_profile
+        )
+        results = []
+        batch = []
+        failed = False
+
+        for listing in listings:
+            index = len(results)
+            results.append(None)
+
+            if failed:
+                results[index] = NOT_ATTEMPTED_MESSAGE
+                continue
+
+            try:
+                self.ensure_limited_fields(listing, ALLOWED_LISTING_FIELDS)
+            except ValueError as e:
+                results[index] = str(e)
+                failed = ordered
+                continue
+
+            if '_id' in listing:
+                request = pymongo.UpdateOne(
+                    {'_id': listing['_id']},
+                    get_replacement_update(listing, ALLOWED_LISTING_FIELDS),
+                    upsert=True
+                )
+            else:
+                request = pymongo.InsertOne(listing)
+            batch.append((index, request))
+
+            if len(batch) >= batch_size:
+                success = self.write_listings_batch(
+                    collection,
+                    batch,
+                    results,
+                    ordered
+                )
+                failed = ordered and not success
+                batch = []
+
+        if failed:
+            for index, request in batch:
+                results[index] = NOT_ATTEMPTED_MESSAGE
+        elif batch:
+            self.write_listings_batch(collection, batch, results, ordered)
+
+        return results
+
+
+    def write_listings_batch(self, collection, batch, results, ordered):
+        """Send one batch of bulk_upsert_listings writes.
+
+        @param collection: The listings collection.
+        @type collection: pymongo.collection
+        @param batch: Pairs of result index and write request.
+        @type batch: list of tuple
+        @param results: The bulk_upsert_listings results to record errors in.
+        @type results: list
+        @param ordered: Flag indicating if the batch is an ordered bulk write.
+        @type ordered: bool
+        @return: True if every write in the batch succeeded, False otherwise.
+        @rtype: bool
+        """
+        try:
+            collection.bulk_write(
+                [request for (index, request) in batch],
+                ordered=ordered
+            )
+            return True
+        except errors.BulkWriteError as e:
+            write_errors = e.details.get('writeErrors', [])
+            for error in write_errors:
+                results[batch[error['index']][0]] = error.get('errmsg')
+
+            if ordered and write_errors:
+                last_attempted = write_errors[0]['index']
+                for index, request in batch[last_attempted + 1:]:
+                    results[index] = NOT_ATTEMPTED_MESSAGE
+
+            return False
+
+
+    @instrumentation_service.instrumented
+    @circuit_breaker_service.guarded_read
+    def list_stale_about_listings(self, renderer_version, after_id=None,
+        limit=None):
+        """List listings whose about_html was rendered by another renderer.
+
+        @param renderer_version: The current about renderer version.
+        @type renderer_version: int
+        @keyword after_id: Only return listings with ids after this one.
+        @type after_id: bson.objectid.ObjectId
+        @keyword limit: The maximum number of listings to return or None for
+            no limit.
+        @type limit: int
+        @return: The "_id" and "about" of the matching listings ordered by id.
+        @rtype: list of dict
+        """
+        collection = self.get_listings_collection()
+        query = {'about_renderer_version': {'$ne': renderer_version}}
+        if after_id != None:
+            query['_id'] = {'$gt': after_id}
+
+        listings = self.limit_time(collection.find(query, ['about']))
+        listings = listings.sort('_id', pymongo.ASCENDING)
+        if limit:
+            listings = listings.limit(limit)
+        return list(listings)
+
+
+    @instrumentation_service.instrumented
+    def set_about_html(self, listing_id, about, about_html, renderer_version):
+        """Store the rendered about section of a listing.
+
+        The listing (and its copy in the public read model, if published) is
+        only updated if its about section is still the one that was rendered
+        so that a concurrent edit is not overwritten.
+
+        @param listing_id: The "_id" of the listing to update.
+        @type listing_id: bson.objectid.ObjectId
+        @param about: The about section which was rendered.
+        @type about: str
+        @param about_html: The rendered about section.
+        @type about_html: str
+        @param renderer_version: The version of the renderer used.
+        @type renderer_version: int
+        @return: True if the listing was updated.
+        @rtype: bool
+        """
+        query = {'_id': listing_id, 'about': about}
+        update = {'$set': {
+            'about_html': about_html,
+            'about_renderer_version': renderer_version
+        }}
+        result = self.get_listings_collection().update_one(query, update)
+        if result.matched_count > 0:
+            self.get_public_listings_collection().update_one(query, update)
+        return result.matched_count > 0
+
+
+    @instrumentation_service.instrumented
+    @circuit_breaker_service.guarded_read
+    def list_listing_batch(self, fields=None, after_id=None, upper_id=None,
+        limit=None):
+        """List a batch of listings in id order.
+
+        @keyword fields: The only fields to return for each listing or None to
+            return entire listings.
+        @type fields: list of str
+        @keyword after_id: Only return listings with ids after this one.
+        @type after_id: bson.objectid.ObjectId
+        @keyword upper_id: Only return listings with ids up to and including
+            this one.
+        @type upper_id: bson.objectid.ObjectId
+        @keyword limit: The maximum number of listings to return or None for
+            no limit.
+        @type limit: int
+        @return: The listings ordered by id.
+        @rtype: list of dict
+        """
+        collection = self.get_listings_collection()
+        id_range = {}
+        if after_id != None:
+            id_range['$gt'] = after_id
+        if upper_id != None:
+            id_range['$lte'] = upper_id
+        query = {'_id': id_range} if id_range else {}
+
+        listings = self.limit_time(collection.find(query, fields))
+        listings = listings.sort('_id', pymongo.ASCENDING)
+        if limit:
+            listings = listings.limit(limit)
+        return list(listings)
+
+
+    @instrumentation_service.instrumented
+    @circuit_breaker_service.guarded_read
+    def get_listing_id_split_points(self, count):
+        """Get the ids which split the listings into ranges of equal size.
+
+        @param count: The number of ranges.
+        @type count: int
+        @return: Up to count - 1 ids in ascending order. Range i holds the
+            listings with ids after split point i - 1 (if any) up to and
+            including split point i (if any).
+        @rtype: list of bson.objectid.ObjectId
+        """
+        collection = self.get_listings_collection()
+        total = collection.count()
+        split_points = []
+        for i in range(1, count):
+            position = total * i // count
+            if position == 0:
+                continue
+            cursor = collection.find({}, ['_id']).sort('_id', pymongo.ASCENDING)
+            listings = list(cursor.skip(position - 1).limit(1))
+            if listings and not listings[0]['_id'] in split_points:
+                split_points.append(listings[0]['_id'])
+        return split_points
+
+
+    @instrumentation_service.instrumented
+    def update_listing_fields(self, updates):
+        """Set fields of many listings if they have not changed since read.
+
+        Updates are sent in one unordered bulk write with the bulk write
+        concern. The public copies of published listings get the changes to
+        PUBLIC_LISTING_FIELDS under the same condition, so a copy is only
+        changed if its listing could be.
+
+        @param updates: (listing id, expected fields, changed fields) triples.
+            A listing is only updated if its expected fields still have the
+            given values (None for missing fields). Only public fields should
+            be expected of listings with public changes, as public copies do
+            not have the other fields.
+        @type updates: list of tuple
+        @return: The number of listings updated.
+        @rtype: int
+        """
+        if not updates:
+            return 0
+
+        requests = []
+        public_requests = []
+        for (listing_id, expected, changes) in updates:
+            query = dict(expected)
+            query['_id'] = listing_id
+            requests.append(pymongo.UpdateOne(query, {'$set': changes}))
+
+            public_changes = dict(
+                (k, v) for (k, v) in changes.iteritems()
+                if k in PUBLIC_LISTING_FIELDS
+            )
+            if public_changes:
+                public_requests.append(pymongo.UpdateOne(
+                    query,
+                    {'$set': public_changes}
+                ))
+
+        collection = self.get_listings_collection(
+            write_concern_profile=WRITE_CONCERN_BULK
+        )
+        result = collection.bulk_write(requests, ordered=False)
+        if public_requests:
+            self.get_public_listings_collection().bulk_write(
+                public_requests,
+                ordered=False
+            )
+        return result.matched_count
+
+
+    @instrumentation_service.instrumented
+    def upsert_public_listing(self, listing):
+        """Insert or replace the public copy of a published listing.
+
+        An existing copy keeps its views.
+
+        @param listing: The saved listing, with an "_id". Only its
+            PUBLIC_LISTING_FIELDS are copied.
+        @type listing: dict
+        """
+        collection = self.get_public_listings_collection()
+        collection.update_one(
+            {'_id': listing['_id']},
+            get_public_listing_update(listing),
+            upsert=True
+        )
+
+
+    @instrumentation_service.instrumented
+    def delete_public_listing(self, listing_id):
+        """Remove a listing from the public read model if it is there.
+
+        @param listing_id: The "_id" of the listing to remove.
+        @type listing_id: bson.objectid.ObjectId
+        """
+        collection = self.get_public_listings_collection()
+        collection.delete_one({'_id': listing_id})
+
+
+    @instrumentation_service.instrumented
+    def bulk_publish_listings(self, listings,
+        batch_size=DEFAULT_BULK_BATCH_SIZE,
+        write_concern_profile=WRITE_CONCERN_BULK):
+        """Bring the public copies of many listings up to date in bulk.
+
+        Like upsert_public_listing for the published listings and
+        delete_public_listing for the others, but with one unordered bulk
+        write per batch.
+
+        @param listings: The saved listings, each with an "_id" and at least
+            its PUBLIC_LISTING_FIELDS and is_published. Listings which are not
+            published (like those with only an "_id") are removed.
+        @type listings: iterable over dict
+        @keyword batch_size: The maximum number of writes per bulk write.
+        @type batch_size: int
+        @keyword write_concern_profile: The name of the write concern profile
+            for the bulk writes. Defaults to the fast WRITE_CONCERN_BULK.
+        @type write_concern_profile: str
+        """
+        collection = self.get_public_listings_collection(
+            write_concern_profile=write_concern_profile
+        )
+        batch = []
+        for listing in listings:
+            if listing.get('is_published', False):
+                batch.append(pymongo.UpdateOne(
+                    {'_id': listing['_id']},
+                    get_public_listing_update(listing),
+                    upsert=True
+                ))
+            else:
+                batch.append(pymongo.DeleteOne({'_id': listing['_id']}))
+
+            if len(batch) >= batch_size:
+                collection.bulk_write(batch, ordered=False)
+                batch = []
+
+        if batch:
+            collection.bulk_write(batch, ordered=False)
+
+
+    @instrumentation_service.instrumented
     def delete_listing_by_slug(self, listing_slug):
         """Deletes a listing by one of its fully qualified slugs.
 
@@ -195,7 +1323,9 @@ class DBAdapter:
         @raises: ValueError if multiple listings are matched by the given slug
             ValueError if no listings are matched by the given slug
         """
-        collection = self.get_listings_collection()
+        collection = self.get_listings_collection(
+            write_concern_profile=WRITE_CONCERN_DELETE
+        )
         listing_result = collection.find({'slugs': listing_slug})
 
         count = listing_result.count()
@@ -208,16 +1338,355 @@ class DBAdapter:
         collection.remove(listing_result.next())
 
 
+    @instrumentation_service.instrumented
+    def delete_listing(self, listing_id):
+        """Deletes a listing by its id.
+
+        @param listing_id: The "_id" of the listing to delete.
+        @type listing_id: bson.objectid.ObjectId
+        """
+        collection = self.get_listings_collection(
+            write_concern_profile=WRITE_CONCERN_DELETE
+        )
+        collection.remove(listing_id)
+
+
+    @instrumentation_service.instrumented
     def delete_listing_by_name(self, listing_name):
         """Deletes a listing.
 
         @param listing_name: The name of the listing to delete.
         @type listing: str
         """
-        collection = self.get_listings_collection()
+        collection = self.get_listings_collection(
+            write_concern_profile=WRITE_CONCERN_DELETE
+        )
         collection.remove({'name': listing_name})
 
 
+    @instrumentation_service.instrumented
+    def increment_listing_views(self, counts, public=False):
+        """Add to the view counts of listings in one unordered bulk write.
+
+        @param counts: The number of views to add by listing id.
+        @type counts: dict
+        @keyword public: If True, add to the public copies of the listings
+            instead of the listings.
+        @type public: bool
+        @return: The counts which could not be added, by listing id.
+        @rtype: dict
+        """
+        if not counts:
+            return {}
+
+        listing_ids = counts.keys()
+        requests = [
+            pymongo.UpdateOne(
+                {'_id': listing_id},
+                {'$inc': {'views': counts[listing_id]}}
+            )
+            for listing_id in listing_ids
+        ]
+        if public:
+            collection = self.get_public_listings_collection()
+        else:
+            collection = self.get_listings_collection(
+                write_concern_profile=WRITE_CONCERN_BULK
+            )
+
+        try:
+            collection.bulk_write(requests, ordered=False)
+        except errors.BulkWriteError as e:
+            failed_ids = [
+                listing_ids[x['index']]
+                for x in e.details.get('writeErrors', [])
+            ]
+            return dict((x, counts[x]) for x in failed_ids)
+        return {}
+
+
+    @instrumentation_service.instrumented
+    @circuit_breaker_service.guarded_read
+    def list_popular_listings(self, fields=None, limit=None):
+        """List the most viewed published listings.
+
+        @keyword fields: The only fields to return for each listing or None to
+            return entire listings.
+        @type fields: list of str
+        @keyword limit: The maximum number of listings to return or None for
+            no limit.
+        @type limit: int
+        @return: The viewed listings, most viewed first.
+        @rtype: list of dict
+        """
+        collection = self.get_public_listings_collection()
+        listings = self.limit_time(
+            collection.find({'views': {'$gt': 0}}, fields)
+        )
+        listings = listings.sort('views', pymongo.DESCENDING)
+        if limit:
+            listings = listings.limit(limit)
+        return list(listings)
+
+
+    @instrumentation_service.instrumented
+    @circuit_breaker_service.guarded_read
+    def list_archivable_listings(self, expired_before, unpublished_before,
+        after_id=None, limit=None):
+        """List the listings which expired or have long been unpublished.
+
+        @param expired_before: Find listings expiring on or before this time.
+        @type expired_before: datetime.datetime
+        @param unpublished_before: Find listings unpublished on or before this
+            time or None not to find listings by when they were unpublished.
+        @type unpublished_before: datetime.datetime
+        @keyword after_id: Only return listings with ids after this one.
+        @type after_id: bson.objectid.ObjectId
+        @keyword limit: The maximum number of listings to return or None for
+            no limit.
+        @type limit: int
+        @return: The matching listings ordered by id.
+        @rtype: list of dict
+        """
+        conditions = [{'expires_on': {'$lte': expired_before}}]
+        if unpublished_before != None:
+            conditions.append({'unpublished_on': {'$lte': unpublished_before}})
+        query = {'$or': conditions}
+        if after_id != None:
+            query['_id'] = {'$gt': after_id}
+
+        collection = self.get_listings_collection()
+        listings = self.limit_time(collection.find(query))
+        listings = listings.sort('_id', pymongo.ASCENDING)
+        if limit:
+            listings = listings.limit(limit)
+        return list(listings)
+
+
+    @instrumentation_service.instrumented
+    def archive_listings(self, listings):
+        """Move listings from the listing collection to the archive.
+
+        Listings are first copied to the archive and then deleted, so an
+        interrupted archive leaves listings in both collections rather than in
+        neither. A listing whose expires_on or unpublished_on changed since it
+        was read (like one published again) is not deleted and its archived
+        copy is removed again.
+
+        @param listings: The listings to archive, as read, with any archive
+            fields (like "archived_on") to store on the archived copies.
+        @type listings: list of dict
+        @return: The ids of the archived listings.
+        @rtype: list of bson.objectid.ObjectId
+        """
+        if not listings:
+            return []
+
+        archive = self.get_listing_archive_collection(
+            write_concern_profile=WRITE_CONCERN_DELETE
+        )
+        archive.bulk_write(
+            [
+                pymongo.ReplaceOne({'_id': x['_id']}, x, upsert=True)
+                for x in listings
+            ],
+            ordered=False
+        )
+
+        collection = self.get_listings_collection(
+            write_concern_profile=WRITE_CONCERN_DELETE
+        )
+        listing_ids = [x['_id'] for x in listings]
+        result = collection.bulk_write(
+            [
+                pymongo.DeleteOne({
+                    '_id': x['_id'],
+                    'expires_on': x.get('expires_on', None),
+                    'unpublished_on': x.get('unpublished_on', None)
+                })
+                for x in listings
+            ],
+            ordered=False
+        )
+        if result.deleted_count < len(listings):
+            kept_ids = set(
+                x['_id'] for x in
+                collection.find({'_id': {'$in': listing_ids}}, ['_id'])
+            )
+            archive.delete_many({'_id': {'$in': list(kept_ids)}})
+            listing_ids = [x for x in listing_ids if not x in kept_ids]
+
+        self.get_public_listings_collection().delete_many(
+            {'_id': {'$in': listing_ids}}
+        )
+        return listing_ids
+
+
+    @instrumentation_service.instrumented
+    @circuit_breaker_service.guarded_read
+    def get_archived_listing_by_email(self, author_email):
+        """Find the most recently archived listing of an author.
+
+        @param author_email: The email address of the author.
+        @type author_email: str
+        @return: The archived listing or None if the author has none.
+        @rtype: dict or None
+        """
+        return self.get_listing_archive_collection().find_one(
+            {'author_email': author_email},
+            sort=[('archived_on', pymongo.DESCENDING)],
+            **self.get_time_limit()
+        )
+
+
+    @instrumentation_service.instrumented
+    def delete_archived_listing(self, listing_id):
+        """Remove a listing from the archive if it is there.
+
+        @param listing_id: The "_id" of the archived listing.
+        @type listing_id: bson.objectid.ObjectId
+        """
+        self.get_listing_archive_collection().delete_one({'_id': listing_id})
+
+
+    @instrumentation_service.instrumented
+    @circuit_breaker_service.guarded_read
+    def get_category_summary(self, summary_id, public=False, raw=False):
+        """Get the summary of a category or subcategory.
+
+        @param summary_id: The normalized category or category / subcategory
+            slug of the summary.
+        @type summary_id: str
+        @keyword public: If True, the read may be served by a secondary and
+            miss recent writes.
+        @type public: bool
+        @keyword raw: If True, return the summary as a RawBSONDocument without
+            decoding it.
+        @type raw: bool
+        @return: The summary or None if there is no summary with the id or
+            its category has no listings left.
+        @rtype: dict or None
+        """
+        collection = self.get_category_summaries_collection(
+            public=public,
+            raw=raw
+        )
+        return collection.find_one(
+            {'_id': summary_id, 'listings.0': {'$exists': True}},
+            **self.get_time_limit()
+        )
+
+
+    @instrumentation_service.instrumented
+    def upsert_category_summary(self, summary):
+        """Insert or replace the summary of a category or subcategory.
+
+        The summary is only written if the stored one has an older version, so
+        that summaries built concurrently are kept in the order they were built
+        in whatever order their writes arrive.
+
+        @param summary: The summary, with its id under "_id" and its version
+            under "version".
+        @type summary: dict
+        @return: True if the summary was written and False if a newer one is
+            stored.
+        @rtype: bool
+        """
+        collection = self.get_category_summaries_collection()
+        try:
+            collection.replace_one(
+                {
+                    '_id': summary['_id'],
+                    'version': {'$not': {'$gte': summary['version']}}
+                },
+                summary,
+                upsert=True
+            )
+        except errors.DuplicateKeyError:
+            return False
+        return True
+
+
+    @instrumentation_service.instrumented
+    def delete_category_summary(self, summary_id, version):
+        """Delete the summary of a category or subcategory if it is not newer.
+
+        @param summary_id: The id of the summary to delete.
+        @type summary_id: str
+        @param version: The summary is kept if its version is newer than this.
+        @type version: int
+        """
+        collection = self.get_category_summaries_collection()
+        collection.delete_one({
+            '_id': summary_id,
+            'version': {'$not': {'$gt': version}}
+        })
+
+
+    @instrumentation_service.instrumented
+    def list_category_summary_ids(self):
+        """List the ids of all the stored category summaries.
+
+        @return: The ids, including those of summaries of categories with no
+            listings left.
+        @rtype: list of str
+        """
+        collection = self.get_category_summaries_collection()
+        return [x['_id'] for x in collection.find({}, ['_id'])]
+
+
+    @instrumentation_service.instrumented
+    @circuit_breaker_service.guarded_read
+    def get_meta(self, name):
+        """Get a named bookkeeping document.
+
+        @param name: The name of the document.
+        @type name: str
+        @return: The document or None if there is no document with the name.
+        @rtype: dict or None
+        """
+        return self.get_meta_collection().find_one(
+            {'name': name},
+            **self.get_time_limit()
+        )
+
+
+    @instrumentation_service.instrumented
+    def upsert_meta(self, document):
+        """Insert or replace a named bookkeeping document.
+
+        @param document: The document, with its name under "name".
+        @type document: dict
+        """
+        self.get_meta_collection().replace_one(
+            {'name': document['name']},
+            document,
+            upsert=True
+        )
+
+
+    @instrumentation_service.instrumented
+    def get_next_sequence(self, name):
+        """Atomically increment a named counter and return its new value.
+
+        Counters are bookkeeping documents whose value starts at 1.
+
+        @param name: The name of the counter.
+        @type name: str
+        @return: The new value of the counter.
+        @rtype: int
+        """
+        document = self.get_meta_collection().find_one_and_update(
+            {'name': name},
+            {'$inc': {'value': 1}},
+            upsert=True,
+            return_document=pymongo.ReturnDocument.AFTER
+        )
+        return document['value']
+
+
+    @instrumentation_service.instrumented
+    @circuit_breaker_service.guarded_read
     def get_user_by_email(self, user_email):
         """Find a user given an email address.
 
@@ -228,9 +1697,13 @@ class DBAdapter:
         @rtype: dict
         """
         collection = self.get_users_collection()
-        return collection.find_one({'email': user_email})
+        return collection.find_one(
+            {'email': user_email},
+            **self.get_time_limit()
+        )
 
 
+    @instrumentation_service.instrumented
     def upsert_user(self, user_info):
         """Updates or inserts a user, with checks for user validity.
 
@@ -240,25 +1713,157 @@ class DBAdapter:
         @type user: dict
         """
         self.ensure_required_fields(user_info, MINIMUM_REQUIRED_USER_FIELDS)
-        collection = self.get_users_collection()
+        collection = self.get_users_collection(
+            write_concern_profile=WRITE_CONCERN_AUTH
+        )
         collection.save(user_info)
 
 
+    @instrumentation_service.instrumented
     def delete_user(self, user_email):
         """Delete a user given a that user's email address.
 
         @param user_email: The email address of the user to delete.
         @type user_email: str
         """
-        collection = self.get_users_collection()
+        collection = self.get_users_collection(
+            write_concern_profile=WRITE_CONCERN_AUTH
+        )
         collection.remove({'email': user_email})
 
 
-    def get_tags(self):
+    @instrumentation_service.instrumented
+    @circuit_breaker_service.guarded_read
+    def distinct(self, key, listing_slug=None):
+        """Get the unique values of a listing field.
+
+        This is a public read of published listings which may be served by a
+        secondary.
+
+        @param key: The listing field to get the values of.
+        @type key: str
+        @keyword listing_slug: If given, only consider listings with slugs
+            beginning with this slug.
+        @type listing_slug: str
+        @return: The unique values of the field.
+        @rtype: list
+        """
+        collection = self.get_public_listings_collection(public=True)
+        query = None
+        if listing_slug != None:
+            query = self.get_slug_query(listing_slug)
+        return collection.distinct(
+            key,
+            query,
+            **self.get_time_limit('maxTimeMS')
+        )
+
+
+    @instrumentation_service.instrumented
+    @circuit_breaker_service.guarded_read
+    def list_listings_near(self, longitude, latitude, listing_slug=None,
+        max_distance=None, fields=None, skip=0, limit=None):
+        """List the published listings nearest to a point.
+
+        Uses $geoNear so that the distances are calculated, filtered and
+        sorted by the 2dsphere index on location. This is a public read which
+        may be served by a secondary.
+
+        @param longitude: The longitude of the point in degrees.
+        @type longitude: float
+        @param latitude: The latitude of the point in degrees.
+        @type latitude: float
+        @keyword listing_slug: If given, only return listings with slugs
+            beginning with this slug.
+        @type listing_slug: str
+        @keyword max_distance: If given, only return listings at most this
+            many meters away.
+        @type max_distance: float
+        @keyword fields: The only fields to return for each listing (in
+            addition to "distance") or None to return entire listings.
+        @type fields: list of str
+        @keyword skip: The number of nearest listings to skip.
+        @type skip: int
+        @keyword limit: The maximum number of listings to return or None for
+            no limit.
+        @type limit: int
+        @return: The listings, with their distance from the point in meters
+            under "distance", nearest first.
+        @rtype: list of dict
+        """
+        geo_near = {
+            'near': {'type': 'Point', 'coordinates': [longitude, latitude]},
+            'distanceField': 'distance',
+            'spherical': True,
+            'key': 'location'
+        }
+        if listing_slug:
+            geo_near['query'] = self.get_slug_query(listing_slug)
+        if max_distance != None:
+            geo_near['maxDistance'] = max_distance
+
+        pipeline = [{'$geoNear': geo_near}]
+        if skip:
+            pipeline.append({'$skip': skip})
+        if limit:
+            pipeline.append({'$limit': limit})
+        if fields != None:
+            projection = dict((x, True) for x in fields)
+            projection['distance'] = True
+            pipeline.append({'$project': projection})
+
+        collection = self.get_public_listings_collection(public=True)
+        return list(collection.aggregate(
+            pipeline,
+            **self.get_time_limit('maxTimeMS')
+        ))
+
+
+    @instrumentation_service.instrumented
+    @circuit_breaker_service.guarded_read
+    def get_tag_tree(self, listing_slug=None, public=True):
+        """Get the categories and subcategories of the published listings.
+
+        Built by the database from the listings' tag_pairs.
+
+        @keyword listing_slug: If given, only consider listings with slugs
+            beginning with this slug.
+        @type listing_slug: str
+        @keyword public: If True (the default), the read may be served by a
+            secondary and miss recent writes.
+        @type public: bool
+        @return: Dict from category name to its sorted subcategory names.
+        @rtype: dict
+        """
+        collection = self.get_public_listings_collection(public=public)
+        pipeline = []
+        if listing_slug != None:
+            pipeline.append({'$match': self.get_slug_query(listing_slug)})
+        pipeline.extend([
+            {'$unwind': '$tag_pairs'},
+            {'$group': {
+                '_id': '$tag_pairs.cat_name',
+                'subcategories': {'$addToSet': '$tag_pairs.sub_name'}
+            }}
+        ])
+
+        categories = collection.aggregate(
+            pipeline,
+            **self.get_time_limit('maxTimeMS')
+        )
+        return dict(
+            (x['_id'], sorted(x['subcategories'])) for x in categories
+        )
+
+
+    @instrumentation_service.instrumented
+    def get_tags(self, listing_slug=None):
         """Get all the unique listing tags.
 
+        @keyword listing_slug: If given, only get the tags of listings with
+            slugs beginning with this slug.
+        @type listing_slug: str
         @return: All the unique listing tags.
         @type: list
         """
-        collection = self.get_listings_collection()
-        return collection.distinct('tags')
+        return self.distinct('tags', listing_slug)
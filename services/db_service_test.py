@@ -4,8 +4,12 @@
 @license: GNU GPLv3
 """
 import copy
+import os
+import threading
 
 import mox
+import pymongo
+from pymongo import monitoring
 
 try:
     from tinyclassified import tiny_classified
@@ -13,6 +17,7 @@ except:
     import tiny_classified
 
 import db_service
+import deadline_service
 
 
 TEST_LISTING = {
@@ -41,16 +46,57 @@ class TestCollection():
     def remove(self, record):
         self.deleted.append(record)
 
-    def ensure_index(self, key, **kwargs):
+    def create_index(self, key, **kwargs):
+        if isinstance(key, list):
+            key = tuple(key)
         self.indices.append({key: kwargs})
 
-    def find(self, find_dict):
+    def find(self, find_dict, fields=None):
+        pass
+
+    def find_one(self, find_dict, max_time_ms=None):
+        pass
+
+    def distinct(self, key, find_dict=None, maxTimeMS=None):
+        pass
+
+    def aggregate(self, pipeline, maxTimeMS=None):
+        pass
+
+    def bulk_write(self, requests, ordered=True):
+        pass
+
+    def replace_one(self, find_dict, record, upsert=False):
+        pass
+
+    def insert_one(self, record):
+        self.saved.append(record)
+
+    def update_one(self, find_dict, update, upsert=False):
         pass
 
 class TestMongoCursor():
     """Test object for injection as a pymongo.collection.find() result."""
     def __init__(self):
-        pass
+        self.sort_params = None
+        self.limit_param = None
+        self.max_time_ms_param = None
+        self.results = []
+
+    def sort(self, key, direction):
+        self.sort_params = (key, direction)
+        return self
+
+    def limit(self, limit):
+        self.limit_param = limit
+        return self
+
+    def max_time_ms(self, max_time_ms):
+        self.max_time_ms_param = max_time_ms
+        return self
+
+    def __iter__(self):
+        return iter(self.results)
 
     def next(self):
         raise StopIteration
@@ -64,8 +110,113 @@ class DBAdapterTests(mox.MoxTestBase):
         mox.MoxTestBase.setUp(self)
         self.db_adapter = db_service.DBAdapter()
 
-    def test_get_listings_collection_ensures_unique_names(self):
+    def test_get_client_reuses_client_in_same_process(self):
+        self.mox.StubOutWithMock(os, 'getpid')
+        os.getpid().AndReturn(100)
+        os.getpid().AndReturn(100)
+
+        self.mox.StubOutWithMock(self.db_adapter, 'create_client')
+        self.db_adapter.create_client(
+            mox.IsA(db_service.PoolUsageListener)
+        ).AndReturn('client')
+
+        self.mox.ReplayAll()
+
+        self.assertEqual('client', self.db_adapter.get_client())
+        self.assertEqual('client', self.db_adapter.get_client())
+
+    def test_get_client_recreates_client_after_fork(self):
+        self.mox.StubOutWithMock(os, 'getpid')
+        os.getpid().AndReturn(100)
+        os.getpid().AndReturn(101)
+
+        self.mox.StubOutWithMock(self.db_adapter, 'create_client')
+        self.db_adapter.create_client(
+            mox.IsA(db_service.PoolUsageListener)
+        ).AndReturn('parent client')
+        self.db_adapter.create_client(
+            mox.IsA(db_service.PoolUsageListener)
+        ).AndReturn('child client')
+
+        self.mox.ReplayAll()
+
+        self.assertEqual('parent client', self.db_adapter.get_client())
+        self.db_adapter.collections['test'] = 'parent collection'
+        self.assertEqual('child client', self.db_adapter.get_client())
+        self.assertEqual({}, self.db_adapter.collections)
+
+    def test_get_client_creates_one_client_across_threads(self):
+        created = []
+        started = threading.Event()
+        release = threading.Event()
+
+        def create_client(pool_listener):
+            created.append(pool_listener)
+            started.set()
+            release.wait(5)
+            return 'client'
+
+        self.db_adapter.create_client = create_client
+        clients = []
+        threads = [
+            threading.Thread(
+                target=lambda: clients.append(self.db_adapter.get_client())
+            )
+            for i in range(4)
+        ]
+        threads[0].start()
+        started.wait(5)
+        for thread in threads[1:]:
+            thread.start()
+        release.set()
+        for thread in threads:
+            thread.join(5)
+
+        self.assertEqual(['client'] * 4, clients)
+        self.assertEqual(1, len(created))
+        self.assertIs(created[0], self.db_adapter.pool_listener)
+
+    def test_create_client_uses_pool_config(self):
+        app_config = tiny_classified.get_config()
+        self.mox.StubOutWithMock(app_config, 'get')
+        app_config.get('MONGO_MAX_POOL_SIZE', mox.IgnoreArg()).AndReturn(7)
+        app_config.get(
+            'MONGO_WAIT_QUEUE_TIMEOUT_MS',
+            mox.IgnoreArg()
+        ).AndReturn(250)
+        app_config.get('MONGO_CONNECT_TIMEOUT_MS', mox.IgnoreArg()).AndReturn(
+            500
+        )
+        app_config.get('MONGO_SOCKET_TIMEOUT_MS', mox.IgnoreArg()).AndReturn(
+            3000
+        )
+
+        self.mox.ReplayAll()
 
+        client = self.db_adapter.create_client(db_service.PoolUsageListener())
+        self.assertEqual(7, client.max_pool_size)
+
+    def test_pool_usage_listener(self):
+        listener = db_service.PoolUsageListener()
+        listener.connection_created(None)
+        listener.connection_created(None)
+        listener.connection_checked_out(None)
+        listener.connection_checked_out(None)
+        listener.connection_checked_in(None)
+        listener.connection_closed(None)
+
+        failure = self.mox.CreateMockAnything()
+        failure.reason = monitoring.ConnectionCheckOutFailedReason.TIMEOUT
+        listener.connection_check_out_failed(failure)
+
+        counts = listener.get_counts()
+        self.assertEqual(1, counts['open'])
+        self.assertEqual(1, counts['checked_out'])
+        self.assertEqual(2, counts['checkouts'])
+        self.assertEqual(1, counts['checkout_failures'])
+        self.assertEqual(1, counts['wait_queue_timeouts'])
+
+    def test_get_listings_collection_reuses_handle(self):
         test_collection = TestCollection()
         test_database = {db_service.LISTINGS_COLLECTION_NAME: test_collection}
 
@@ -76,9 +227,110 @@ class DBAdapterTests(mox.MoxTestBase):
 
         result_collection = self.db_adapter.get_listings_collection()
         self.assertEqual(test_collection, result_collection)
-        self.assertTrue({'name': {'unique':True}} in result_collection.indices)
+        result_collection = self.db_adapter.get_listings_collection()
+        self.assertEqual(test_collection, result_collection)
+        self.assertEqual([], result_collection.indices)
+
+    def test_get_public_listings_collection_uses_read_preference(self):
+        test_collection = self.mox.CreateMock(pymongo.collection.Collection)
+        test_public_collection = TestCollection()
+        test_database = {db_service.LISTINGS_COLLECTION_NAME: test_collection}
+
+        self.mox.StubOutWithMock(self.db_adapter, 'get_database')
+        self.db_adapter.get_database().AndReturn(test_database)
+        test_collection.with_options(read_preference=mox.Func(
+            lambda x: x.mongos_mode == 'secondaryPreferred' and
+                x.max_staleness == 90
+        )).AndReturn(test_public_collection)
+
+        self.mox.ReplayAll()
+
+        result = self.db_adapter.get_listings_collection(public=True)
+        self.assertEqual(test_public_collection, result)
+        result = self.db_adapter.get_listings_collection(public=True)
+        self.assertEqual(test_public_collection, result)
+
+    def test_get_public_read_preference_from_config(self):
+        config = tiny_classified.get_config()
+        original_config = dict(config)
+        try:
+            config['MONGO_PUBLIC_READ_PREFERENCE'] = 'nearest'
+            config['MONGO_PUBLIC_MAX_STALENESS_SECONDS'] = 120
+            preference = self.db_adapter.get_public_read_preference()
+            self.assertEqual('nearest', preference.mongos_mode)
+            self.assertEqual(120, preference.max_staleness)
+
+            config['MONGO_PUBLIC_READ_PREFERENCE'] = 'primary'
+            preference = self.db_adapter.get_public_read_preference()
+            self.assertEqual('primary', preference.mongos_mode)
+        finally:
+            config.clear()
+            config.update(original_config)
+
+    def test_get_write_concern_defaults_and_config(self):
+        config = tiny_classified.get_config()
+        original_config = dict(config)
+        try:
+            config.pop('MONGO_WRITE_CONCERNS', None)
+            result = self.db_adapter.get_write_concern(
+                db_service.WRITE_CONCERN_AUTH)
+            self.assertEqual('majority', result.document['w'])
+            self.assertTrue(result.document['j'])
+
+            config['MONGO_WRITE_CONCERNS'] = {
+                db_service.WRITE_CONCERN_BULK: {'w': 0}
+            }
+            result = self.db_adapter.get_write_concern(
+                db_service.WRITE_CONCERN_BULK)
+            self.assertEqual({'w': 0}, result.document)
+            result = self.db_adapter.get_write_concern(
+                db_service.WRITE_CONCERN_DELETE)
+            self.assertEqual({'j': True}, result.document)
+        finally:
+            config.clear()
+            config.update(original_config)
+
+    def test_get_collection_uses_write_concern_profile(self):
+        test_collection = self.mox.CreateMock(pymongo.collection.Collection)
+        test_delete_collection = TestCollection()
+        test_database = {db_service.LISTINGS_COLLECTION_NAME: test_collection}
+
+        self.mox.StubOutWithMock(self.db_adapter, 'get_database')
+        self.db_adapter.get_database().AndReturn(test_database)
+        test_collection.with_options(write_concern=mox.Func(
+            lambda x: x.document == {'j': True}
+        )).AndReturn(test_delete_collection)
+
+        self.mox.ReplayAll()
 
-    def test_get_users_collection_ensures_unique_emails(self):
+        for i in range(2):
+            result = self.db_adapter.get_listings_collection(
+                write_concern_profile=db_service.WRITE_CONCERN_DELETE
+            )
+            self.assertEqual(test_delete_collection, result)
+
+    def test_get_collection_raw(self):
+        test_collection = self.mox.CreateMock(pymongo.collection.Collection)
+        test_raw_collection = TestCollection()
+        test_database = {
+            db_service.CATEGORY_SUMMARIES_COLLECTION_NAME: test_collection
+        }
+
+        self.mox.StubOutWithMock(self.db_adapter, 'get_database')
+        self.db_adapter.get_database().AndReturn(test_database)
+        test_collection.with_options(
+            codec_options=db_service.RAW_CODEC_OPTIONS
+        ).AndReturn(test_raw_collection)
+
+        self.mox.ReplayAll()
+
+        for i in range(2):
+            result = self.db_adapter.get_category_summaries_collection(
+                raw=True
+            )
+            self.assertEqual(test_raw_collection, result)
+
+    def test_get_users_collection_reuses_handle(self):
         test_collection = TestCollection()
         test_database = {db_service.USERS_COLLECTION_NAME: test_collection}
 
@@ -89,7 +341,44 @@ class DBAdapterTests(mox.MoxTestBase):
 
         result_collection = self.db_adapter.get_users_collection()
         self.assertEqual(test_collection, result_collection)
-        self.assertTrue({'email': {'unique':True}} in result_collection.indices)
+        result_collection = self.db_adapter.get_users_collection()
+        self.assertEqual(test_collection, result_collection)
+        self.assertEqual([], result_collection.indices)
+
+    def test_ensure_indices(self):
+        test_listings_collection = TestCollection()
+        test_public_listings_collection = TestCollection()
+        test_users_collection = TestCollection()
+        test_meta_collection = TestCollection()
+        test_archive_collection = TestCollection()
+        test_database = {
+            db_service.LISTINGS_COLLECTION_NAME: test_listings_collection,
+            db_service.PUBLIC_LISTINGS_COLLECTION_NAME:
+                test_public_listings_collection,
+            db_service.USERS_COLLECTION_NAME: test_users_collection,
+            db_service.META_COLLECTION_NAME: test_meta_collection,
+            db_service.LISTING_ARCHIVE_COLLECTION_NAME: test_archive_collection
+        }
+
+        self.mox.StubOutWithMock(self.db_adapter, 'get_database')
+        for collection_name in db_service.INDICES:
+            self.db_adapter.get_database().AndReturn(test_database)
+
+        self.mox.ReplayAll()
+
+        self.db_adapter.ensure_indices()
+        listing_indices = test_listings_collection.indices
+        self.assertTrue({'name': {'unique':True}} in listing_indices)
+        self.assertTrue({'slugs': {}} in listing_indices)
+        self.assertTrue({'author_email': {}} in listing_indices)
+        self.assertTrue({'expires_on': {'sparse': True}} in listing_indices)
+        public_listing_indices = test_public_listings_collection.indices
+        self.assertTrue({'slugs': {}} in public_listing_indices)
+        self.assertFalse({'author_email': {}} in public_listing_indices)
+        user_indices = test_users_collection.indices
+        self.assertTrue({'email': {'unique':True}} in user_indices)
+        meta_indices = test_meta_collection.indices
+        self.assertTrue({'name': {'unique':True}} in meta_indices)
 
     def test_ensure_required_fields_not_enough_fields(self):
         test_fields = {'a':'', 'b':'', 'c':''}
@@ -123,6 +412,286 @@ class DBAdapterTests(mox.MoxTestBase):
         test_record = {'a':'', 'b':'', 'c':''}
         self.db_adapter.ensure_limited_fields(test_record, test_fields)
 
+    def test_normalize_slug(self):
+        result = db_service.normalize_slug('Cat/SubCat/Test Name')
+        self.assertEqual('cat/subcat/test name', result)
+
+    def test_escape_regex(self):
+        result = db_service.escape_regex('a.b*c(d)[e]{f}+g?h|i^j$k\\l m/n')
+        expected = 'a\\.b\\*c\\(d\\)\\[e\\]\\{f\\}\\+g\\?h\\|i\\^j\\$k\\\\l m/n'
+        self.assertEqual(expected, result)
+
+    def test_list_listings_by_slug_normalized_prefix(self):
+        test_collection = TestCollection()
+        test_cursor = TestMongoCursor()
+
+        self.mox.StubOutWithMock(
+            self.db_adapter,
+            'get_public_listings_collection'
+        )
+        self.db_adapter.get_public_listings_collection(
+            public=True,
+            raw=False
+        ).AndReturn(test_collection)
+
+        self.mox.StubOutWithMock(test_collection, 'find')
+        test_collection.find(mox.Func(
+            lambda x: x['slugs_normalized'].pattern == '^cat \\(x\\)/sub/n'
+        ), None).AndReturn(test_cursor)
+
+        self.mox.ReplayAll()
+
+        result = self.db_adapter.list_listings_by_slug('Cat (X)/Sub/N')
+        self.assertEqual(test_cursor.results, result)
+        self.assertEqual(('name', pymongo.ASCENDING), test_cursor.sort_params)
+        self.assertEqual(None, test_cursor.limit_param)
+
+    def test_get_slug_query_categories(self):
+        self.assertEqual({}, self.db_adapter.get_slug_query(''))
+        self.assertEqual(
+            {'categories': 'cat (x)'},
+            self.db_adapter.get_slug_query('Cat (X)/')
+        )
+        self.assertEqual(
+            {'tag_pairs': {'$elemMatch': {'cat': 'cat', 'sub': 'sub'}}},
+            self.db_adapter.get_slug_query('Cat/Sub/')
+        )
+
+    def test_get_tag_tree(self):
+        test_collection = TestCollection()
+
+        self.mox.StubOutWithMock(
+            self.db_adapter,
+            'get_public_listings_collection'
+        )
+        self.db_adapter.get_public_listings_collection(public=True).AndReturn(
+            test_collection)
+
+        self.mox.StubOutWithMock(test_collection, 'aggregate')
+        test_collection.aggregate(mox.Func(
+            lambda x: x[0] == {'$match': {'categories': 'cat'}} and
+                x[1] == {'$unwind': '$tag_pairs'}
+        )).AndReturn([{'_id': 'Cat', 'subcategories': ['Sub2', 'Sub1']}])
+
+        self.mox.ReplayAll()
+
+        self.assertEqual(
+            {'Cat': ['Sub1', 'Sub2']},
+            self.db_adapter.get_tag_tree(listing_slug='Cat')
+        )
+
+    def test_list_listings_near(self):
+        test_collection = TestCollection()
+
+        self.mox.StubOutWithMock(
+            self.db_adapter,
+            'get_public_listings_collection'
+        )
+        self.db_adapter.get_public_listings_collection(public=True).AndReturn(
+            test_collection)
+
+        self.mox.StubOutWithMock(test_collection, 'aggregate')
+        test_collection.aggregate([
+            {'$geoNear': {
+                'near': {'type': 'Point', 'coordinates': [-122.3, 47.6]},
+                'distanceField': 'distance',
+                'spherical': True,
+                'key': 'location',
+                'query': {'categories': 'cat'},
+                'maxDistance': 5000
+            }},
+            {'$skip': 10},
+            {'$limit': 11},
+            {'$project': {'name': True, 'distance': True}}
+        ]).AndReturn(iter([{'name': 'test', 'distance': 12.5}]))
+
+        self.mox.ReplayAll()
+
+        self.assertEqual(
+            [{'name': 'test', 'distance': 12.5}],
+            self.db_adapter.list_listings_near(
+                -122.3,
+                47.6,
+                listing_slug='Cat',
+                max_distance=5000,
+                fields=['name'],
+                skip=10,
+                limit=11
+            )
+        )
+
+    def test_list_listings_by_slug_projection(self):
+        test_collection = TestCollection()
+        test_cursor = TestMongoCursor()
+
+        self.mox.StubOutWithMock(
+            self.db_adapter,
+            'get_public_listings_collection'
+        )
+        self.db_adapter.get_public_listings_collection(
+            public=True,
+            raw=False
+        ).AndReturn(test_collection)
+
+        self.mox.StubOutWithMock(test_collection, 'find')
+        test_collection.find(
+            mox.IsA(dict),
+            db_service.LISTING_SUMMARY_FIELDS
+        ).AndReturn(test_cursor)
+
+        self.mox.ReplayAll()
+
+        result = self.db_adapter.list_listings_by_slug(
+            'cat',
+            fields=db_service.LISTING_SUMMARY_FIELDS
+        )
+        self.assertEqual(test_cursor.results, result)
+
+    def test_list_listings_by_slug_keyset_page(self):
+        test_collection = TestCollection()
+        test_cursor = TestMongoCursor()
+
+        self.mox.StubOutWithMock(
+            self.db_adapter,
+            'get_public_listings_collection'
+        )
+        self.db_adapter.get_public_listings_collection(
+            public=True,
+            raw=False
+        ).AndReturn(test_collection)
+
+        self.mox.StubOutWithMock(test_collection, 'find')
+        test_collection.find(
+            mox.Func(lambda x: x['name'] == {'$gt': 'Last Name'}),
+            None
+        ).AndReturn(test_cursor)
+
+        self.mox.ReplayAll()
+
+        self.db_adapter.list_listings_by_slug(
+            'cat',
+            after_name='Last Name',
+            limit=11
+        )
+        self.assertEqual(('name', pymongo.ASCENDING), test_cursor.sort_params)
+        self.assertEqual(11, test_cursor.limit_param)
+
+    def test_get_listing_by_id_primary(self):
+        test_collection = TestCollection()
+
+        self.mox.StubOutWithMock(
+            self.db_adapter,
+            'get_public_listings_collection'
+        )
+        self.db_adapter.get_public_listings_collection(
+            public=False,
+            raw=True
+        ).AndReturn(test_collection)
+
+        self.mox.StubOutWithMock(test_collection, 'find_one')
+        test_collection.find_one({'_id': 'someid'}).AndReturn(TEST_LISTING)
+
+        self.mox.ReplayAll()
+
+        result = self.db_adapter.get_listing_by_id(
+            'someid',
+            public=True,
+            raw=True,
+            primary=True
+        )
+        self.assertEqual(TEST_LISTING, result)
+
+    def test_get_listing_by_slug_limited_to_deadline(self):
+        test_collection = TestCollection()
+
+        self.mox.StubOutWithMock(
+            self.db_adapter,
+            'get_public_listings_collection'
+        )
+        self.db_adapter.get_public_listings_collection(
+            public=True,
+            raw=False
+        ).AndReturn(test_collection)
+
+        self.mox.StubOutWithMock(deadline_service, 'get_remaining_ms')
+        deadline_service.get_remaining_ms().AndReturn(250)
+
+        self.mox.StubOutWithMock(test_collection, 'find_one')
+        test_collection.find_one(
+            {'slugs': 'cat/subcat/TestName'},
+            max_time_ms=250
+        ).AndReturn(TEST_LISTING)
+
+        self.mox.ReplayAll()
+
+        result = self.db_adapter.get_listing_by_slug(
+            'cat/subcat/TestName',
+            public=True
+        )
+        self.assertEqual(TEST_LISTING, result)
+
+    def test_list_listings_by_slug_limited_to_deadline(self):
+        test_collection = TestCollection()
+        test_cursor = TestMongoCursor()
+
+        self.mox.StubOutWithMock(
+            self.db_adapter,
+            'get_public_listings_collection'
+        )
+        self.db_adapter.get_public_listings_collection(
+            public=True,
+            raw=False
+        ).AndReturn(test_collection)
+
+        self.mox.StubOutWithMock(test_collection, 'find')
+        test_collection.find(mox.IsA(dict), None).AndReturn(test_cursor)
+
+        self.mox.ReplayAll()
+
+        deadline_service.set_timeout(60000)
+        try:
+            self.db_adapter.list_listings_by_slug('cat')
+        finally:
+            deadline_service.clear_deadline()
+        self.assertTrue(0 < test_cursor.max_time_ms_param <= 60000)
+
+    def test_distinct_limited_to_deadline(self):
+        test_collection = TestCollection()
+
+        self.mox.StubOutWithMock(
+            self.db_adapter,
+            'get_public_listings_collection'
+        )
+        self.db_adapter.get_public_listings_collection(public=True).AndReturn(
+            test_collection)
+
+        self.mox.StubOutWithMock(deadline_service, 'get_remaining_ms')
+        deadline_service.get_remaining_ms().AndReturn(250)
+
+        self.mox.StubOutWithMock(test_collection, 'distinct')
+        test_collection.distinct('tags', None, maxTimeMS=250).AndReturn([])
+
+        self.mox.ReplayAll()
+
+        self.assertEqual([], self.db_adapter.get_tags())
+
+    def test_query_after_deadline_not_sent(self):
+        test_collection = TestCollection()
+
+        self.mox.StubOutWithMock(self.db_adapter, 'get_listings_collection')
+        self.db_adapter.get_listings_collection().AndReturn(test_collection)
+
+        self.mox.StubOutWithMock(test_collection, 'find_one')
+
+        self.mox.ReplayAll()
+
+        deadline_service.set_deadline(0)
+        try:
+            with self.assertRaises(deadline_service.DeadlineExceeded):
+                self.db_adapter.get_listing_by_name('TestName')
+        finally:
+            deadline_service.clear_deadline()
+
     def test_upsert_listing(self):
         test_collection = TestCollection()
 
@@ -148,11 +717,345 @@ class DBAdapterTests(mox.MoxTestBase):
         self.db_adapter.upsert_listing(TEST_LISTING)
         self.assertTrue(TEST_LISTING in test_collection.saved)
 
+    def test_bulk_upsert_listings_batches(self):
+        test_collection = TestCollection()
+        existing_listing = copy.deepcopy(TEST_LISTING)
+        existing_listing['_id'] = 'existing id'
+        new_listings = [copy.deepcopy(TEST_LISTING) for i in range(2)]
+
+        self.mox.StubOutWithMock(self.db_adapter, 'get_listings_collection')
+        self.db_adapter.get_listings_collection(
+            write_concern_profile=db_service.WRITE_CONCERN_BULK
+        ).AndReturn(test_collection)
+
+        self.mox.StubOutWithMock(test_collection, 'bulk_write')
+        test_collection.bulk_write(
+            [
+                pymongo.UpdateOne(
+                    {'_id': 'existing id'},
+                    db_service.get_replacement_update(
+                        existing_listing,
+                        db_service.ALLOWED_LISTING_FIELDS
+                    ),
+                    upsert=True
+                ),
+                pymongo.InsertOne(new_listings[0])
+            ],
+            ordered=False
+        )
+        test_collection.bulk_write(
+            [pymongo.InsertOne(new_listings[1])],
+            ordered=False
+        )
+
+        self.mox.ReplayAll()
+
+        results = self.db_adapter.bulk_upsert_listings(
+            [existing_listing] + new_listings,
+            batch_size=2
+        )
+        self.assertEqual([None, None, None], results)
+
+    def test_bulk_publish_listings(self):
+        test_collection = TestCollection()
+        published_listing = dict(TEST_LISTING, _id='published id')
+        published_listing['is_published'] = True
+        draft_listing = dict(TEST_LISTING, _id='draft id')
+
+        self.mox.StubOutWithMock(
+            self.db_adapter,
+            'get_public_listings_collection'
+        )
+        self.db_adapter.get_public_listings_collection(
+            write_concern_profile=db_service.WRITE_CONCERN_BULK
+        ).AndReturn(test_collection)
+
+        self.mox.StubOutWithMock(test_collection, 'bulk_write')
+        test_collection.bulk_write(
+            [
+                pymongo.UpdateOne(
+                    {'_id': 'published id'},
+                    db_service.get_public_listing_update(published_listing),
+                    upsert=True
+                ),
+                pymongo.DeleteOne({'_id': 'draft id'})
+            ],
+            ordered=False
+        )
+        test_collection.bulk_write(
+            [pymongo.DeleteOne({'_id': 'deleted id'})],
+            ordered=False
+        )
+
+        self.mox.ReplayAll()
+
+        self.db_adapter.bulk_publish_listings(
+            [published_listing, draft_listing, {'_id': 'deleted id'}],
+            batch_size=2
+        )
+        self.assertFalse(
+            'is_published' in db_service.get_public_listing_update(
+                published_listing)['$set']
+        )
+
+    def test_update_listing_fields(self):
+        test_collection = TestCollection()
+        test_public_collection = TestCollection()
+        bulk_result = self.mox.CreateMockAnything()
+        bulk_result.matched_count = 1
+
+        self.mox.StubOutWithMock(self.db_adapter, 'get_listings_collection')
+        self.db_adapter.get_listings_collection(
+            write_concern_profile=db_service.WRITE_CONCERN_BULK
+        ).AndReturn(test_collection)
+        self.mox.StubOutWithMock(
+            self.db_adapter,
+            'get_public_listings_collection'
+        )
+        self.db_adapter.get_public_listings_collection().AndReturn(
+            test_public_collection
+        )
+
+        self.mox.StubOutWithMock(test_collection, 'bulk_write')
+        test_collection.bulk_write(
+            [
+                pymongo.UpdateOne(
+                    {'_id': 'id1', 'latitude': '1.5'},
+                    {'$set': {'latitude': 1.5}}
+                ),
+                pymongo.UpdateOne(
+                    {'_id': 'id2', 'datecreated': '2009-03-01'},
+                    {'$set': {'datecreated': 'date'}}
+                )
+            ],
+            ordered=False
+        ).AndReturn(bulk_result)
+        self.mox.StubOutWithMock(test_public_collection, 'bulk_write')
+        test_public_collection.bulk_write(
+            [pymongo.UpdateOne(
+                {'_id': 'id1', 'latitude': '1.5'},
+                {'$set': {'latitude': 1.5}}
+            )],
+            ordered=False
+        )
+
+        self.mox.ReplayAll()
+
+        self.assertEqual(1, self.db_adapter.update_listing_fields([
+            ('id1', {'latitude': '1.5'}, {'latitude': 1.5}),
+            ('id2', {'datecreated': '2009-03-01'}, {'datecreated': 'date'})
+        ]))
+
+    def test_increment_listing_views(self):
+        test_collection = TestCollection()
+        test_public_collection = TestCollection()
+        counts = {'id1': 3, 'id2': 1}
+        requests = [
+            pymongo.UpdateOne({'_id': x}, {'$inc': {'views': counts[x]}})
+            for x in counts.keys()
+        ]
+
+        self.mox.StubOutWithMock(self.db_adapter, 'get_listings_collection')
+        self.db_adapter.get_listings_collection(
+            write_concern_profile=db_service.WRITE_CONCERN_BULK
+        ).AndReturn(test_collection)
+        self.mox.StubOutWithMock(
+            self.db_adapter,
+            'get_public_listings_collection'
+        )
+        self.db_adapter.get_public_listings_collection().AndReturn(
+            test_public_collection
+        )
+
+        self.mox.StubOutWithMock(test_collection, 'bulk_write')
+        test_collection.bulk_write(requests, ordered=False)
+        self.mox.StubOutWithMock(test_public_collection, 'bulk_write')
+        test_public_collection.bulk_write(requests, ordered=False).AndRaise(
+            pymongo.errors.BulkWriteError({'writeErrors': [{'index': 1}]})
+        )
+
+        self.mox.ReplayAll()
+
+        self.assertEqual({}, self.db_adapter.increment_listing_views(counts))
+        failed_id = counts.keys()[1]
+        self.assertEqual(
+            {failed_id: counts[failed_id]},
+            self.db_adapter.increment_listing_views(counts, public=True)
+        )
+
+    def test_get_replacement_update(self):
+        self.assertEqual(
+            {
+                '$set': {'name': 'A', 'tags': {}},
+                '$unset': {'slugs': ''},
+                '$setOnInsert': {'views': 3}
+            },
+            db_service.get_replacement_update(
+                {'_id': 'id1', 'name': 'A', 'tags': {}, 'views': 3},
+                ['_id', 'name', 'tags', 'slugs', 'views']
+            )
+        )
+        self.assertEqual(
+            {'$set': {'name': 'A'}},
+            db_service.get_replacement_update(
+                {'_id': 'id1', 'name': 'A'},
+                ['_id', 'name', 'views']
+            )
+        )
+
+    def test_upsert_category_summary_keeps_newer(self):
+        test_collection = TestCollection()
+        summary = {'_id': 'cat', 'version': 3, 'listings': []}
+        query = {'_id': 'cat', 'version': {'$not': {'$gte': 3}}}
+
+        self.mox.StubOutWithMock(
+            self.db_adapter,
+            'get_category_summaries_collection'
+        )
+        self.db_adapter.get_category_summaries_collection().MultipleTimes(
+            ).AndReturn(test_collection)
+
+        self.mox.StubOutWithMock(test_collection, 'replace_one')
+        test_collection.replace_one(query, summary, upsert=True)
+        test_collection.replace_one(query, summary, upsert=True).AndRaise(
+            pymongo.errors.DuplicateKeyError('E11000'))
+
+        self.mox.ReplayAll()
+
+        self.assertTrue(self.db_adapter.upsert_category_summary(summary))
+        self.assertFalse(self.db_adapter.upsert_category_summary(summary))
+
+    def test_archive_listings(self):
+        listings = [
+            {'_id': 'id1', 'expires_on': 'yesterday'},
+            {'_id': 'id2', 'unpublished_on': 'last year'}
+        ]
+        test_archive = self.mox.CreateMock(pymongo.collection.Collection)
+        test_collection = self.mox.CreateMock(pymongo.collection.Collection)
+        test_public_collection = self.mox.CreateMock(
+            pymongo.collection.Collection
+        )
+        delete_result = self.mox.CreateMockAnything()
+        delete_result.deleted_count = 1
+
+        self.mox.StubOutWithMock(
+            self.db_adapter,
+            'get_listing_archive_collection'
+        )
+        self.db_adapter.get_listing_archive_collection(
+            write_concern_profile=db_service.WRITE_CONCERN_DELETE
+        ).AndReturn(test_archive)
+        test_archive.bulk_write(
+            [
+                pymongo.ReplaceOne({'_id': 'id1'}, listings[0], upsert=True),
+                pymongo.ReplaceOne({'_id': 'id2'}, listings[1], upsert=True)
+            ],
+            ordered=False
+        )
+
+        self.mox.StubOutWithMock(self.db_adapter, 'get_listings_collection')
+        self.db_adapter.get_listings_collection(
+            write_concern_profile=db_service.WRITE_CONCERN_DELETE
+        ).AndReturn(test_collection)
+        test_collection.bulk_write(
+            [
+                pymongo.DeleteOne({
+                    '_id': 'id1',
+                    'expires_on': 'yesterday',
+                    'unpublished_on': None
+                }),
+                pymongo.DeleteOne({
+                    '_id': 'id2',
+                    'expires_on': None,
+                    'unpublished_on': 'last year'
+                })
+            ],
+            ordered=False
+        ).AndReturn(delete_result)
+        test_collection.find(
+            {'_id': {'$in': ['id1', 'id2']}},
+            ['_id']
+        ).AndReturn([{'_id': 'id2'}])
+        test_archive.delete_many({'_id': {'$in': ['id2']}})
+
+        self.mox.StubOutWithMock(
+            self.db_adapter,
+            'get_public_listings_collection'
+        )
+        self.db_adapter.get_public_listings_collection().AndReturn(
+            test_public_collection
+        )
+        test_public_collection.delete_many({'_id': {'$in': ['id1']}})
+
+        self.mox.ReplayAll()
+
+        self.assertEqual(['id1'], self.db_adapter.archive_listings(listings))
+
+    def test_bulk_upsert_listings_reports_errors(self):
+        test_collection = TestCollection()
+        invalid_listing = copy.deepcopy(TEST_LISTING)
+        invalid_listing['not allowed'] = True
+        listings = [copy.deepcopy(TEST_LISTING) for i in range(2)]
+        write_error = pymongo.errors.BulkWriteError({'writeErrors': [
+            {'index': 1, 'code': 11000, 'errmsg': 'duplicate key'}
+        ]})
+
+        self.mox.StubOutWithMock(self.db_adapter, 'get_listings_collection')
+        self.db_adapter.get_listings_collection(
+            write_concern_profile=db_service.WRITE_CONCERN_BULK
+        ).AndReturn(test_collection)
+
+        self.mox.StubOutWithMock(test_collection, 'bulk_write')
+        test_collection.bulk_write(
+            mox.IsA(list),
+            ordered=False
+        ).AndRaise(write_error)
+
+        self.mox.ReplayAll()
+
+        results = self.db_adapter.bulk_upsert_listings(
+            [listings[0], invalid_listing, listings[1]]
+        )
+        self.assertEqual(None, results[0])
+        self.assertTrue('not allowed' in results[1])
+        self.assertEqual('duplicate key', results[2])
+
+    def test_bulk_upsert_listings_ordered_stops_at_error(self):
+        test_collection = TestCollection()
+        listings = [copy.deepcopy(TEST_LISTING) for i in range(4)]
+        write_error = pymongo.errors.BulkWriteError({'writeErrors': [
+            {'index': 0, 'code': 11000, 'errmsg': 'duplicate key'}
+        ]})
+
+        self.mox.StubOutWithMock(self.db_adapter, 'get_listings_collection')
+        self.db_adapter.get_listings_collection(
+            write_concern_profile=db_service.WRITE_CONCERN_BULK
+        ).AndReturn(test_collection)
+
+        self.mox.StubOutWithMock(test_collection, 'bulk_write')
+        test_collection.bulk_write(
+            mox.IsA(list),
+            ordered=True
+        ).AndRaise(write_error)
+
+        self.mox.ReplayAll()
+
+        results = self.db_adapter.bulk_upsert_listings(
+            listings,
+            batch_size=2,
+            ordered=True
+        )
+        self.assertEqual('duplicate key', results[0])
+        for result in results[1:]:
+            self.assertEqual(db_service.NOT_ATTEMPTED_MESSAGE, result)
+
     def test_delete_listing_by_name(self):
         test_collection = TestCollection()
 
         self.mox.StubOutWithMock(self.db_adapter, 'get_listings_collection')
-        self.db_adapter.get_listings_collection().AndReturn(test_collection)
+        self.db_adapter.get_listings_collection(
+            write_concern_profile=db_service.WRITE_CONCERN_DELETE
+        ).AndReturn(test_collection)
 
         self.mox.ReplayAll()
 
@@ -168,7 +1071,9 @@ class DBAdapterTests(mox.MoxTestBase):
         test_cursor = TestMongoCursor()
 
         self.mox.StubOutWithMock(self.db_adapter, 'get_listings_collection')
-        self.db_adapter.get_listings_collection().AndReturn(test_collection)
+        self.db_adapter.get_listings_collection(
+            write_concern_profile=db_service.WRITE_CONCERN_DELETE
+        ).AndReturn(test_collection)
 
         self.mox.StubOutWithMock(test_collection, 'find')
         test_collection.find({'slugs': test_slug}).AndReturn(test_cursor)
@@ -191,7 +1096,9 @@ class DBAdapterTests(mox.MoxTestBase):
         test_cursor = TestMongoCursor()
 
         self.mox.StubOutWithMock(self.db_adapter, 'get_listings_collection')
-        self.db_adapter.get_listings_collection().AndReturn(test_collection)
+        self.db_adapter.get_listings_collection(
+            write_concern_profile=db_service.WRITE_CONCERN_DELETE
+        ).AndReturn(test_collection)
 
         self.mox.StubOutWithMock(test_collection, 'find')
         test_collection.find({'slugs': test_slug}).AndReturn(test_cursor)
@@ -213,7 +1120,9 @@ class DBAdapterTests(mox.MoxTestBase):
         test_cursor = TestMongoCursor()
 
         self.mox.StubOutWithMock(self.db_adapter, 'get_listings_collection')
-        self.db_adapter.get_listings_collection().AndReturn(test_collection)
+        self.db_adapter.get_listings_collection(
+            write_concern_profile=db_service.WRITE_CONCERN_DELETE
+        ).AndReturn(test_collection)
 
         self.mox.StubOutWithMock(test_collection, 'find')
         test_collection.find({'slugs': test_slug}).AndReturn(test_cursor)
@@ -237,7 +1146,9 @@ class DBAdapterTests(mox.MoxTestBase):
         )
 
         self.mox.StubOutWithMock(self.db_adapter, 'get_users_collection')
-        self.db_adapter.get_users_collection().AndReturn(test_collection)
+        self.db_adapter.get_users_collection(
+            write_concern_profile=db_service.WRITE_CONCERN_AUTH
+        ).AndReturn(test_collection)
 
         self.mox.ReplayAll()
 
@@ -248,7 +1159,9 @@ class DBAdapterTests(mox.MoxTestBase):
         test_collection = TestCollection()
 
         self.mox.StubOutWithMock(self.db_adapter, 'get_users_collection')
-        self.db_adapter.get_users_collection().AndReturn(test_collection)
+        self.db_adapter.get_users_collection(
+            write_concern_profile=db_service.WRITE_CONCERN_AUTH
+        ).AndReturn(test_collection)
 
         self.mox.ReplayAll()
 
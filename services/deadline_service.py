@@ -0,0 +1,73 @@
+"""Request scoped deadlines for database calls.
+
+A deadline is set for the current thread at the start of a request (see the
+public blueprint) and every DBAdapter query made before it is cleared is sent
+with maxTimeMS set to the time remaining, so that no single query can hold a
+worker past the request's budget.
+
+@license: GNU GPLv3
+"""
+import threading
+import time
+
+local = threading.local()
+
+
+class DeadlineExceeded(Exception):
+    """Raised instead of starting a query after the deadline has passed."""
+    pass
+
+
+def set_deadline(deadline):
+    """Set the deadline for the current thread.
+
+    @param deadline: The time (as from time.time) by which database calls
+        made on this thread must finish or None to remove the deadline.
+    @type deadline: float
+    """
+    local.deadline = deadline
+
+
+def set_timeout(timeout_ms):
+    """Set the deadline for the current thread relative to now.
+
+    @param timeout_ms: The number of milliseconds from now until the deadline
+        or None to remove the deadline.
+    @type timeout_ms: float
+    """
+    if timeout_ms == None:
+        set_deadline(None)
+    else:
+        set_deadline(time.time() + timeout_ms / 1000.0)
+
+
+def clear_deadline():
+    """Remove the deadline for the current thread."""
+    set_deadline(None)
+
+
+def get_deadline():
+    """Get the deadline for the current thread.
+
+    @return: The deadline as from time.time or None if there is no deadline.
+    @rtype: float
+    """
+    return getattr(local, 'deadline', None)
+
+
+def get_remaining_ms():
+    """Get the time left before the current thread's deadline.
+
+    @return: The number of whole milliseconds left (at least 1) or None if
+        there is no deadline.
+    @rtype: int
+    @raise DeadlineExceeded: Raised if the deadline has already passed.
+    """
+    deadline = get_deadline()
+    if deadline == None:
+        return None
+
+    remaining_ms = int((deadline - time.time()) * 1000)
+    if remaining_ms <= 0:
+        raise DeadlineExceeded('The request deadline has passed.')
+    return remaining_ms
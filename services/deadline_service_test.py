@@ -0,0 +1,36 @@
+"""Tests for deadline_service.
+
+@license: GNU GPLv3
+"""
+import time
+
+import mox
+
+import deadline_service
+
+
+class DeadlineServiceTests(mox.MoxTestBase):
+
+    def tearDown(self):
+        deadline_service.clear_deadline()
+        mox.MoxTestBase.tearDown(self)
+
+    def test_no_deadline(self):
+        self.assertEqual(None, deadline_service.get_deadline())
+        self.assertEqual(None, deadline_service.get_remaining_ms())
+
+    def test_get_remaining_ms(self):
+        self.mox.StubOutWithMock(time, 'time')
+        time.time().AndReturn(100)
+        time.time().AndReturn(100.25)
+        self.mox.ReplayAll()
+
+        deadline_service.set_timeout(500)
+        self.assertEqual(100.5, deadline_service.get_deadline())
+        self.assertEqual(250, deadline_service.get_remaining_ms())
+
+    def test_get_remaining_ms_after_deadline(self):
+        deadline_service.set_deadline(time.time() - 1)
+        with self.assertRaises(deadline_service.DeadlineExceeded):
+            deadline_service.get_remaining_ms()
+
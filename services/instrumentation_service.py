@@ -0,0 +1,224 @@
+"""Timing, result counts and a slow query log for database adapter calls.
+
+Adapter methods decorated with instrumented report a query event for each
+call to every registered sink. A sink is any function taking the event dict:
+
+    {
+        'operation': 'list_listings_by_slug',
+        'duration_ms': 12.5,
+        'documents': 50,
+        'error': None,
+        'slow': False,
+        'explain': None
+    }
+
+Calls slower than MONGO_SLOW_QUERY_MS are also logged as warnings to the
+"tinyclassified.slow_queries" logger and, if MONGO_SLOW_QUERY_EXPLAIN is set,
+the query plans of the commands they sent are attached to the event and log.
+
+@license: GNU GPLv3
+"""
+import collections
+import functools
+import logging
+import threading
+import time
+
+from bson import son
+from pymongo import monitoring
+
+try:
+    from tinyclassified import tiny_classified
+except:
+    import tiny_classified
+
+SLOW_QUERY_LOGGER_NAME = 'tinyclassified.slow_queries'
+
+# Commands that mongodb can explain.
+EXPLAINABLE_COMMANDS = [
+    'aggregate',
+    'count',
+    'delete',
+    'distinct',
+    'find',
+    'findAndModify',
+    'update'
+]
+
+QUERY_SINKS = []
+
+local = threading.local()
+
+
+def add_query_sink(sink):
+    """Start sending query events to a sink.
+
+    @param sink: Function called with the event dict of every instrumented
+        call. It is called on the thread making the call so it should be fast.
+    @type sink: function
+    """
+    QUERY_SINKS.append(sink)
+
+
+def remove_query_sink(sink):
+    """Stop sending query events to a sink.
+
+    @param sink: A sink previously passed to add_query_sink.
+    @type sink: function
+    """
+    if sink in QUERY_SINKS:
+        QUERY_SINKS.remove(sink)
+
+
+def count_documents(result):
+    """Count the documents in an adapter method's return value.
+
+    @param result: The value returned by the adapter method.
+    @type result: object
+    @return: The number of documents in a list result, 1 for a single
+        document (any mapping, like a dict or a bson.raw_bson.RawBSONDocument),
+        0 for None or None if the result is not made of documents.
+    @rtype: int
+    """
+    if result is None:
+        return 0
+    if isinstance(result, collections.Mapping):
+        return 1
+    if isinstance(result, list):
+        return len(result)
+    return None
+
+
+class CommandCaptureListener(monitoring.CommandListener):
+    """Command listener keeping the commands sent by instrumented calls.
+
+    Commands are only kept on threads in the middle of an instrumented call
+    (so that explain is not run on unrelated traffic) and only until that call
+    finishes.
+    """
+
+    def started(self, event):
+        commands = getattr(local, 'commands', None)
+        if commands != None and event.command_name in EXPLAINABLE_COMMANDS:
+            commands.append(son.SON(
+                (key, value) for (key, value) in event.command.items()
+                if not key.startswith('$') and key != 'lsid'
+            ))
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+def get_slow_query_threshold():
+    """Get the duration in milliseconds after which a call is slow.
+
+    @return: The value of MONGO_SLOW_QUERY_MS or None if slow queries are not
+        logged.
+    @rtype: float
+    """
+    return tiny_classified.get_config().get('MONGO_SLOW_QUERY_MS', None)
+
+
+def explain_commands(adapter, commands):
+    """Get the query plans for commands sent by a slow call.
+
+    @param adapter: The adapter which sent the commands.
+    @type adapter: db_service.DBAdapter
+    @param commands: The commands to explain.
+    @type commands: list of bson.son.SON
+    @return: The queryPlanner explain output of each command or, if explain
+        failed, a description of the error.
+    @rtype: list
+    """
+    database = adapter.get_database()
+    plans = []
+    for command in commands:
+        try:
+            plans.append(database.command(son.SON([
+                ('explain', command),
+                ('verbosity', 'queryPlanner')
+            ])))
+        except Exception as e:
+            plans.append({'error': str(e)})
+    return plans
+
+
+def report(adapter, operation, duration_ms, result, error, commands):
+    """Build the event for a finished call and send it to the sinks.
+
+    @param adapter: The adapter whose method was called.
+    @type adapter: db_service.DBAdapter
+    @param operation: The name of the method.
+    @type operation: str
+    @param duration_ms: How long the call took in milliseconds.
+    @type duration_ms: float
+    @param result: The value returned by the call.
+    @type result: object
+    @param error: The exception raised by the call or None if it succeeded.
+    @type error: Exception
+    @param commands: The explainable commands sent during the call.
+    @type commands: list of bson.son.SON
+    """
+    threshold = get_slow_query_threshold()
+    event = {
+        'operation': operation,
+        'duration_ms': duration_ms,
+        'documents': count_documents(result),
+        'error': repr(error) if error else None,
+        'slow': threshold != None and duration_ms >= threshold,
+        'explain': None
+    }
+
+    if event['slow']:
+        config = tiny_classified.get_config()
+        if commands and config.get('MONGO_SLOW_QUERY_EXPLAIN', False):
+            event['explain'] = explain_commands(adapter, commands)
+        logging.getLogger(SLOW_QUERY_LOGGER_NAME).warning(
+            'Slow query %s took %.1f ms and returned %s documents. %s %s',
+            operation,
+            duration_ms,
+            event['documents'],
+            event['error'] or '',
+            event['explain'] or ''
+        )
+
+    for sink in list(QUERY_SINKS):
+        sink(event)
+
+
+def instrumented(method):
+    """Decorate an adapter method so that its calls are reported.
+
+    Only the outermost instrumented call on a thread is reported so that an
+    adapter method built from other adapter methods counts once.
+
+    @param method: The adapter method to decorate.
+    @type method: function
+    @return: The decorated method.
+    @rtype: function
+    """
+    @functools.wraps(method)
+    def instrumented_method(self, *args, **kwargs):
+        if getattr(local, 'commands', None) != None:
+            return method(self, *args, **kwargs)
+
+        result = None
+        error = None
+        local.commands = []
+        start = time.time()
+        try:
+            result = method(self, *args, **kwargs)
+            return result
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            duration_ms = (time.time() - start) * 1000
+            commands = local.commands
+            local.commands = None
+            report(self, method.__name__, duration_ms, result, error, commands)
+
+    return instrumented_method
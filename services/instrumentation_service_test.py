@@ -0,0 +1,152 @@
+"""Tests for instrumentation_service.
+
+@license: GNU GPLv3
+"""
+import logging
+
+import bson
+import mox
+from bson import raw_bson
+
+try:
+    from tinyclassified import tiny_classified
+except:
+    import tiny_classified
+
+import instrumentation_service
+
+
+class TestCommandEvent:
+    def __init__(self, command_name, command):
+        self.command_name = command_name
+        self.command = command
+
+
+class TestDatabase:
+    def __init__(self):
+        self.commands = []
+
+    def command(self, command):
+        self.commands.append(command)
+        return {'queryPlanner': {'winningPlan': {'stage': 'COLLSCAN'}}}
+
+
+class TestAdapter:
+    def __init__(self):
+        self.database = TestDatabase()
+        self.listener = instrumentation_service.CommandCaptureListener()
+
+    def get_database(self):
+        return self.database
+
+    @instrumentation_service.instrumented
+    def find_listings(self, count):
+        self.listener.started(TestCommandEvent('find', {
+            'find': 'listing',
+            'filter': {'name': 'test'},
+            'lsid': {'id': 1},
+            '$db': 'tiny_classified'
+        }))
+        return [{'name': 'test'}] * count
+
+    @instrumentation_service.instrumented
+    def find_listings_twice(self):
+        return self.find_listings(1) + self.find_listings(1)
+
+    @instrumentation_service.instrumented
+    def fail(self):
+        raise ValueError('test')
+
+
+class InstrumentationServiceTests(mox.MoxTestBase):
+
+    def setUp(self):
+        mox.MoxTestBase.setUp(self)
+        self.events = []
+        instrumentation_service.add_query_sink(self.events.append)
+        self.adapter = TestAdapter()
+        self.config = tiny_classified.get_config()
+        self.original_config = dict(self.config)
+
+    def tearDown(self):
+        instrumentation_service.remove_query_sink(self.events.append)
+        self.config.clear()
+        self.config.update(self.original_config)
+        mox.MoxTestBase.tearDown(self)
+
+    def test_count_documents(self):
+        count_documents = instrumentation_service.count_documents
+        self.assertEqual(0, count_documents(None))
+        self.assertEqual(1, count_documents({'name': 'test'}))
+        raw_document = raw_bson.RawBSONDocument(
+            bson.BSON.encode({'name': 'test'})
+        )
+        self.assertEqual(1, count_documents(raw_document))
+        self.assertEqual(2, count_documents([{}, {}]))
+        self.assertEqual(None, count_documents(True))
+
+    def test_instrumented_reports_to_sinks(self):
+        self.config['MONGO_SLOW_QUERY_MS'] = None
+        result = self.adapter.find_listings(3)
+
+        self.assertEqual(3, len(result))
+        self.assertEqual(1, len(self.events))
+        event = self.events[0]
+        self.assertEqual('find_listings', event['operation'])
+        self.assertEqual(3, event['documents'])
+        self.assertEqual(None, event['error'])
+        self.assertFalse(event['slow'])
+        self.assertTrue(event['duration_ms'] >= 0)
+
+    def test_instrumented_reports_outermost_call_once(self):
+        self.adapter.find_listings_twice()
+        self.assertEqual(['find_listings_twice'],
+            [x['operation'] for x in self.events])
+        self.assertEqual(2, self.events[0]['documents'])
+
+    def test_instrumented_reports_errors(self):
+        with self.assertRaises(ValueError):
+            self.adapter.fail()
+        self.assertTrue('ValueError' in self.events[0]['error'])
+
+    def test_slow_query_logged_with_explain(self):
+        self.config['MONGO_SLOW_QUERY_MS'] = 0
+        self.config['MONGO_SLOW_QUERY_EXPLAIN'] = True
+
+        logger = logging.getLogger(
+            instrumentation_service.SLOW_QUERY_LOGGER_NAME)
+        self.mox.StubOutWithMock(logger, 'warning')
+        logger.warning(mox.IsA(str), 'find_listings', mox.IsA(float), 1, '',
+            mox.IsA(list))
+        self.mox.ReplayAll()
+
+        self.adapter.find_listings(1)
+
+        event = self.events[0]
+        self.assertTrue(event['slow'])
+        self.assertEqual(1, len(event['explain']))
+        explained = self.adapter.database.commands[0]
+        self.assertEqual('queryPlanner', explained['verbosity'])
+        self.assertEqual(
+            {'find': 'listing', 'filter': {'name': 'test'}},
+            dict(explained['explain'])
+        )
+
+    def test_slow_query_without_explain(self):
+        self.config['MONGO_SLOW_QUERY_MS'] = 0
+        self.config['MONGO_SLOW_QUERY_EXPLAIN'] = False
+
+        self.adapter.find_listings(1)
+
+        self.assertTrue(self.events[0]['slow'])
+        self.assertEqual(None, self.events[0]['explain'])
+        self.assertEqual([], self.adapter.database.commands)
+
+    def test_listener_ignores_commands_outside_calls(self):
+        self.config['MONGO_SLOW_QUERY_MS'] = 0
+        self.config['MONGO_SLOW_QUERY_EXPLAIN'] = True
+
+        self.adapter.listener.started(TestCommandEvent('find', {}))
+        self.adapter.find_listings_twice()
+
+        self.assertEqual(2, len(self.events[0]['explain']))
@@ -0,0 +1,260 @@
+"""Compact listing documents which are decoded only when accessed.
+
+Decoded listings are nested dicts of unicode strings, which in memory are many
+times the size of their BSON encoding (the about section alone is stored as
+four bytes per character). Listing keeps the BSON document as read from the
+database (see db_service.RAW_CODEC_OPTIONS) and decodes it the first time a
+field is used, so listings held by the in-process caches cost little more than
+their encoded size and cached listings which are not read are never decoded.
+
+Listing behaves like a dict for the services, the templates and BSON encoding.
+The json module only serializes real dicts, so use json_default (instead of
+bson.json_util.default) when dumping values which may contain a Listing.
+
+@license: GNU GPLv3
+"""
+import collections
+
+import bson
+from bson import json_util
+from bson import raw_bson
+
+
+class Listing(object):
+    """Mutable mapping over a BSON encoded document.
+
+    The document is decoded on first access and the decoded fields are kept
+    by this instance, so values read from a Listing can be modified in place
+    like those of a dict. Copies of a listing which has not been decoded
+    share its encoded document, which is never modified, and so are cheap and
+    independent of each other.
+
+    collections.MutableMapping is registered rather than subclassed because
+    the Python 2 ABCs do not define __slots__ and subclassing them would give
+    every instance a __dict__.
+    """
+
+    __slots__ = ('raw', 'decoded')
+
+    def __init__(self, document=None):
+        """Create a new listing.
+
+        @keyword document: The fields of the listing, as a dict or a
+            RawBSONDocument (whose BSON is kept without decoding it), or None
+            for an empty listing.
+        @type document: dict
+        """
+        if isinstance(document, raw_bson.RawBSONDocument):
+            self.raw = document.raw
+        else:
+            self.raw = bson.BSON.encode(document or {})
+        self.decoded = None
+
+    def get_decoded(self):
+        """Get the decoded fields, decoding the document on first use.
+
+        @return: The fields of this listing.
+        @rtype: dict
+        """
+        if self.decoded == None:
+            self.decoded = bson.BSON(self.raw).decode()
+        return self.decoded
+
+    def __getitem__(self, key):
+        return self.get_decoded()[key]
+
+    def __setitem__(self, key, value):
+        self.get_decoded()[key] = value
+
+    def __delitem__(self, key):
+        del self.get_decoded()[key]
+
+    def __contains__(self, key):
+        return key in self.get_decoded()
+
+    def __iter__(self):
+        return iter(self.get_decoded())
+
+    def __len__(self):
+        return len(self.get_decoded())
+
+    def __repr__(self):
+        return 'Listing(%r)' % self.to_dict()
+
+    # The remaining dict methods are implemented by the ABCs in terms of the
+    # methods above.
+    get = collections.Mapping.get.im_func
+    keys = collections.Mapping.keys.im_func
+    items = collections.Mapping.items.im_func
+    values = collections.Mapping.values.im_func
+    iterkeys = collections.Mapping.iterkeys.im_func
+    iteritems = collections.Mapping.iteritems.im_func
+    itervalues = collections.Mapping.itervalues.im_func
+    __eq__ = collections.Mapping.__eq__.im_func
+    __ne__ = collections.Mapping.__ne__.im_func
+    __hash__ = None
+    pop = collections.MutableMapping.pop.im_func
+    popitem = collections.MutableMapping.popitem.im_func
+    clear = collections.MutableMapping.clear.im_func
+    update = collections.MutableMapping.update.im_func
+    setdefault = collections.MutableMapping.setdefault.im_func
+
+    def copy(self):
+        """Get an independent copy of this listing.
+
+        A listing which has not been decoded shares its encoded document with
+        the copy. One which has been decoded (and so may have been modified)
+        is encoded again.
+
+        @return: The copy.
+        @rtype: Listing
+        """
+        if self.decoded == None:
+            listing = Listing.__new__(Listing)
+            listing.raw = self.raw
+            listing.decoded = None
+            return listing
+        return Listing(self.decoded)
+
+    __copy__ = copy
+
+    def __deepcopy__(self, memo):
+        return self.copy()
+
+    def get_size(self):
+        """Get the number of bytes taken by the encoded document.
+
+        @return: The size of the encoded document.
+        @rtype: int
+        """
+        return len(self.raw)
+
+    def to_dict(self):
+        """Get the fields of this listing in a new dict.
+
+        The dict shares the decoded values with this listing.
+
+        @return: The listing as a dict.
+        @rtype: dict
+        """
+        return dict(self.get_decoded())
+
+
+collections.MutableMapping.register(Listing)
+
+
+def from_bson(data):
+    """Create a listing from a BSON encoded document.
+
+    @param data: The encoded listing.
+    @type data: str
+    @return: The listing.
+    @rtype: Listing
+    """
+    return Listing(raw_bson.RawBSONDocument(data))
+
+
+def json_default(value):
+    """Serialize values that json cannot, for use as json.dumps' default.
+
+    @param value: The value to serialize.
+    @type value: object
+    @return: JSON serializable version of the value.
+    @rtype: object
+    """
+    if isinstance(value, Listing):
+        return value.to_dict()
+    return json_util.default(value)
+
+
+def freeze_value(value):
+    """Convert the listings (dicts with an "_id") in a value to Listings.
+
+    RawBSONDocuments are converted without decoding them.
+
+    @param value: A listing, None, or a dict or list containing listings.
+    @type value: object
+    @return: The value with every listing replaced by a Listing.
+    @rtype: object
+    """
+    if isinstance(value, Listing):
+        return value.copy()
+    if isinstance(value, raw_bson.RawBSONDocument):
+        return Listing(value)
+    if isinstance(value, dict):
+        if '_id' in value:
+            return Listing(value)
+        return dict((k, freeze_value(v)) for k, v in value.iteritems())
+    if isinstance(value, list):
+        return [freeze_value(x) for x in value]
+    return value
+
+
+def copy_value(value):
+    """Copy a value returned by freeze_value so that it may be modified.
+
+    @param value: A value returned by freeze_value.
+    @type value: object
+    @return: Independent copy of the value.
+    @rtype: object
+    """
+    if isinstance(value, Listing):
+        return value.copy()
+    if isinstance(value, dict):
+        return dict((k, copy_value(v)) for k, v in value.iteritems())
+    if isinstance(value, list):
+        return [copy_value(x) for x in value]
+    return value
+
+
+def load_value(value):
+    """Convert the RawBSONDocuments in a value to Listings.
+
+    RawBSONDocuments are read only, so reads made with
+    db_service.RAW_CODEC_OPTIONS go through this before being returned to
+    code which may modify them.
+
+    @param value: A value which may contain RawBSONDocuments.
+    @type value: object
+    @return: The value with every RawBSONDocument replaced by a Listing.
+    @rtype: object
+    """
+    if isinstance(value, raw_bson.RawBSONDocument):
+        return Listing(value)
+    if isinstance(value, dict):
+        return dict((k, load_value(v)) for k, v in value.iteritems())
+    if isinstance(value, list):
+        return [load_value(x) for x in value]
+    return value
+
+
+def get_value_size(value):
+    """Estimate the number of bytes taken by a value returned by freeze_value.
+
+    @param value: A value returned by freeze_value.
+    @type value: object
+    @return: The encoded size of its listings plus the size of everything
+        else.
+    @rtype: int
+    """
+    if isinstance(value, Listing):
+        return value.get_size()
+    if isinstance(value, dict):
+        return sum(len(k) + get_value_size(v) for k, v in value.iteritems())
+    if isinstance(value, list):
+        return sum(get_value_size(x) for x in value)
+    if isinstance(value, basestring):
+        return len(value)
+    return 8
+
+
+def encode_for_cache(value):
+    """Prepare a listing read for storage in an LRUCache.
+
+    @param value: The value to store.
+    @type value: object
+    @return: The value to store and its size.
+    @rtype: tuple
+    """
+    frozen = freeze_value(value)
+    return (frozen, get_value_size(frozen))
@@ -0,0 +1,131 @@
+"""Tests for listing_model.
+
+@license: GNU GPLv3
+"""
+import collections
+import copy
+import json
+
+import bson
+import mox
+from bson import raw_bson
+
+import listing_model
+
+TEST_ID = bson.ObjectId()
+TEST_DOCUMENT = {
+    '_id': TEST_ID,
+    'name': 'TestName',
+    'about': 'About test listing',
+    'tags': {'cat': ['subcat']},
+    'contact_infos': [{'_id': 0, 'type': 'email', 'value': 'a@example.com'}]
+}
+
+
+class ListingTests(mox.MoxTestBase):
+
+    def setUp(self):
+        mox.MoxTestBase.setUp(self)
+        self.listing = listing_model.Listing(TEST_DOCUMENT)
+
+    def test_behaves_like_dict(self):
+        self.assertTrue(isinstance(self.listing, collections.MutableMapping))
+        self.assertEqual(TEST_DOCUMENT, self.listing)
+        self.assertEqual(TEST_DOCUMENT, dict(self.listing))
+        self.assertEqual(TEST_DOCUMENT, self.listing.to_dict())
+        self.assertEqual(len(TEST_DOCUMENT), len(self.listing))
+        self.assertEqual('TestName', self.listing.get('name'))
+        self.assertEqual(None, self.listing.get('missing'))
+        self.assertTrue('about' in self.listing)
+        self.assertFalse('missing' in self.listing)
+        with self.assertRaises(KeyError):
+            self.listing['missing']
+
+    def test_has_no_dict(self):
+        self.assertFalse(hasattr(self.listing, '__dict__'))
+
+    def test_decodes_on_access(self):
+        self.assertEqual(None, self.listing.decoded)
+        self.assertEqual('TestName', self.listing['name'])
+        self.assertEqual(TEST_DOCUMENT, self.listing.decoded)
+
+    def test_changes(self):
+        self.listing['contact_infos'].append({'_id': 1})
+        self.listing['featured'] = True
+        del self.listing['about']
+
+        self.assertEqual(2, len(self.listing['contact_infos']))
+        self.assertTrue(self.listing['featured'])
+        self.assertFalse('about' in self.listing)
+        self.assertEqual(len(TEST_DOCUMENT), len(self.listing))
+        with self.assertRaises(KeyError):
+            del self.listing['about']
+
+    def test_copy_is_independent(self):
+        self.listing['tags']['cat'].append('other')
+        listing_copy = self.listing.copy()
+        self.listing['tags']['cat'].append('third')
+        del self.listing['name']
+
+        self.assertEqual(['subcat', 'other'], listing_copy['tags']['cat'])
+        self.assertEqual('TestName', listing_copy['name'])
+        self.assertEqual(listing_copy, copy.deepcopy(listing_copy))
+
+    def test_copy_shares_encoded_document(self):
+        listing_copy = self.listing.copy()
+        self.assertTrue(listing_copy.raw is self.listing.raw)
+        self.assertEqual(None, listing_copy.decoded)
+
+    def test_keeps_raw_bson_document(self):
+        data = bson.BSON.encode(TEST_DOCUMENT)
+        listing = listing_model.Listing(raw_bson.RawBSONDocument(data))
+        self.assertTrue(listing.raw is data)
+        self.assertEqual(TEST_DOCUMENT, listing)
+
+    def test_bson_and_json(self):
+        self.assertEqual(
+            TEST_DOCUMENT,
+            bson.BSON(bson.BSON.encode(self.listing)).decode()
+        )
+        self.assertEqual(self.listing, listing_model.from_bson(
+            bson.BSON.encode(TEST_DOCUMENT)))
+
+        expected = json.dumps(TEST_DOCUMENT, default=listing_model.json_default)
+        self.assertEqual(
+            json.loads(expected),
+            json.loads(json.dumps(
+                {'listing': self.listing},
+                default=listing_model.json_default
+            ))['listing']
+        )
+
+    def test_encode_for_cache(self):
+        page = {'listings': [TEST_DOCUMENT], 'next_page_token': 'token'}
+        (frozen, size) = listing_model.encode_for_cache(page)
+
+        self.assertTrue(
+            isinstance(frozen['listings'][0], listing_model.Listing)
+        )
+        self.assertEqual(page, frozen)
+        self.assertTrue(size > frozen['listings'][0].get_size())
+
+        page_copy = listing_model.copy_value(frozen)
+        page_copy['listings'][0]['name'] = 'Changed'
+        self.assertEqual('TestName', frozen['listings'][0]['name'])
+
+    def test_load_value(self):
+        raw_listing = raw_bson.RawBSONDocument(bson.BSON.encode(TEST_DOCUMENT))
+        page = {'listings': [raw_listing], 'next_page_token': None}
+        (frozen, size) = listing_model.encode_for_cache(page)
+        self.assertTrue(frozen['listings'][0].raw is raw_listing.raw)
+
+        loaded = listing_model.load_value(page)
+        self.assertTrue(
+            isinstance(loaded['listings'][0], listing_model.Listing)
+        )
+        loaded['listings'][0]['name'] = 'Changed'
+        self.assertEqual('Changed', loaded['listings'][0]['name'])
+        self.assertEqual(
+            {'listings': [TEST_DOCUMENT], 'next_page_token': None},
+            listing_model.load_value(frozen)
+        )
@@ -3,21 +3,56 @@
 @author: Rory Olsen (rolsen, Gleap LLC 2014)
 @license: GNU GPLv3
 """
+import base64
+import bisect
+import datetime
 import jinja2
+import markdown
 import os
 import re
+import threading
+import time
 
 try:
     from tinyclassified import tiny_classified
 except:
     import tiny_classified
 
+import cache_service
+import category_index_service
+import db_service
+import listing_model
+
 PUBLIC_TEMPLATE_DIR = os.path.join('templates', 'public')
 INDEX_TEMPLATE_PATH = os.path.join(
     PUBLIC_TEMPLATE_DIR,
     'listing_tags_index_inner.html'
 )
 ESCAPED_SLASH = '_slash_'
+DEFAULT_PAGE_SIZE = 50
+
+# Category summaries hold at most this many listings (and featured listings) so
+# that they stay far below the 16MB document limit and a write only rebuilds a
+# bounded amount. Later pages are listed from the listings themselves.
+DEFAULT_CATEGORY_SUMMARY_MAX_LISTINGS = 1000
+CATEGORY_SUMMARY_SEQUENCE = 'category_summary_version'
+
+# Near searches page by offset, which costs more the deeper the page, so only
+# this many of the nearest listings can be paged through.
+MAX_NEAR_RESULTS = 1000
+
+# Increment whenever render_about_html would render existing about sections
+# differently (like after upgrading markdown) so that they are rendered again.
+ABOUT_RENDERER_VERSION = 1
+DEFAULT_RERENDER_BATCH_SIZE = 100
+
+# Public reads may be served by secondaries up to
+# MONGO_PUBLIC_MAX_STALENESS_SECONDS behind the primary. Reads of the listings
+# and categories which this process wrote since then go to the primary so that
+# the process sees (and caches) its own writes. Maps listing ids and normalized
+# slugs to the time until which they are read from the primary.
+LOCAL_WRITES = {'ids': {}, 'slugs': {}}
+LOCAL_WRITES_LOCK = threading.Lock()
 
 
 def make_tag_safe(tag):
@@ -61,6 +96,85 @@ def sanitize_tags(listing):
     listing['tags'] = tags
 
 
+def render_about_html(about):
+    """Render a listing about section from markdown to HTML.
+
+    @param about: The markdown about section or None.
+    @type about: str
+    @return: The HTML about section or None if there is no about section.
+    @rtype: str
+    """
+    if not about:
+        return None
+    return markdown.markdown(about)
+
+
+def render_about(listing):
+    """Store the rendered about section of a listing on the listing.
+
+    @param listing: The listing to render and modify.
+    @type listing: dict
+    """
+    listing['about_html'] = render_about_html(listing.get('about', None))
+    listing['about_renderer_version'] = ABOUT_RENDERER_VERSION
+
+
+def get_about_html(listing):
+    """Get the HTML about section of a listing.
+
+    Uses the stored about_html unless it was rendered by another version of
+    the renderer (or not at all), in which case the about section is rendered
+    now.
+
+    @param listing: The listing whose about section to get.
+    @type listing: dict
+    @return: The HTML about section or None if there is no about section.
+    @rtype: str
+    """
+    if listing.get('about_renderer_version', None) == ABOUT_RENDERER_VERSION:
+        return listing.get('about_html', None)
+    return render_about_html(listing.get('about', None))
+
+
+def rerender_abouts(batch_size=DEFAULT_RERENDER_BATCH_SIZE):
+    """Render the about sections which were rendered by another renderer.
+
+    Listings are read in batches in id order. A listing whose about section
+    changes while it is being rendered is skipped as the edit renders it.
+
+    @keyword batch_size: The number of listings to read at a time.
+    @type batch_size: int
+    @return: The number of listings rendered.
+    @rtype: int
+    """
+    db_adapter = tiny_classified.get_db_adapter()
+    cache = cache_service.get_listing_cache()
+    count = 0
+    after_id = None
+    while True:
+        listings = db_adapter.list_stale_about_listings(
+            ABOUT_RENDERER_VERSION,
+            after_id=after_id,
+            limit=batch_size
+        )
+        for listing in listings:
+            about = listing.get('about', None)
+            updated = db_adapter.set_about_html(
+                listing['_id'],
+                about,
+                render_about_html(about),
+                ABOUT_RENDERER_VERSION
+            )
+            if updated:
+                record_local_write([listing['_id']])
+                cache.invalidate_tag(listing['_id'])
+                count += 1
+
+        if len(listings) < batch_size:
+            return count
+        after_id = listings[-1]['_id']
+
+
 def make_slug_safe(slug):
     """Convert / modify a slug substring into a safe version for use in URLs.
 
@@ -90,11 +204,37 @@ def make_slug(tag, subtag, name):
     return safe_tag + '/' + safe_subtag + '/' + safe_name
 
 
+def get_tag_pairs(tags):
+    """Get the normalized (category, subcategory) pairs of a listing's tags.
+
+    @param tags: The listing's tags.
+    @type tags: dict
+    @return: One dict per subcategory with the normalized (casefolded)
+        category and subcategory under "cat" and "sub", used for queries, and
+        their names as tagged under "cat_name" and "sub_name".
+    @rtype: list of dict
+    """
+    normalize = db_service.normalize_slug
+    return [
+        {
+            'cat': normalize(tag),
+            'sub': normalize(subtag),
+            'cat_name': tag,
+            'sub_name': subtag
+        }
+        for (tag, subtaglist) in sorted(tags.items())
+        for subtag in subtaglist
+    ]
+
+
 def calculate_slugs(listing):
     """Calculate and update slugs for a listing.
 
-    Calculate the slugs for a listing based on its tags, then add those slugs to
-    the given listing.
+    Calculate the slugs for a listing based on its tags, then add those slugs
+    and their normalized (casefolded) versions used for prefix searches to the
+    given listing. Also adds the normalized tags used for category and
+    subcategory queries: the listing's categories under "categories" and its
+    (category, subcategory) pairs under "tag_pairs" (see get_tag_pairs).
 
     @param listing: The listing to calculate and modify.
     @type listing: dict
@@ -105,6 +245,45 @@ def calculate_slugs(listing):
             slugs.append(make_slug(tag, subtag, listing['name']))
 
     listing['slugs'] = slugs
+    listing['slugs_normalized'] = [db_service.normalize_slug(x) for x in slugs]
+    listing['categories'] = sorted(set(
+        db_service.normalize_slug(x) for x in listing['tags']
+    ))
+    listing['tag_pairs'] = get_tag_pairs(listing['tags'])
+
+
+def get_location(listing):
+    """Get the point at a listing's latitude and longitude.
+
+    @param listing: The listing with its latitude and longitude, as numbers or
+        as strings (like those saved by the data importer).
+    @type listing: dict
+    @return: The GeoJSON point or None if the listing does not have a valid
+        latitude and longitude.
+    @rtype: dict or None
+    """
+    try:
+        latitude = float(listing.get('latitude', None))
+        longitude = float(listing.get('longitude', None))
+    except (TypeError, ValueError):
+        return None
+
+    if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+        return None
+    return {'type': 'Point', 'coordinates': [longitude, latitude]}
+
+
+def set_location(listing):
+    """Update the location searched by list_near from a listing's coordinates.
+
+    @param listing: The listing to calculate and modify.
+    @type listing: dict
+    """
+    location = get_location(listing)
+    if location == None:
+        listing.pop('location', None)
+    else:
+        listing['location'] = location
 
 
 def ensure_qualified_slug(slug):
@@ -126,25 +305,53 @@ def check_is_qualified_slug(slug):
     """Check if a listing slug is fully qualified or not.
 
     Check if a listing slug is fully qualified or not, where a fully qualified
-    slug looks like this: "category/sub-category/name-of-listing".
+    slug looks like this: "category/sub-category/name-of-listing". Categories
+    and subcategories never contain slashes (see make_tag_safe) but listing
+    names may.
 
     @param slug: The listing slug to check.
     @type slug: str
     @return: True if the slug is fully qualified, False if not
     @rtype: boolean
     """
-    regex = re.compile("^[\w\.\- ]+\/[\w\- \(\)]+\/[\w@\.,\- \(\)]+$")
+    regex = re.compile("^[^/]+/[^/]+/.+$")
     return isinstance(slug, basestring) and regex.match(slug)
 
 
-def index_tags():
+def index_tags(slug=None):
     """List all unique listings tags.
 
+    @keyword slug: If given, only list the tags of listings under this
+        category / sub-category slug.
+    @type slug: str
     @return: listing tags as a list of tag dicts
     @rtype: iterable over dicts
     """
-    listings = tiny_classified.get_db_adapter().get_listings_collection()
-    return listings.distinct('tags')
+    return tiny_classified.get_db_adapter().get_tags(listing_slug=slug)
+
+
+def index_tag_tree(slug=None, home_only=True):
+    """Get the unique categories and subcategories of the published listings.
+
+    Read from the database's normalized tag pairs (see get_tag_pairs) rather
+    than by merging every listing's tags like collect_index_dict.
+
+    @keyword slug: If given, only include the tags of listings under this
+        category / sub-category slug.
+    @type slug: str
+    @keyword home_only: If True, leave out NO_FRONT_PAGE_CATEGORIES.
+    @type home_only: bool
+    @return: Dict from category to its sorted subcategories.
+    @rtype: dict
+    """
+    categories = tiny_classified.get_db_adapter().get_tag_tree(
+        listing_slug=slug
+    )
+    if home_only:
+        to_ignore = tiny_classified.get_config()['NO_FRONT_PAGE_CATEGORIES']
+        for category in to_ignore:
+            categories.pop(category, None)
+    return categories
 
 
 def collect_index_dict(taglists, home_only=True):
@@ -192,14 +399,43 @@ def collect_index_dict(taglists, home_only=True):
     return categories
 
 
+def get_categories(home_only=True):
+    """Get the unique categories and subcategories of all listings.
+
+    Equivalent to index_tag_tree(home_only=home_only) but read from the
+    in-process category index instead of the database.
+
+    @keyword home_only: If True, leave out NO_FRONT_PAGE_CATEGORIES.
+    @type home_only: bool
+    @return: Dict from category to its sorted subcategories. Must not be
+        modified.
+    @rtype: dict
+    """
+    return category_index_service.get_category_index().get_categories(
+        home_only
+    )
+
+
+def get_category_counts(home_only=True):
+    """Get the number of listings in each category and subcategory.
+
+    @keyword home_only: If True, leave out NO_FRONT_PAGE_CATEGORIES.
+    @type home_only: bool
+    @return: Dict from category to a dict with the category's "count" and
+        "subcategories", a dict from subcategory to count. Must not be
+        modified.
+    @rtype: dict
+    """
+    return category_index_service.get_category_index().get_counts(home_only)
+
+
 def index_tags_as_html():
     """List all unique listings tags formatted as an HTML document.
 
     @return: List all unique listings tags formatted as an HTML document.
     @rtype: str
     """
-    tags = index_tags()
-    categories = collect_index_dict(tags)
+    categories = get_categories()
 
     template = None
     with open(INDEX_TEMPLATE_PATH) as f:
@@ -232,23 +468,208 @@ def read_by_slug_as_html():
 def read_by_slug(qualified_slug):
     """Get the listing corresponding to a qualified listing slug.
 
+    This is meant for public pages: the listing may be read from a secondary
+    and so may not reflect writes made by other processes in the last few
+    seconds (writes made by this process are read from the primary, see
+    record_local_write). Author and admin paths should use read_by_email or
+    the adapter directly.
+
+    Slugs found in the category index are fetched by _id. The index may not
+    have seen listings created or renamed by other processes yet, so other
+    slugs (and slugs whose listing was renamed since) are looked up by slug.
+
     @param qualified_slug: A qualified listing slug corresponding to a listing
     @type qualified_slug: str
+    @return: The listing or None if no listing has the slug.
+    @rtype: dict or None
     @raise ValueError: If the given slug is not fully qualified.
     """
     ensure_qualified_slug(qualified_slug)
-    return tiny_classified.get_db_adapter().get_listing_by_slug(qualified_slug)
+    listing_id = None
+    index = category_index_service.get_category_index(wait=False)
+    if index != None:
+        listing_id = index.get_listing_id(qualified_slug)
+
+    def read():
+        db_adapter = tiny_classified.get_db_adapter()
+        primary = check_local_write(qualified_slug, listing_id)
+        if listing_id != None:
+            listing = db_adapter.get_listing_by_id(
+                listing_id,
+                public=True,
+                raw=True,
+                primary=primary
+            )
+            if listing != None and check_is_qualified(listing, qualified_slug):
+                return listing
+        return db_adapter.get_listing_by_slug(
+            qualified_slug,
+            public=True,
+            raw=True,
+            primary=primary
+        )
+
+    cache = cache_service.get_listing_cache()
+    return listing_model.load_value(
+        cache.read_through(('slug', qualified_slug), read, get_listing_ids)
+    )
+
+
+def check_has_listings(slug):
+    """Check if any listings are under a category / sub-category slug.
+
+    Categories in the category index are answered without a query. Others
+    may have been created by another process since the index was built (or
+    the index may not be built yet), so unless the slug could not name a
+    category one of its published listings is looked up. The category
+    summaries are not used as they may not have been built yet.
+
+    @param slug: The category or category / sub-category slug.
+    @type slug: str
+    @return: True if at least one listing is under the slug.
+    @rtype: bool
+    """
+    summary_id = get_summary_id(slug)
+    parts = summary_id.split('/')
+    if len(parts) > 2 or '' in parts:
+        return False
+
+    index = category_index_service.get_category_index(wait=False)
+    if index != None and index.has_listings(summary_id):
+        return True
+    listings = tiny_classified.get_db_adapter().list_listings_by_slug(
+        summary_id,
+        fields=['_id'],
+        limit=1
+    )
+    return len(listings) > 0
 
 
 def read_by_email(email):
     """Get the listing corresponding to a listing author email address
 
+    This is meant for author and admin paths which edit the listing and save
+    it back, so it is read from the primary and never from the listing cache
+    (which may hold a copy older than an edit made in another process).
+
     @param email: A user / author email address or None if not found
     @type email: str or None
     """
-    db_adapter = tiny_classified.get_db_adapter()
-    listing_collection = db_adapter.get_listings_collection()
-    return listing_collection.find_one({'author_email': email})
+    return tiny_classified.get_db_adapter().get_listing_by_email(email)
+
+
+def get_listing_ids(value):
+    """Get the ids of the listings in a cached read for cache invalidation.
+
+    @param value: The result of read_by_slug or list_by_slug.
+    @type value: dict or None
+    @return: The ids of the listings in the value.
+    @rtype: list
+    """
+    if value == None:
+        return []
+    listings = value.get('listings', [value])
+    return [x['_id'] for x in listings if x.get('_id', None) != None]
+
+
+def get_local_write_seconds():
+    """Get for how long public reads of a local write go to the primary.
+
+    @return: The configured MONGO_PUBLIC_MAX_STALENESS_SECONDS or, if it is
+        not configured or unbounded (-1), DEFAULT_PUBLIC_MAX_STALENESS_SECONDS.
+    @rtype: float
+    """
+    seconds = tiny_classified.get_config().get(
+        'MONGO_PUBLIC_MAX_STALENESS_SECONDS',
+        db_service.DEFAULT_PUBLIC_MAX_STALENESS_SECONDS
+    )
+    if seconds < 0:
+        return db_service.DEFAULT_PUBLIC_MAX_STALENESS_SECONDS
+    return seconds
+
+
+def record_local_write(listing_ids=(), slugs=()):
+    """Read listings and slugs from the primary until secondaries catch up.
+
+    @keyword listing_ids: The ids of the listings written.
+    @type listing_ids: iterable over bson.objectid.ObjectId
+    @keyword slugs: The slugs of the listings written, before and after the
+        write, or [''] for every listing.
+    @type slugs: iterable over str
+    """
+    now = time.time()
+    until = now + get_local_write_seconds()
+    with LOCAL_WRITES_LOCK:
+        for writes in LOCAL_WRITES.itervalues():
+            for key in [k for (k, v) in writes.iteritems() if v <= now]:
+                del writes[key]
+        for listing_id in listing_ids:
+            LOCAL_WRITES['ids'][listing_id] = until
+        for slug in slugs:
+            LOCAL_WRITES['slugs'][db_service.normalize_slug(slug)] = until
+
+
+def check_local_write(slug, listing_id=None):
+    """Check if public reads of a slug should go to the primary.
+
+    @param slug: The qualified listing slug or category / subcategory slug to
+        read.
+    @type slug: str
+    @keyword listing_id: The id of the listing to read, if known.
+    @type listing_id: bson.objectid.ObjectId
+    @return: True if this process recently wrote the listing or a listing
+        under (or at) the slug (see record_local_write).
+    @rtype: bool
+    """
+    now = time.time()
+    slug = db_service.normalize_slug(slug)
+    with LOCAL_WRITES_LOCK:
+        if LOCAL_WRITES['ids'].get(listing_id, 0) > now:
+            return True
+        return any(
+            until > now and (x.startswith(slug) or slug.startswith(x))
+            for (x, until) in LOCAL_WRITES['slugs'].iteritems()
+        )
+
+
+def clear_local_writes():
+    """Forget the local writes recorded by record_local_write."""
+    with LOCAL_WRITES_LOCK:
+        for writes in LOCAL_WRITES.itervalues():
+            writes.clear()
+
+
+def invalidate_cached_listing(listing):
+    """Remove the cached reads which a write to a listing may have changed.
+
+    Removes reads which returned the listing (which covers its previous slugs
+    and categories), reads of its current slugs which may have found nothing
+    before, and pages of the categories it is now in. Reads of the listing
+    and its slugs then go to the primary for a while (see
+    record_local_write).
+
+    @param listing: The listing, as saved or deleted.
+    @type listing: dict
+    """
+    record_local_write(
+        [listing['_id']] if listing.get('_id', None) != None else [],
+        listing.get('slugs', [])
+    )
+    cache = cache_service.get_listing_cache()
+
+    if listing.get('_id', None) != None:
+        cache.invalidate_tag(listing['_id'])
+
+    slugs = listing.get('slugs', [])
+    for slug in slugs:
+        cache.invalidate(('slug', slug))
+
+    normalized_slugs = [db_service.normalize_slug(x) for x in slugs]
+    cache.invalidate_matching(
+        lambda key: key[0] in ('list', 'summary') and any(
+            x.startswith(key[1]) for x in normalized_slugs
+        )
+    )
 
 
 def read_contact_by_id(listing, contact_id):
@@ -268,6 +689,26 @@ def read_contact_by_id(listing, contact_id):
     return None
 
 
+def set_unpublished_on(listing, old_listing=None):
+    """Record when a listing stopped being published.
+
+    Listings which stay unpublished for long are archived (see
+    archive_service), counting from their unpublished_on.
+
+    @param listing: The listing about to be saved.
+    @type listing: dict
+    @keyword old_listing: The listing as saved before or None if new.
+    @type old_listing: dict
+    """
+    if listing.get('is_published', False):
+        listing.pop('unpublished_on', None)
+    elif not listing.get('unpublished_on', None):
+        unpublished_on = None
+        if old_listing:
+            unpublished_on = old_listing.get('unpublished_on', None)
+        listing['unpublished_on'] = unpublished_on or datetime.datetime.utcnow()
+
+
 def update(listing):
     """Update the listing corresponding to a qualified listing slug.
 
@@ -279,9 +720,30 @@ def update(listing):
     if not listing.get('_id', None):
         raise ValueError('Listing not yet saved to database')
 
+    db_adapter = tiny_classified.get_db_adapter()
+    old_listing = db_adapter.get_listing_by_id(listing['_id'])
+    old_slugs = old_listing.get('slugs', []) if old_listing else []
+
+    # Views are counted by view_counter_service, not by edits. Saving never
+    # overwrites a stored count, so the count here is only used when a copy is
+    # inserted: the saved one rather than the editor's, or the archived one
+    # for a listing restored from the archive.
+    if old_listing:
+        listing.pop('views', None)
+        if 'views' in old_listing:
+            listing['views'] = old_listing['views']
+
     sanitize_tags(listing)
     calculate_slugs(listing)
-    tiny_classified.get_db_adapter().upsert_listing(listing)
+    render_about(listing)
+    set_location(listing)
+    set_unpublished_on(listing, old_listing)
+    db_adapter.upsert_listing(listing)
+    publish(listing)
+    refresh_category_summaries(old_slugs + listing['slugs'])
+    record_local_write(slugs=old_slugs)
+    invalidate_cached_listing(listing)
+    category_index_service.update_listing(listing)
 
 
 def delete_by_slug(qualified_slug):
@@ -292,7 +754,14 @@ def delete_by_slug(qualified_slug):
     @raise ValueError: If the given slug is not fully qualified.
     """
     ensure_qualified_slug(qualified_slug)
-    tiny_classified.get_db_adapter().delete_listing_by_slug(qualified_slug)
+    db_adapter = tiny_classified.get_db_adapter()
+    listing = db_adapter.get_listing_by_slug(qualified_slug)
+    db_adapter.delete_listing_by_slug(qualified_slug)
+    if listing:
+        db_adapter.delete_public_listing(listing['_id'])
+        refresh_category_summaries(listing.get('slugs', []))
+        invalidate_cached_listing(listing)
+        category_index_service.remove_listing(listing['_id'])
 
 
 def delete(listing):
@@ -306,8 +775,12 @@ def delete(listing):
     """
     listing_id = listing.get('_id', None)
     if listing_id:
-        collection = tiny_classified.get_db_adapter().get_listings_collection()
-        collection.remove(listing_id)
+        db_adapter = tiny_classified.get_db_adapter()
+        db_adapter.delete_listing(listing_id)
+        db_adapter.delete_public_listing(listing_id)
+        refresh_category_summaries(listing.get('slugs', []))
+        invalidate_cached_listing(listing)
+        category_index_service.remove_listing(listing_id)
 
 
 def create(listing):
@@ -325,25 +798,489 @@ def create(listing):
 
     sanitize_tags(listing)
     calculate_slugs(listing)
+    render_about(listing)
+    set_location(listing)
+    set_unpublished_on(listing)
     tiny_classified.get_db_adapter().upsert_listing(listing)
+    publish(listing)
+    refresh_category_summaries(listing['slugs'])
+    invalidate_cached_listing(listing)
+    category_index_service.update_listing(listing)
+
+
+def publish(listing):
+    """Update the public read model after a listing is saved.
+
+    Published listings are copied to the public read model and listings which
+    are not (or no longer) published are removed from it.
+
+    @param listing: The saved listing.
+    @type listing: dict
+    """
+    db_adapter = tiny_classified.get_db_adapter()
+    if listing.get('is_published', False):
+        db_adapter.upsert_public_listing(listing)
+    else:
+        db_adapter.delete_public_listing(listing['_id'])
+
+
+def rebuild_public_listings(batch_size=db_service.DEFAULT_BULK_BATCH_SIZE):
+    """Rebuild the public read model from all of the saved listings.
+
+    Listings are read in batches in id order, limited to their public fields,
+    and each batch is published with one bulk write.
+
+    @keyword batch_size: The number of listings to read and write at a time.
+    @type batch_size: int
+    @return: The number of published listings.
+    @rtype: int
+    """
+    db_adapter = tiny_classified.get_db_adapter()
+    fields = db_service.PUBLIC_LISTING_FIELDS + ['is_published']
+    published_ids = set()
+    after_id = None
+    while True:
+        listings = db_adapter.list_listing_batch(
+            fields=fields,
+            after_id=after_id,
+            limit=batch_size
+        )
+        db_adapter.bulk_publish_listings(listings, batch_size=batch_size)
+        published_ids.update(
+            x['_id'] for x in listings if x.get('is_published', False)
+        )
+        if len(listings) < batch_size:
+            break
+        after_id = listings[-1]['_id']
+
+    db_adapter.bulk_publish_listings(
+        [
+            x for x in db_adapter.index_listings(fields=['_id'], public=True)
+            if not x['_id'] in published_ids
+        ],
+        batch_size=batch_size
+    )
+    return len(published_ids)
+
+
+def create_many(listings, batch_size=db_service.DEFAULT_BULK_BATCH_SIZE):
+    """Create many new listings at once using batched bulk writes.
+
+    Unlike create, listings are not checked for existing names one by one.
+    Duplicate names are instead reported by the database's unique name index.
+
+    @param listings: The new listings to save.
+    @type listings: iterable over dict
+    @keyword batch_size: The maximum number of listings per bulk write.
+    @type batch_size: int
+    @return: One entry per listing: None if the listing was saved or a message
+        describing why it was not.
+    @rtype: list
+    """
+    def prepare(listing):
+        sanitize_tags(listing)
+        calculate_slugs(listing)
+        render_about(listing)
+        set_location(listing)
+        set_unpublished_on(listing)
+        return listing
 
+    db_adapter = tiny_classified.get_db_adapter()
+    listings = [prepare(listing) for listing in listings]
+    results = db_adapter.bulk_upsert_listings(listings, batch_size=batch_size)
+    db_adapter.bulk_publish_listings(
+        [x for (x, result) in zip(listings, results) if result == None],
+        batch_size=batch_size
+    )
+    rebuild_category_summaries()
+    record_local_write(slugs=[''])
+    cache_service.get_listing_cache().clear()
+    category_index_service.reset()
+    return results
+
+
+def encode_page_token(name):
+    """Encode the name of the last listing on a page as a URL-safe page token.
+
+    @param name: The name of the last listing on the previous page.
+    @type name: str
+    @return: Opaque token for requesting the page after that listing.
+    @rtype: str
+    """
+    if isinstance(name, unicode):
+        name = name.encode('utf-8')
+    return base64.urlsafe_b64encode(name).rstrip('=')
 
-def list_by_slug(slug):
-    """Determines if a specific listing should be returned or a listing index.
 
-    If this slug refers to a specific listing, returns that single listing.
-    Otherwise, returns a list of listings that have this slug as their prefix
-    or, in other words, the listings under the category / sub-category that
-    this slug refers to.
+def decode_page_token(page_token):
+    """Decode a page token created by encode_page_token.
+
+    @param page_token: The token to decode.
+    @type page_token: str
+    @return: The name of the last listing on the previous page.
+    @rtype: unicode
+    @raise ValueError: If the page token is malformed.
+    """
+    try:
+        page_token = str(page_token)
+        padding = '=' * (-len(page_token) % 4)
+        return base64.urlsafe_b64decode(page_token + padding).decode('utf-8')
+    except (TypeError, UnicodeError):
+        raise ValueError('Invalid page token %s' % page_token)
+
+
+def get_page_size():
+    """Get the number of listings to show per category page.
+
+    @return: The configured LISTINGS_PAGE_SIZE or DEFAULT_PAGE_SIZE.
+    @rtype: int
+    """
+    return tiny_classified.get_config().get(
+        'LISTINGS_PAGE_SIZE',
+        DEFAULT_PAGE_SIZE
+    )
+
+
+def list_by_slug(slug, page_token=None, page_size=None):
+    """List a page of listing summaries under a category / sub-category slug.
+
+    Returns the listings that have this slug as their prefix or, in other
+    words, the listings under the category / sub-category that this slug refers
+    to, ordered by name. Only the fields in db_service.LISTING_SUMMARY_FIELDS
+    are returned; use read_by_slug to get an entire listing.
+
+    Pages are keyed by the last listing name of the previous page so each page
+    costs the same regardless of how deep into the category it is and pages
+    stay stable when listings are added or removed before them.
 
     @param slug: The slug to look up.
     @type slug: str
-    @return: The individual listing or the list of listings at this slug. Will
-        be a list if this refers to a cateogry / sub-category. Will be a list of
-        one element if this slug refers to a single listing.
-    @rtype: list
+    @keyword page_token: The next_page_token of the previous page or None for
+        the first page.
+    @type page_token: str
+    @keyword page_size: The maximum number of listings in the page or None to
+        use get_page_size().
+    @type page_size: int
+    @return: Dict with the page of listing summaries under 'listings' and the
+        token for the following page (or None if this is the last page) under
+        'next_page_token'.
+    @rtype: dict
+    @raise ValueError: If the page token is malformed.
+    """
+    if page_size == None:
+        page_size = get_page_size()
+
+    after_name = None
+    if page_token:
+        after_name = decode_page_token(page_token)
+
+    def read():
+        listings = list(tiny_classified.get_db_adapter().list_listings_by_slug(
+            slug,
+            fields=db_service.LISTING_SUMMARY_FIELDS,
+            after_name=after_name,
+            limit=page_size + 1,
+            public=not check_local_write(slug),
+            raw=True
+        ))
+
+        next_page_token = None
+        if len(listings) > page_size:
+            listings = listings[:page_size]
+            next_page_token = encode_page_token(listings[-1]['name'])
+
+        return {'listings': listings, 'next_page_token': next_page_token}
+
+    cache = cache_service.get_listing_cache()
+    return listing_model.load_value(cache.read_through(
+        ('list', db_service.normalize_slug(slug), after_name, page_size),
+        read,
+        get_listing_ids
+    ))
+
+
+def get_summary_id(slug):
+    """Get the id of the summary of a category or category / subcategory.
+
+    @param slug: The category or category / subcategory slug.
+    @type slug: str
+    @return: The normalized slug without a trailing slash.
+    @rtype: str
+    """
+    return db_service.normalize_slug(slug).rstrip('/')
+
+
+def get_category_summary_max_listings():
+    """Get the maximum number of listings to store in a category summary.
+
+    @return: The configured CATEGORY_SUMMARY_MAX_LISTINGS or
+        DEFAULT_CATEGORY_SUMMARY_MAX_LISTINGS.
+    @rtype: int
+    """
+    return tiny_classified.get_config().get(
+        'CATEGORY_SUMMARY_MAX_LISTINGS',
+        DEFAULT_CATEGORY_SUMMARY_MAX_LISTINGS
+    )
+
+
+def build_category_summary(summary_id, public=False):
+    """Build the summary of a category or subcategory from its listings.
+
+    A summary holds the summaries (db_service.LISTING_SUMMARY_FIELDS) of the
+    first listings under the category ordered by name, those of its first
+    featured listings and, for categories, the sorted names of its
+    subcategories. At most get_category_summary_max_listings() of each are
+    kept and "truncated" tells if there are more listings.
+
+    @param summary_id: The id of the summary (see get_summary_id).
+    @type summary_id: str
+    @keyword public: If True, read the listings from a secondary. Summaries
+        to be stored must be built from the primary.
+    @type public: bool
+    @return: The summary or None if there are no listings under the category.
+    @rtype: dict
+    """
+    db_adapter = tiny_classified.get_db_adapter()
+    max_listings = get_category_summary_max_listings()
+    listings = db_adapter.list_listings_by_slug(
+        summary_id,
+        fields=db_service.LISTING_SUMMARY_FIELDS,
+        limit=max_listings + 1,
+        public=public
+    )
+    if not listings:
+        return None
+
+    featured = db_adapter.list_featured_listings_by_slug(
+        summary_id,
+        fields=db_service.LISTING_SUMMARY_FIELDS,
+        limit=max_listings,
+        public=public
+    )
+
+    subcategories = set()
+    if not '/' in summary_id:
+        tag_tree = db_adapter.get_tag_tree(summary_id, public=public)
+        for category, names in tag_tree.items():
+            if db_service.normalize_slug(category) == summary_id:
+                subcategories.update(names)
+
+    return {
+        '_id': summary_id,
+        'listings': listings[:max_listings],
+        'featured': featured,
+        'subcategories': sorted(subcategories),
+        'truncated': len(listings) > max_listings
+    }
+
+
+def refresh_category_summaries(slugs):
+    """Rebuild the summaries of the categories and subcategories of slugs.
+
+    Called after a listing is written with its old and new slugs. Only the
+    summaries of those categories are rebuilt.
+
+    The summaries get a version from a counter taken after the listing was
+    written and before they are built, so a summary with a later version
+    was built from newer listings. The adapter only replaces a summary with
+    a later version, which keeps concurrent writers' summaries from landing
+    out of order. Categories left without listings get an empty summary
+    rather than none, which an older summary can not replace either.
+
+    @param slugs: Qualified listing slugs.
+    @type slugs: iterable over str
+    """
+    summary_ids = set()
+    for slug in slugs:
+        summary_ids.update(category_index_service.get_slug_prefixes(slug))
+    if not summary_ids:
+        return
+
+    db_adapter = tiny_classified.get_db_adapter()
+    version = db_adapter.get_next_sequence(CATEGORY_SUMMARY_SEQUENCE)
+    for summary_id in sorted(summary_ids):
+        summary = build_category_summary(summary_id)
+        if summary == None:
+            summary = {
+                '_id': summary_id,
+                'listings': [],
+                'featured': [],
+                'subcategories': [],
+                'truncated': False
+            }
+        summary['version'] = version
+        db_adapter.upsert_category_summary(summary)
+
+
+def rebuild_category_summaries():
+    """Rebuild the summaries of every category and subcategory.
+
+    Also deletes the summaries of categories which no longer have listings,
+    unless a listing was added to them during the rebuild.
+    """
+    db_adapter = tiny_classified.get_db_adapter()
+    version = db_adapter.get_next_sequence(CATEGORY_SUMMARY_SEQUENCE)
+    listings = db_adapter.index_listings(fields=['slugs', 'is_published'])
+    slugs = [
+        slug for listing in listings if listing.get('is_published', False)
+        for slug in listing.get('slugs', [])
+    ]
+    refresh_category_summaries(slugs)
+
+    summary_ids = set()
+    for slug in slugs:
+        summary_ids.update(category_index_service.get_slug_prefixes(slug))
+    for summary_id in db_adapter.list_category_summary_ids():
+        if not summary_id in summary_ids:
+            db_adapter.delete_category_summary(summary_id, version)
+
+
+def read_category_summary(slug):
+    """Get the summary of a category or category / subcategory slug.
+
+    Falls back to building the summary from the listings if it has not been
+    stored yet (see setup_db.py category_summaries).
+
+    @param slug: The category or category / subcategory slug.
+    @type slug: str
+    @return: The summary (see build_category_summary) or None if there are no
+        listings under the slug.
+    @rtype: dict
+    """
+    summary_id = get_summary_id(slug)
+
+    def read():
+        public = not check_local_write(summary_id)
+        summary = tiny_classified.get_db_adapter().get_category_summary(
+            summary_id,
+            public=public,
+            raw=True
+        )
+        if summary == None:
+            summary = build_category_summary(summary_id, public=public)
+        return summary
+
+    cache = cache_service.get_listing_cache()
+    return listing_model.load_value(
+        cache.read_through(('summary', summary_id), read, get_listing_ids)
+    )
+
+
+def get_summary_page(summary, page_token=None, page_size=None):
+    """Get a page of the listings of a category summary.
+
+    Pages are the same as those of list_by_slug, which lists the pages past
+    the end of truncated summaries.
+
+    @param summary: The summary from read_category_summary.
+    @type summary: dict
+    @keyword page_token: The next_page_token of the previous page or None for
+        the first page.
+    @type page_token: str
+    @keyword page_size: The maximum number of listings in the page or None to
+        use get_page_size().
+    @type page_size: int
+    @return: Dict with the page of listing summaries under 'listings' and the
+        token for the following page (or None) under 'next_page_token'.
+    @rtype: dict
+    @raise ValueError: If the page token is malformed.
+    """
+    if page_size == None:
+        page_size = get_page_size()
+
+    listings = summary['listings']
+    start = 0
+    if page_token:
+        after_name = decode_page_token(page_token)
+        names = [x['name'] for x in listings]
+        start = bisect.bisect_right(names, after_name)
+
+    if summary.get('truncated', False) and start + page_size >= len(listings):
+        return list_by_slug(
+            summary['_id'],
+            page_token=page_token,
+            page_size=page_size
+        )
+
+    page = listings[start:start + page_size]
+    next_page_token = None
+    if start + page_size < len(listings):
+        next_page_token = encode_page_token(page[-1]['name'])
+
+    return {'listings': page, 'next_page_token': next_page_token}
+
+
+def list_near(latitude, longitude, slug=None, radius=None, page=0,
+    page_size=None):
+    """List a page of the published listings nearest to a point.
+
+    The distances are calculated and sorted by the database's geospatial
+    index on the listings' locations (see set_location).
+
+    @param latitude: The latitude of the point in degrees.
+    @type latitude: float
+    @param longitude: The longitude of the point in degrees.
+    @type longitude: float
+    @keyword slug: If given, only list listings with slugs beginning with
+        this category / sub-category slug.
+    @type slug: str
+    @keyword radius: If given, only list listings at most this many meters
+        away.
+    @type radius: float
+    @keyword page: The number of the page, starting from 0.
+    @type page: int
+    @keyword page_size: The maximum number of listings in the page or None to
+        use get_page_size().
+    @type page_size: int
+    @return: Dict with the page of listing summaries, with their address and
+        their distance in meters under "distance", nearest first, under
+        'listings' and the number of the following page (or None if this is
+        the last page) under 'next_page'.
+    @rtype: dict
+    @raise ValueError: If the point, radius or page is invalid.
+    """
+    if page_size == None:
+        page_size = get_page_size()
+
+    if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+        raise ValueError('Invalid point %s, %s' % (latitude, longitude))
+    if radius != None and not radius > 0:
+        raise ValueError('Invalid radius %s' % radius)
+    skip = page * page_size
+    if page < 0 or skip + page_size > MAX_NEAR_RESULTS:
+        raise ValueError('Invalid page %s' % page)
+
+    listings = tiny_classified.get_db_adapter().list_listings_near(
+        longitude,
+        latitude,
+        listing_slug=slug,
+        max_distance=radius,
+        fields=db_service.LISTING_SUMMARY_FIELDS + ['address'],
+        skip=skip,
+        limit=page_size + 1
+    )
+
+    next_page = None
+    if len(listings) > page_size:
+        listings = listings[:page_size]
+        if skip + 2 * page_size <= MAX_NEAR_RESULTS:
+            next_page = page + 1
+
+    return {'listings': listings, 'next_page': next_page}
+
+
+def list_featured_by_slug(slug):
+    """List summaries of the featured listings under a slug.
+
+    @param slug: The category / sub-category slug to look up.
+    @type slug: str
+    @return: Summaries of the featured listings ordered by name.
+    @rtype: list of dict
     """
-    return tiny_classified.get_db_adapter().list_listings_by_slug(slug)
+    return list(tiny_classified.get_db_adapter().list_featured_listings_by_slug(
+        slug,
+        fields=db_service.LISTING_SUMMARY_FIELDS
+    ))
 
 
 def get_slug(listing, category):
@@ -381,5 +1318,8 @@ def create_default_listing_for_user(email):
         'about': 'About section',
         'tags': []
     }
+    render_about(listing)
     tiny_classified.get_db_adapter().upsert_listing(listing)
+    invalidate_cached_listing(listing)
+    category_index_service.update_listing(listing)
     return listing
@@ -4,9 +4,13 @@
 @license: GNU GPLv3
 """
 import copy
+import datetime
 import mox
 import pymongo
 
+import bson
+from bson import raw_bson
+
 
 try:
     from tinyclassified import tiny_classified
@@ -15,8 +19,12 @@ except:
     import tiny_classified
     import controllers
 
+import cache_service
+import category_index_service
 import db_service
+import listing_model
 import listing_service
+import memory_db_service
 
 ALL_CHARS_STR = '0123456789:;<=>?@ABCDEFGHIJKLMNOPQRSTUVWXYZ[\\]\
 ^_`abcdefghijklmnopqrstuvwxyz/'
@@ -38,6 +46,7 @@ TEST_TAGS_MULTIPLE_TAGS = {
     TEST_TAG2: [TEST_SUBTAG3]
 }
 TEST_SLUG1 = 'cat1/subcat1/TestName'
+TEST_ID = 'someid'
 
 TEST_LISTING = {
     'author_email': TEST_EMAIL,
@@ -76,6 +85,30 @@ TEST_LISTING_SLUGS_ONLY = {
 
 class ListingServiceTests(mox.MoxTestBase):
 
+    def setUp(self):
+        mox.MoxTestBase.setUp(self)
+        cache_service.CACHES['listing'] = cache_service.LRUCache(0, 0, 0)
+        listing_service.clear_local_writes()
+        self.original_db_adapter = tiny_classified.get_db_adapter()
+        indexed_listing = copy.deepcopy(TEST_LISTING)
+        indexed_listing['_id'] = TEST_ID
+        category_index_service.INDEXES['category'] = (
+            category_index_service.CategoryIndex([indexed_listing]))
+
+    def tearDown(self):
+        category_index_service.reset()
+        tiny_classified.set_db_adapter(self.original_db_adapter)
+        mox.MoxTestBase.tearDown(self)
+
+    def enable_cache(self):
+        cache_service.CACHES['listing'] = cache_service.LRUCache(
+            10,
+            4096,
+            60,
+            encode=listing_model.encode_for_cache,
+            decode=listing_model.copy_value
+        )
+
     def test_make_tag_safe_simple(self):
         result = listing_service.make_tag_safe(ALL_CHARS_STR)
         self.assertEqual(ALL_CHARS_STR_SAFE, result)
@@ -172,6 +205,38 @@ class ListingServiceTests(mox.MoxTestBase):
 
         listing_service.calculate_slugs(test_listing)
         self.assertEqual(['cat1/subcat1/TestName'], test_listing['slugs'])
+        self.assertEqual(
+            ['cat1/subcat1/testname'],
+            test_listing['slugs_normalized']
+        )
+
+    def test_calculate_slugs_tag_fields(self):
+        test_listing = {'name': 'A', 'tags': {'Food': ['Pizza', 'Tacos']}}
+        listing_service.calculate_slugs(test_listing)
+        self.assertEqual(['food'], test_listing['categories'])
+        self.assertEqual(
+            [
+                {'cat': 'food', 'sub': 'pizza', 'cat_name': 'Food',
+                    'sub_name': 'Pizza'},
+                {'cat': 'food', 'sub': 'tacos', 'cat_name': 'Food',
+                    'sub_name': 'Tacos'}
+            ],
+            test_listing['tag_pairs']
+        )
+
+    def test_index_tag_tree(self):
+        self.mox.StubOutWithMock(tiny_classified, 'get_config')
+        tiny_classified.get_config().AndReturn(
+            {'NO_FRONT_PAGE_CATEGORIES': ['Shops']})
+
+        test_db_adapter = self.mox.CreateMock(db_service.DBAdapter)
+        test_db_adapter.get_tag_tree(listing_slug=None).AndReturn(
+            {'Food': ['Pizza'], 'Shops': ['Books']})
+        tiny_classified.set_db_adapter(test_db_adapter)
+
+        self.mox.ReplayAll()
+
+        self.assertEqual({'Food': ['Pizza']}, listing_service.index_tag_tree())
 
     def test_calculate_slugs_multiple_subtags(self):
         test_listing = copy.deepcopy(TEST_LISTING)
@@ -262,13 +327,101 @@ class ListingServiceTests(mox.MoxTestBase):
         self.mox.StubOutWithMock(listing_service, 'ensure_qualified_slug')
         listing_service.ensure_qualified_slug(TEST_SLUG1)
 
-        test_db_adapter = mox.Mox().CreateMock(db_service.DBAdapter)
-        test_db_adapter.get_listing_by_slug(TEST_SLUG1)
-        tiny_classified.db_adapter = test_db_adapter
+        test_db_adapter = self.mox.CreateMock(db_service.DBAdapter)
+        test_db_adapter.get_listing_by_id(
+            TEST_ID,
+            public=True,
+            raw=True,
+            primary=False
+        ).AndReturn(raw_bson.RawBSONDocument(bson.BSON.encode(TEST_LISTING)))
+        tiny_classified.set_db_adapter(test_db_adapter)
 
         self.mox.ReplayAll()
 
-        listing_service.read_by_slug(TEST_SLUG1)
+        listing = listing_service.read_by_slug(TEST_SLUG1)
+        self.assertTrue(isinstance(listing, listing_model.Listing))
+        self.assertEqual(TEST_LISTING, listing)
+
+    def test_read_by_slug_unknown_slug(self):
+        test_db_adapter = self.mox.CreateMock(db_service.DBAdapter)
+        test_db_adapter.get_listing_by_slug('cat1/subcat1/No',
+            public=True, raw=True, primary=False).AndReturn(None)
+        tiny_classified.set_db_adapter(test_db_adapter)
+
+        self.mox.ReplayAll()
+
+        self.assertEqual(None, listing_service.read_by_slug('cat1/subcat1/No'))
+
+    def test_read_by_slug_not_yet_indexed(self):
+        new_listing = copy.deepcopy(TEST_LISTING_ALT)
+        category_index_service.reset()
+        self.mox.StubOutWithMock(category_index_service,
+            'rebuild_in_background')
+        category_index_service.rebuild_in_background()
+
+        test_db_adapter = self.mox.CreateMock(db_service.DBAdapter)
+        test_db_adapter.get_listing_by_slug('cat1/subcat1/Alt Listing Name',
+            public=True, raw=True, primary=False).AndReturn(new_listing)
+        tiny_classified.set_db_adapter(test_db_adapter)
+
+        self.mox.ReplayAll()
+
+        self.assertEqual(
+            new_listing,
+            listing_service.read_by_slug('cat1/subcat1/Alt Listing Name')
+        )
+
+    def test_read_by_slug_stale_route(self):
+        renamed_listing = copy.deepcopy(TEST_LISTING)
+        renamed_listing['slugs'] = ['cat1/subcat1/Renamed']
+
+        test_db_adapter = self.mox.CreateMock(db_service.DBAdapter)
+        test_db_adapter.get_listing_by_id(TEST_ID, public=True, raw=True,
+            primary=False).AndReturn(renamed_listing)
+        test_db_adapter.get_listing_by_slug(TEST_SLUG1, public=True, raw=True,
+            primary=False).AndReturn(None)
+        tiny_classified.set_db_adapter(test_db_adapter)
+
+        self.mox.ReplayAll()
+
+        self.assertEqual(None, listing_service.read_by_slug(TEST_SLUG1))
+
+    def test_check_has_listings(self):
+        test_db_adapter = self.mox.CreateMock(db_service.DBAdapter)
+        test_db_adapter.list_listings_by_slug('cat', fields=['_id'],
+            limit=1).AndReturn([])
+        test_db_adapter.list_listings_by_slug('cat1/subcat2', fields=['_id'],
+            limit=1).AndReturn([{'_id': TEST_ID}])
+        tiny_classified.set_db_adapter(test_db_adapter)
+
+        self.mox.ReplayAll()
+
+        self.assertTrue(listing_service.check_has_listings('cat1'))
+        self.assertTrue(listing_service.check_has_listings('CAT1/subcat1/'))
+        self.assertFalse(listing_service.check_has_listings('cat'))
+        self.assertTrue(listing_service.check_has_listings('cat1/subcat2'))
+        self.assertFalse(listing_service.check_has_listings('cat1//subcat2'))
+        self.assertFalse(listing_service.check_has_listings(''))
+
+    def test_check_has_listings_before_summaries(self):
+        adapter = memory_db_service.MemoryDBAdapter()
+        tiny_classified.set_db_adapter(adapter)
+        category_index_service.reset()
+        self.mox.StubOutWithMock(category_index_service,
+            'rebuild_in_background')
+        category_index_service.rebuild_in_background().MultipleTimes()
+
+        listing = {'name': 'A', 'tags': {'Food': ['Pizza']}}
+        listing_service.calculate_slugs(listing)
+        adapter.upsert_listing(listing)
+        adapter.upsert_public_listing(listing)
+
+        self.mox.ReplayAll()
+
+        self.assertEqual(None, adapter.get_category_summary('food'))
+        self.assertTrue(listing_service.check_has_listings('Food'))
+        self.assertTrue(listing_service.check_has_listings('food/pizza'))
+        self.assertFalse(listing_service.check_has_listings('food/tacos'))
 
     def test_read_by_email_not_found(self):
         test_collection = controllers.test_util.TestCollection()
@@ -332,9 +485,27 @@ class ListingServiceTests(mox.MoxTestBase):
         self.mox.StubOutWithMock(listing_service, 'calculate_slugs')
         listing_service.calculate_slugs(test_listing_new)
 
-        test_db_adapter = mox.Mox().CreateMock(db_service.DBAdapter)
+        self.mox.StubOutWithMock(listing_service, 'render_about')
+        listing_service.render_about(test_listing_new)
+
+        old_listing = copy.deepcopy(test_listing_copy)
+        old_listing['slugs'] = ['oldcat/oldsubcat/oldname']
+        test_db_adapter = self.mox.CreateMock(db_service.DBAdapter)
+        test_db_adapter.get_listing_by_id(test_id).AndReturn(old_listing)
+
+        self.mox.StubOutWithMock(listing_service, 'set_unpublished_on')
+        listing_service.set_unpublished_on(test_listing_new, old_listing)
+
         test_db_adapter.upsert_listing(test_listing_new)
-        tiny_classified.db_adapter = test_db_adapter
+        tiny_classified.set_db_adapter(test_db_adapter)
+
+        self.mox.StubOutWithMock(listing_service, 'publish')
+        listing_service.publish(test_listing_new)
+
+        self.mox.StubOutWithMock(listing_service, 'refresh_category_summaries')
+        listing_service.refresh_category_summaries(
+            old_listing['slugs'] + test_listing_new['slugs']
+        )
 
         self.mox.ReplayAll()
 
@@ -342,6 +513,548 @@ class ListingServiceTests(mox.MoxTestBase):
         self.assertEqual(test_id, test_listing_new['_id'])
         self.assertEqual(test_listing_new, test_listing_copy)
 
+    def test_set_unpublished_on(self):
+        listing = {'is_published': False}
+        listing_service.set_unpublished_on(listing)
+        unpublished_on = listing['unpublished_on']
+        self.assertTrue(isinstance(unpublished_on, datetime.datetime))
+
+        old_listing = {'unpublished_on': datetime.datetime(2014, 1, 1)}
+        listing = {'is_published': False}
+        listing_service.set_unpublished_on(listing, old_listing)
+        self.assertEqual(datetime.datetime(2014, 1, 1),
+            listing['unpublished_on'])
+
+        listing['is_published'] = True
+        listing_service.set_unpublished_on(listing, old_listing)
+        self.assertFalse('unpublished_on' in listing)
+
+    def test_render_about(self):
+        listing = {'about': 'Some *about*'}
+        listing_service.render_about(listing)
+        self.assertEqual('<p>Some <em>about</em></p>', listing['about_html'])
+        self.assertEqual(
+            listing_service.ABOUT_RENDERER_VERSION,
+            listing['about_renderer_version']
+        )
+
+        listing = {}
+        listing_service.render_about(listing)
+        self.assertEqual(None, listing['about_html'])
+
+    def test_get_about_html(self):
+        listing = {
+            'about': 'Some *about*',
+            'about_html': 'stored',
+            'about_renderer_version': listing_service.ABOUT_RENDERER_VERSION
+        }
+        self.assertEqual('stored', listing_service.get_about_html(listing))
+
+        listing['about_renderer_version'] -= 1
+        self.assertEqual(
+            '<p>Some <em>about</em></p>',
+            listing_service.get_about_html(listing)
+        )
+
+    def test_rerender_abouts(self):
+        adapter = memory_db_service.MemoryDBAdapter()
+        tiny_classified.set_db_adapter(adapter)
+        for name in ['A', 'B', 'C']:
+            listing_service.create({
+                'author_email': '%s@example.com' % name,
+                'name': name,
+                'about': '*%s*' % name,
+                'tags': {}
+            })
+        old_listing = adapter.get_listing_by_name('B')
+        old_listing['about_renderer_version'] = 0
+        adapter.upsert_listing(old_listing)
+        adapter.upsert_listing({'name': 'D', 'about': 'D'})
+
+        self.assertEqual(2, listing_service.rerender_abouts(batch_size=1))
+        self.assertEqual(0, listing_service.rerender_abouts(batch_size=1))
+        self.assertEqual(
+            '<p><em>B</em></p>',
+            adapter.get_listing_by_name('B')['about_html']
+        )
+        self.assertEqual('<p>D</p>', adapter.get_listing_by_name('D')[
+            'about_html'])
+
+    def test_category_summaries_follow_writes(self):
+        adapter = memory_db_service.MemoryDBAdapter()
+        tiny_classified.set_db_adapter(adapter)
+        listings = {}
+        for (name, tags) in [('B', {'Food': ['Pizza']}),
+            ('A', {'Food': ['Tacos'], 'Foods': ['Other']})]:
+            listings[name] = {
+                'author_email': '%s@example.com' % name,
+                'name': name,
+                'tags': tags,
+                'is_published': True
+            }
+            listing_service.create(listings[name])
+
+        summary = adapter.get_category_summary('food')
+        self.assertEqual(['A', 'B'], [x['name'] for x in summary['listings']])
+        self.assertEqual(['Pizza', 'Tacos'], summary['subcategories'])
+        self.assertEqual([], summary['featured'])
+        self.assertEqual(
+            ['A'],
+            [x['name'] for x in adapter.get_category_summary('foods')[
+                'listings']]
+        )
+
+        listings['B']['tags'] = {'Food': ['Tacos']}
+        listings['B']['featured'] = True
+        listing_service.update(listings['B'])
+        self.assertEqual(None, adapter.get_category_summary('food/pizza'))
+        summary = adapter.get_category_summary('food/tacos')
+        self.assertEqual(['B'], [x['name'] for x in summary['featured']])
+        self.assertEqual([], summary['subcategories'])
+
+        listing_service.delete(listings['A'])
+        self.assertEqual(None, adapter.get_category_summary('foods'))
+        self.assertEqual(
+            ['B'],
+            [x['name'] for x in adapter.get_category_summary('food')[
+                'listings']]
+        )
+
+    def test_read_category_summary_builds_missing(self):
+        adapter = memory_db_service.MemoryDBAdapter()
+        tiny_classified.set_db_adapter(adapter)
+        listing = {'name': 'A', 'tags': {'Food': ['Pizza']},
+            'is_published': True}
+        listing_service.calculate_slugs(listing)
+        adapter.upsert_listing(listing)
+        adapter.upsert_public_listing(listing)
+
+        summary = listing_service.read_category_summary('Food/Pizza/')
+        self.assertEqual('food/pizza', summary['_id'])
+        self.assertEqual(None, listing_service.read_category_summary('Bars'))
+
+        listing_service.rebuild_category_summaries()
+        summary['version'] = 2
+        self.assertEqual(summary, adapter.get_category_summary('food/pizza'))
+
+    def test_rebuild_category_summaries_deletes_orphans(self):
+        adapter = memory_db_service.MemoryDBAdapter()
+        tiny_classified.set_db_adapter(adapter)
+        listing = {'name': 'A', 'tags': {'Food': ['Pizza']},
+            'is_published': True}
+        listing_service.calculate_slugs(listing)
+        adapter.upsert_listing(listing)
+        adapter.upsert_public_listing(listing)
+        adapter.upsert_category_summary(
+            {'_id': 'bars', 'version': 0, 'listings': [{'name': 'B'}]})
+        adapter.upsert_category_summary(
+            {'_id': 'cafes', 'version': 5, 'listings': [{'name': 'C'}]})
+
+        listing_service.rebuild_category_summaries()
+
+        self.assertEqual(
+            ['cafes', 'food', 'food/pizza'],
+            sorted(adapter.list_category_summary_ids())
+        )
+
+    def test_refresh_category_summaries_keeps_newer(self):
+        adapter = memory_db_service.MemoryDBAdapter()
+        tiny_classified.set_db_adapter(adapter)
+        listing = {'name': 'A', 'tags': {'Food': ['Pizza']},
+            'is_published': True}
+        listing_service.calculate_slugs(listing)
+        adapter.upsert_listing(listing)
+        adapter.upsert_public_listing(listing)
+        adapter.upsert_category_summary(
+            {'_id': 'food', 'version': 5, 'listings': [{'name': 'B'}]})
+
+        listing_service.refresh_category_summaries(listing['slugs'])
+
+        self.assertEqual(
+            [{'name': 'B'}],
+            adapter.get_category_summary('food')['listings']
+        )
+        self.assertEqual(
+            ['A'],
+            [x['name'] for x in adapter.get_category_summary('food/pizza')[
+                'listings']]
+        )
+
+    def test_build_category_summary_truncated(self):
+        adapter = memory_db_service.MemoryDBAdapter()
+        tiny_classified.set_db_adapter(adapter)
+        for name in ['A', 'B', 'C']:
+            listing = {'name': name, 'tags': {'Food': ['Pizza']},
+                'featured': True}
+            listing_service.calculate_slugs(listing)
+            adapter.upsert_listing(listing)
+            adapter.upsert_public_listing(listing)
+
+        config = tiny_classified.get_config()
+        config['CATEGORY_SUMMARY_MAX_LISTINGS'] = 2
+        try:
+            summary = listing_service.build_category_summary('food')
+        finally:
+            del config['CATEGORY_SUMMARY_MAX_LISTINGS']
+
+        self.assertEqual(['A', 'B'], [x['name'] for x in summary['listings']])
+        self.assertEqual(['A', 'B'], [x['name'] for x in summary['featured']])
+        self.assertEqual(['Pizza'], summary['subcategories'])
+        self.assertTrue(summary['truncated'])
+
+        page = listing_service.get_summary_page(summary, page_size=1)
+        self.assertEqual(['A'], [x['name'] for x in page['listings']])
+        page = listing_service.get_summary_page(
+            summary,
+            page_token=page['next_page_token'],
+            page_size=1
+        )
+        self.assertEqual(['B'], [x['name'] for x in page['listings']])
+        page = listing_service.get_summary_page(
+            summary,
+            page_token=page['next_page_token'],
+            page_size=1
+        )
+        self.assertEqual(['C'], [x['name'] for x in page['listings']])
+        self.assertEqual(None, page['next_page_token'])
+
+    def test_get_summary_page(self):
+        summary = {'listings': [{'name': x} for x in ['A', 'B', 'C']]}
+
+        page = listing_service.get_summary_page(summary, page_size=2)
+        self.assertEqual(['A', 'B'], [x['name'] for x in page['listings']])
+
+        page = listing_service.get_summary_page(
+            summary,
+            page_token=page['next_page_token'],
+            page_size=2
+        )
+        self.assertEqual(['C'], [x['name'] for x in page['listings']])
+        self.assertEqual(None, page['next_page_token'])
+
+    def test_publish(self):
+        adapter = memory_db_service.MemoryDBAdapter()
+        tiny_classified.set_db_adapter(adapter)
+        category_index_service.reset()
+        listing = {
+            'author_email': 'a@example.com',
+            'name': 'A',
+            'tags': {'Food': ['Pizza']},
+            'is_published': True,
+            'contact_id_next': 2
+        }
+        listing_service.create(listing)
+        public_listing = listing_service.read_by_slug('Food/Pizza/A')
+        self.assertEqual('A', public_listing['name'])
+        self.assertFalse('contact_id_next' in public_listing)
+
+        listing['is_published'] = False
+        listing_service.update(listing)
+        self.assertEqual(None, listing_service.read_by_slug('Food/Pizza/A'))
+        self.assertEqual(None, listing_service.read_category_summary('Food'))
+        self.assertEqual({}, listing_service.get_categories(home_only=False))
+
+    def test_set_location(self):
+        listing = {'latitude': '47.6', 'longitude': -122.3}
+        listing_service.set_location(listing)
+        self.assertEqual(
+            {'type': 'Point', 'coordinates': [-122.3, 47.6]},
+            listing['location']
+        )
+
+        for (latitude, longitude) in [(None, -122.3), ('', '1'), (91, 0),
+            (0, 'west')]:
+            listing['latitude'] = latitude
+            listing['longitude'] = longitude
+            listing_service.set_location(listing)
+            self.assertFalse('location' in listing)
+
+    def test_list_near(self):
+        adapter = memory_db_service.MemoryDBAdapter()
+        tiny_classified.set_db_adapter(adapter)
+        category_index_service.reset()
+        for (name, tag, latitude) in [('A', 'Food', 47.62),
+            ('B', 'Food', 47.61), ('C', 'Shops', 47.6), ('D', 'Food', None)]:
+            listing_service.create({
+                'author_email': '%s@example.com' % name,
+                'name': name,
+                'tags': {tag: ['Other']},
+                'is_published': True,
+                'latitude': latitude,
+                'longitude': -122.3
+            })
+
+        page = listing_service.list_near(47.6, -122.3, page_size=2)
+        self.assertEqual(['C', 'B'], [x['name'] for x in page['listings']])
+        self.assertEqual(0, page['listings'][0]['distance'])
+        self.assertEqual(1, page['next_page'])
+        page = listing_service.list_near(47.6, -122.3, page=1, page_size=2)
+        self.assertEqual(['A'], [x['name'] for x in page['listings']])
+        self.assertEqual(None, page['next_page'])
+
+        page = listing_service.list_near(47.6, -122.3, slug='food',
+            radius=1500)
+        self.assertEqual(['B'], [x['name'] for x in page['listings']])
+
+        for (latitude, radius, page) in [(-91, None, 0), (47.6, 0, 0),
+            (47.6, None, -1), (47.6, None, listing_service.MAX_NEAR_RESULTS)]:
+            with self.assertRaises(ValueError):
+                listing_service.list_near(latitude, -122.3, radius=radius,
+                    page=page, page_size=1)
+
+    def test_rebuild_public_listings(self):
+        adapter = memory_db_service.MemoryDBAdapter()
+        tiny_classified.set_db_adapter(adapter)
+        for (name, is_published) in [('A', True), ('B', False), ('C', True)]:
+            listing = {'name': name, 'is_published': is_published}
+            adapter.upsert_listing(listing)
+            adapter.upsert_public_listing(listing)
+        listing = adapter.get_listing_by_name('C')
+        listing['is_published'] = False
+        adapter.upsert_listing(listing)
+        adapter.upsert_public_listing({'_id': 'deleted', 'name': 'D'})
+
+        self.assertEqual(
+            1,
+            listing_service.rebuild_public_listings(batch_size=2)
+        )
+        self.assertEqual(
+            ['A'],
+            [x['name'] for x in adapter.index_listings(public=True)]
+        )
+
+    def test_check_is_qualified_slug_ok_with_special_characters(self):
+        result = listing_service.check_is_qualified_slug(
+            'P&C Aggregators/sub-ct/Smith & Sons, Inc.')
+        self.assertTrue(result)
+
+    def test_create_many(self):
+        test_listings = [
+            copy.deepcopy(TEST_LISTING),
+            copy.deepcopy(TEST_LISTING_ALT)
+        ]
+
+        self.mox.StubOutWithMock(listing_service, 'sanitize_tags')
+        self.mox.StubOutWithMock(listing_service, 'calculate_slugs')
+        for listing in test_listings:
+            listing_service.sanitize_tags(listing)
+            listing_service.calculate_slugs(listing)
+
+        test_db_adapter = self.mox.CreateMock(db_service.DBAdapter)
+        test_db_adapter.bulk_upsert_listings(
+            test_listings,
+            batch_size=10
+        ).AndReturn([None, 'Duplicate name'])
+        test_db_adapter.bulk_publish_listings(
+            [test_listings[0]],
+            batch_size=10
+        )
+
+        self.mox.StubOutWithMock(tiny_classified, 'get_db_adapter')
+        tiny_classified.get_db_adapter().AndReturn(test_db_adapter)
+
+        self.mox.StubOutWithMock(listing_service, 'rebuild_category_summaries')
+        listing_service.rebuild_category_summaries()
+
+        self.mox.ReplayAll()
+
+        result = listing_service.create_many(test_listings, batch_size=10)
+        self.assertEqual([None, 'Duplicate name'], result)
+
+    def test_page_token_round_trip(self):
+        token = listing_service.encode_page_token(u'Caf\xe9 & Sons')
+        self.assertFalse('=' in token)
+        self.assertEqual(
+            u'Caf\xe9 & Sons',
+            listing_service.decode_page_token(token)
+        )
+
+    def test_decode_page_token_invalid(self):
+        with self.assertRaises(ValueError):
+            listing_service.decode_page_token('a')
+
+    def test_list_by_slug_first_page(self):
+        test_db_adapter = self.mox.CreateMock(db_service.DBAdapter)
+        test_db_adapter.list_listings_by_slug(
+            TEST_TAG1,
+            fields=db_service.LISTING_SUMMARY_FIELDS,
+            after_name=None,
+            limit=2,
+            public=True,
+            raw=True
+        ).AndReturn(TEST_LISTINGS)
+
+        self.mox.StubOutWithMock(tiny_classified, 'get_db_adapter')
+        tiny_classified.get_db_adapter().AndReturn(test_db_adapter)
+
+        self.mox.ReplayAll()
+
+        page = listing_service.list_by_slug(TEST_TAG1, page_size=1)
+        self.assertEqual([TEST_LISTING], page['listings'])
+        self.assertEqual(
+            TEST_NAME,
+            listing_service.decode_page_token(page['next_page_token'])
+        )
+
+    def test_list_by_slug_last_page(self):
+        test_db_adapter = self.mox.CreateMock(db_service.DBAdapter)
+        test_db_adapter.list_listings_by_slug(
+            TEST_TAG1,
+            fields=db_service.LISTING_SUMMARY_FIELDS,
+            after_name=TEST_NAME,
+            limit=3,
+            public=True,
+            raw=True
+        ).AndReturn([TEST_LISTING_ALT])
+
+        self.mox.StubOutWithMock(tiny_classified, 'get_db_adapter')
+        tiny_classified.get_db_adapter().AndReturn(test_db_adapter)
+
+        self.mox.ReplayAll()
+
+        page = listing_service.list_by_slug(
+            TEST_TAG1,
+            page_token=listing_service.encode_page_token(TEST_NAME),
+            page_size=2
+        )
+        self.assertEqual([TEST_LISTING_ALT], page['listings'])
+        self.assertEqual(None, page['next_page_token'])
+
+    def test_read_by_slug_cached(self):
+        self.enable_cache()
+        test_listing = copy.deepcopy(TEST_LISTING)
+        test_listing['_id'] = TEST_ID
+
+        test_db_adapter = self.mox.CreateMock(db_service.DBAdapter)
+        test_db_adapter.get_listing_by_id(
+            TEST_ID,
+            public=True,
+            raw=True,
+            primary=False
+        ).AndReturn(raw_bson.RawBSONDocument(bson.BSON.encode(test_listing)))
+
+        self.mox.StubOutWithMock(tiny_classified, 'get_db_adapter')
+        tiny_classified.get_db_adapter().AndReturn(test_db_adapter)
+
+        self.mox.ReplayAll()
+
+        listing = listing_service.read_by_slug(TEST_SLUG1)
+        self.assertEqual(test_listing, listing)
+        listing['name'] = 'Changed'
+        cached_listing = listing_service.read_by_slug(TEST_SLUG1)
+        self.assertTrue(isinstance(cached_listing, listing_model.Listing))
+        self.assertEqual(test_listing, cached_listing)
+
+    def test_read_by_slug_after_local_write(self):
+        self.enable_cache()
+        test_listing = copy.deepcopy(TEST_LISTING)
+        test_listing['_id'] = TEST_ID
+        listing_service.invalidate_cached_listing(test_listing)
+
+        test_db_adapter = self.mox.CreateMock(db_service.DBAdapter)
+        test_db_adapter.get_listing_by_id(
+            TEST_ID,
+            public=True,
+            raw=True,
+            primary=True
+        ).AndReturn(test_listing)
+        test_db_adapter.get_category_summary(
+            'cat1',
+            public=False,
+            raw=True
+        ).AndReturn({'_id': 'cat1', 'listings': [test_listing]})
+        test_db_adapter.get_category_summary(
+            'cat2',
+            public=True,
+            raw=True
+        ).AndReturn({'_id': 'cat2', 'listings': [test_listing]})
+
+        self.mox.StubOutWithMock(tiny_classified, 'get_db_adapter')
+        tiny_classified.get_db_adapter().MultipleTimes().AndReturn(
+            test_db_adapter)
+
+        self.mox.ReplayAll()
+
+        self.assertEqual(test_listing, listing_service.read_by_slug(TEST_SLUG1))
+        listing_service.read_category_summary('cat1')
+        listing_service.read_category_summary('cat2')
+
+    def test_check_local_write(self):
+        listing_service.record_local_write(['someid'], ['Food/Pizza/Alpha'])
+        self.assertTrue(listing_service.check_local_write('x/y/z', 'someid'))
+        self.assertTrue(listing_service.check_local_write('food/pizza/alpha'))
+        self.assertTrue(listing_service.check_local_write('food'))
+        self.assertFalse(listing_service.check_local_write('food/tacos'))
+
+        self.mox.StubOutWithMock(listing_service, 'get_local_write_seconds')
+        listing_service.get_local_write_seconds().AndReturn(-1)
+        self.mox.ReplayAll()
+
+        listing_service.record_local_write(slugs=['food/tacos/beta'])
+        self.assertFalse(listing_service.check_local_write('food/tacos'))
+        self.assertTrue(listing_service.check_local_write('food/pizza'))
+
+        listing_service.clear_local_writes()
+        self.assertFalse(listing_service.check_local_write('food/pizza'))
+
+    def test_read_by_email_not_cached(self):
+        self.enable_cache()
+        old_listing = copy.deepcopy(TEST_LISTING)
+        old_listing['_id'] = TEST_ID
+        new_listing = copy.deepcopy(old_listing)
+        new_listing['name'] = 'Edited elsewhere'
+
+        test_db_adapter = self.mox.CreateMock(db_service.DBAdapter)
+        test_db_adapter.get_listing_by_email(TEST_EMAIL).AndReturn(old_listing)
+        test_db_adapter.get_listing_by_email(TEST_EMAIL).AndReturn(new_listing)
+
+        self.mox.StubOutWithMock(tiny_classified, 'get_db_adapter')
+        tiny_classified.get_db_adapter().MultipleTimes().AndReturn(
+            test_db_adapter)
+
+        self.mox.ReplayAll()
+
+        self.assertEqual(old_listing, listing_service.read_by_email(TEST_EMAIL))
+        self.assertEqual(new_listing, listing_service.read_by_email(TEST_EMAIL))
+
+    def test_update_invalidates_cache(self):
+        self.enable_cache()
+        cache = cache_service.get_listing_cache()
+        test_listing = copy.deepcopy(TEST_LISTING)
+        test_listing['_id'] = 'someid'
+        other_listing = copy.deepcopy(TEST_LISTING_ALT)
+        other_listing['_id'] = 'otherid'
+
+        cache.put(('slug', 'cat1/subcat1/Old'), test_listing, ['someid'])
+        cache.put(('slug', TEST_SLUG1), None)
+        cache.put(('list', 'cat1', None, 50), {'listings': []})
+        cache.put(('list', 'other', None, 50), {'listings': []})
+        cache.put(('summary', 'cat1'), {'listings': []})
+        cache.put(('slug', 'cat2/subcat3/Alt'), other_listing, ['otherid'])
+
+        test_db_adapter = self.mox.CreateMock(db_service.DBAdapter)
+        test_db_adapter.get_listing_by_id('someid').AndReturn(None)
+        test_db_adapter.upsert_listing(test_listing)
+
+        self.mox.StubOutWithMock(tiny_classified, 'get_db_adapter')
+        tiny_classified.get_db_adapter().AndReturn(test_db_adapter)
+
+        self.mox.StubOutWithMock(listing_service, 'publish')
+        listing_service.publish(test_listing)
+
+        self.mox.StubOutWithMock(listing_service, 'refresh_category_summaries')
+        listing_service.refresh_category_summaries(test_listing['slugs'])
+
+        self.mox.ReplayAll()
+
+        listing_service.update(test_listing)
+        self.assertFalse(cache.get(('slug', 'cat1/subcat1/Old'))[0])
+        self.assertFalse(cache.get(('slug', TEST_SLUG1))[0])
+        self.assertFalse(cache.get(('list', 'cat1', None, 50))[0])
+        self.assertFalse(cache.get(('summary', 'cat1'))[0])
+        self.assertTrue(cache.get(('list', 'other', None, 50))[0])
+        self.assertTrue(cache.get(('slug', 'cat2/subcat3/Alt'))[0])
+
     def test_get_slug_first(self):
         slug = listing_service.get_slug(
             TEST_LISTING_SLUGS_ONLY,
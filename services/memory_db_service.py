@@ -0,0 +1,1293 @@
+"""In-process database adapter for benchmarks and hermetic tests.
+
+@license: GNU GPLv3
+"""
+import bisect
+import copy
+import math
+import threading
+
+import bson
+from bson import raw_bson
+from pymongo import errors
+
+import db_service
+import instrumentation_service
+
+# The radius of the earth used by mongodb's spherical geometry.
+EARTH_RADIUS_METERS = 6378100.0
+
+
+def freeze(value):
+    """Convert a BSON compatible value into an equivalent hashable value.
+
+    @param value: The value to convert.
+    @type value: object
+    @return: Hashable value which is equal for equal values.
+    @rtype: object
+    """
+    if isinstance(value, dict):
+        return tuple(sorted((key, freeze(item)) for key, item in value.items()))
+    if isinstance(value, list):
+        return tuple(freeze(item) for item in value)
+    return value
+
+
+def copy_document(document, raw):
+    """Copy a stored document for a caller.
+
+    @param document: The stored document or None.
+    @type document: dict
+    @param raw: If True, copy the document as a RawBSONDocument like reads
+        through db_service.RAW_CODEC_OPTIONS return.
+    @type raw: bool
+    @return: The copy or None if the document is None.
+    @rtype: dict
+    """
+    if document == None:
+        return None
+    if raw:
+        return raw_bson.RawBSONDocument(bson.BSON.encode(document))
+    return copy.deepcopy(document)
+
+
+def get_field_values(record, key):
+    """Get the values of a field the way a mongo multikey index sees them.
+
+    @param record: The record to read the field from.
+    @type record: dict
+    @param key: The name of the field.
+    @type key: str
+    @return: The elements of the field if it is a list, the field alone if it
+        is not or nothing if the record does not have the field.
+    @rtype: list
+    """
+    if not key in record:
+        return []
+    value = record[key]
+    if isinstance(value, list):
+        return value
+    return [value]
+
+
+def project(record, fields):
+    """Copy a record, keeping only some of its fields.
+
+    @param record: The record to copy.
+    @type record: dict
+    @param fields: The fields to keep (in addition to "_id") or None to keep
+        all fields.
+    @type fields: list of str
+    @return: Deep copy of the projected record.
+    @rtype: dict
+    """
+    if fields == None:
+        return copy.deepcopy(record)
+    projected = {'_id': record['_id']}
+    for field in fields:
+        if field in record:
+            projected[field] = copy.deepcopy(record[field])
+    return projected
+
+
+def get_distance(point, other_point):
+    """Get the distance between two points like $geoNear does.
+
+    @param point: The longitude and latitude of a point in degrees.
+    @type point: list of float
+    @param other_point: The longitude and latitude of the other point.
+    @type other_point: list of float
+    @return: The great circle distance between the points in meters.
+    @rtype: float
+    """
+    (longitude, latitude) = [math.radians(x) for x in point]
+    (other_longitude, other_latitude) = [math.radians(x) for x in other_point]
+    a = math.sin((other_latitude - latitude) / 2) ** 2 + \
+        math.cos(latitude) * math.cos(other_latitude) * \
+        math.sin((other_longitude - longitude) / 2) ** 2
+    return 2 * EARTH_RADIUS_METERS * math.asin(math.sqrt(a))
+
+
+class MemoryDBAdapter(db_service.DBAdapter):
+    """DBAdapter keeping listings and users in memory instead of mongodb.
+
+    Listings are indexed by id, slug, normalized slug (sorted so that slug
+    prefix queries are a range scan, with one sort after each batch write),
+    normalized category and category / subcategory pair, name, author email
+    and tag so that lookups cost about what they would against an indexed
+    collection. Records
+    are copied on the way in and on the way out so that callers can not modify
+    the stored records, just like with a real database. Install with
+    tiny_classified.set_db_adapter.
+
+    The public read model is kept as the public copies of the published
+    listings by id. Public reads find listings through the listing indices
+    and return the public copies of those which are published.
+    """
+
+    def __init__(self):
+        """Create a new empty in-memory database."""
+        db_service.DBAdapter.__init__(self)
+        self.lock = threading.RLock()
+        self.listings = {}
+        self.listing_ids_by_slug = {}
+        self.listing_id_by_name = {}
+        self.listing_ids_by_email = {}
+        self.listing_ids_by_tag = {}
+        self.listing_ids_by_category = {}
+        self.normalized_slugs = set()
+        self.sorted_slugs = []
+        self.users = {}
+        self.public_listings = {}
+        self.category_summaries = {}
+        self.meta = {}
+        self.archived_listings = {}
+
+
+    def get_client(self):
+        raise NotImplementedError('MemoryDBAdapter has no mongodb client.')
+
+
+    def get_collection(self, collection_name):
+        raise NotImplementedError('MemoryDBAdapter has no mongodb collections.')
+
+
+    @instrumentation_service.instrumented
+    def ensure_indices(self):
+        """Do nothing as the in-memory indices are always maintained."""
+        pass
+
+
+    def add_to_indices(self, listing):
+        """Add a stored listing to the secondary indices.
+
+        @param listing: The listing to index.
+        @type listing: dict
+        """
+        listing_id = listing['_id']
+        for slug in get_field_values(listing, 'slugs'):
+            self.listing_ids_by_slug.setdefault(slug, set()).add(listing_id)
+        for slug in set(get_field_values(listing, 'slugs_normalized')):
+            self.normalized_slugs.add((slug, listing_id))
+            if self.sorted_slugs != None:
+                bisect.insort(self.sorted_slugs, (slug, listing_id))
+        if 'name' in listing:
+            self.listing_id_by_name[listing['name']] = listing_id
+        if 'author_email' in listing:
+            email = listing['author_email']
+            self.listing_ids_by_email.setdefault(email, set()).add(listing_id)
+        for tag in get_field_values(listing, 'tags'):
+            self.listing_ids_by_tag.setdefault(freeze(tag), set()).add(
+                listing_id)
+        for key in self.get_category_keys(listing):
+            self.listing_ids_by_category.setdefault(key, set()).add(listing_id)
+
+
+    def remove_from_indices(self, listing):
+        """Remove a stored listing from the secondary indices.
+
+        @param listing: The listing to stop indexing.
+        @type listing: dict
+        """
+        listing_id = listing['_id']
+        for slug in get_field_values(listing, 'slugs'):
+            self.discard_from_index(self.listing_ids_by_slug, slug, listing_id)
+        for slug in set(get_field_values(listing, 'slugs_normalized')):
+            self.normalized_slugs.discard((slug, listing_id))
+            if self.sorted_slugs != None:
+                position = bisect.bisect_left(
+                    self.sorted_slugs,
+                    (slug, listing_id)
+                )
+                del self.sorted_slugs[position]
+        if self.listing_id_by_name.get(listing.get('name')) == listing_id:
+            del self.listing_id_by_name[listing['name']]
+        if 'author_email' in listing:
+            self.discard_from_index(
+                self.listing_ids_by_email,
+                listing['author_email'],
+                listing_id
+            )
+        for tag in get_field_values(listing, 'tags'):
+            self.discard_from_index(
+                self.listing_ids_by_tag,
+                freeze(tag),
+                listing_id
+            )
+        for key in self.get_category_keys(listing):
+            self.discard_from_index(
+                self.listing_ids_by_category,
+                key,
+                listing_id
+            )
+
+
+    def defer_slug_sort(self):
+        """Stop keeping the sorted slugs up to date until the next slug lookup.
+
+        Called before writing many listings at once so that the sorted slugs
+        are rebuilt with one sort instead of one insertion per listing.
+        """
+        self.sorted_slugs = None
+
+
+    def get_sorted_slugs(self):
+        """Get the sorted (normalized slug, listing id) pairs.
+
+        @return: The pairs, sorted again if a batch write deferred sorting.
+        @rtype: list of tuple
+        """
+        if self.sorted_slugs == None:
+            self.sorted_slugs = sorted(self.normalized_slugs)
+        return self.sorted_slugs
+
+
+    def get_category_keys(self, listing):
+        """Get the keys of a listing in the category index.
+
+        @param listing: The listing to index.
+        @type listing: dict
+        @return: The listing's normalized categories and (category,
+            subcategory) pairs.
+        @rtype: set
+        """
+        keys = set(get_field_values(listing, 'categories'))
+        for pair in get_field_values(listing, 'tag_pairs'):
+            keys.add((pair['cat'], pair['sub']))
+        return keys
+
+
+    def discard_from_index(self, index, key, listing_id):
+        """Remove a listing id from the set of ids under a key of an index.
+
+        @param index: The index mapping keys to sets of listing ids.
+        @type index: dict
+        @param key: The key to remove the listing id from.
+        @type key: hashable
+        @param listing_id: The listing id to remove.
+        @type listing_id: bson.objectid.ObjectId
+        """
+        listing_ids = index.get(key, None)
+        if listing_ids == None:
+            return
+        listing_ids.discard(listing_id)
+        if not listing_ids:
+            del index[key]
+
+
+    def get_public_listings(self, listing_ids):
+        """Get the public copies of the published listings among some ids.
+
+        @param listing_ids: The ids of the listings to get.
+        @type listing_ids: iterable over bson.objectid.ObjectId
+        @return: The stored public copies (not copied again).
+        @rtype: list of dict
+        """
+        return [
+            self.public_listings[listing_id]
+            for listing_id in listing_ids
+            if listing_id in self.public_listings
+        ]
+
+
+    def get_first_listing(self, listing_ids):
+        """Get a copy of the listing with the lowest id among some ids.
+
+        @param listing_ids: The ids to choose from.
+        @type listing_ids: iterable over bson.objectid.ObjectId
+        @return: Copy of the listing or None if there are no ids.
+        @rtype: dict or None
+        """
+        if not listing_ids:
+            return None
+        return copy.deepcopy(self.listings[min(listing_ids)])
+
+
+    def get_slug_ids(self, listing_slug):
+        """Get the ids of listings with slugs beginning with a slug.
+
+        Like DBAdapter.get_slug_query, category and category / subcategory
+        slugs are looked up in the category index and other slugs are matched
+        as a prefix of the normalized slugs.
+
+        @param listing_slug: The slug to match case-insensitively.
+        @type listing_slug: str
+        @return: The ids of the matching listings.
+        @rtype: set
+        """
+        prefix = db_service.normalize_slug(listing_slug)
+        parts = prefix.split('/', 2)
+        if len(parts) < 3 or not parts[2]:
+            if not parts[0]:
+                return set(self.listings.iterkeys())
+            if len(parts) == 1 or not parts[1]:
+                key = parts[0]
+            else:
+                key = (parts[0], parts[1])
+            return set(self.listing_ids_by_category.get(key, ()))
+
+        listing_ids = set()
+        sorted_slugs = self.get_sorted_slugs()
+        position = bisect.bisect_left(sorted_slugs, (prefix,))
+        while position < len(sorted_slugs):
+            (slug, listing_id) = sorted_slugs[position]
+            if not slug.startswith(prefix):
+                break
+            listing_ids.add(listing_id)
+            position += 1
+        return listing_ids
+
+
+    @instrumentation_service.instrumented
+    def index_listings(self, fields=None, public=False):
+        """List / index all listings.
+
+        @keyword fields: The only fields to return for each listing or None to
+            return entire listings.
+        @type fields: list of str
+        @keyword public: If True, list the public copies of the published
+            listings.
+        @type public: bool
+        @return: all listings
+        @rtype: list of dict
+        """
+        with self.lock:
+            if public:
+                listings = self.public_listings
+            else:
+                listings = self.listings
+            return [project(x, fields) for x in listings.itervalues()]
+
+
+    @instrumentation_service.instrumented
+    def get_listing_by_id(self, listing_id, public=False, raw=False,
+        primary=False):
+        """Gets a listing by its _id.
+
+        @param listing_id: The _id of the listing.
+        @type listing_id: bson.objectid.ObjectId
+        @keyword public: If True, only find published listings, in their
+            public shape.
+        @type public: bool
+        @keyword raw: If True and public, return the listing as a
+            RawBSONDocument.
+        @type raw: bool
+        @keyword primary: If True and public, read from the primary (ignored as
+            there are no secondaries).
+        @type primary: bool
+        @return: The matching listing or None
+        @rtype: dict or None
+        """
+        with self.lock:
+            listings = self.public_listings if public else self.listings
+            return copy_document(
+                listings.get(listing_id, None),
+                raw and public
+            )
+
+
+    @instrumentation_service.instrumented
+    def get_listing_by_slug(self, listing_slug, public=False, raw=False,
+        primary=False):
+        """Gets a listing which matches the given slug.
+
+        @param listing_slug: The slug to match to a listing.
+        @type listing_slug: str
+        @keyword public: If True, only find published listings, in their
+            public shape.
+        @type public: bool
+        @keyword raw: If True and public, return the listing as a
+            RawBSONDocument.
+        @type raw: bool
+        @keyword primary: If True and public, read from the primary (ignored as
+            there are no secondaries).
+        @type primary: bool
+        @return: The matching listing or None
+        @rtype: dict or None
+        """
+        with self.lock:
+            listing_ids = self.listing_ids_by_slug.get(listing_slug, None)
+            if public:
+                listings = self.get_public_listings(sorted(listing_ids or ()))
+                return copy_document(listings[0] if listings else None, raw)
+            return self.get_first_listing(listing_ids)
+
+
+    @instrumentation_service.instrumented
+    def get_listing_by_name(self, listing_name):
+        """Gets a listing which matches the given name.
+
+        @param listing_name: The name to match to a listing.
+        @type listing_name: str
+        @return: The matching listing or None
+        @rtype: dict or None
+        """
+        with self.lock:
+            listing_id = self.listing_id_by_name.get(listing_name, None)
+            if listing_id == None:
+                return None
+            return copy.deepcopy(self.listings[listing_id])
+
+
+    @instrumentation_service.instrumented
+    def get_listing_by_email(self, author_email):
+        """Gets a listing written by the given author.
+
+        @param author_email: The email address of the listing's author.
+        @type author_email: str
+        @return: The matching listing or None
+        @rtype: dict or None
+        """
+        with self.lock:
+            return self.get_first_listing(
+                self.listing_ids_by_email.get(author_email, None))
+
+
+    @instrumentation_service.instrumented
+    def list_listings_by_slug(self, listing_slug, fields=None, after_name=None,
+        limit=None, public=True, raw=False):
+        """List the listings that have slugs that begin with the specified slug.
+
+        @param listing_slug: The slug to match
+        @type listing_slug: str
+        @keyword fields: The only fields to return for each listing (like
+            LISTING_SUMMARY_FIELDS) or None to return entire listings.
+        @type fields: list of str
+        @keyword after_name: Only return listings with names after this one.
+        @type after_name: str
+        @keyword limit: The maximum number of listings to return or None for
+            no limit.
+        @type limit: int
+        @keyword public: Ignored as there are no secondaries.
+        @type public: bool
+        @keyword raw: If True, return the listings as RawBSONDocument.
+        @type raw: bool
+        @return: The published matching listings ordered by name.
+        @rtype: list of dict
+        """
+        with self.lock:
+            listings = self.get_public_listings(
+                self.get_slug_ids(listing_slug)
+            )
+            if after_name != None:
+                listings = [x for x in listings if x.get('name') > after_name]
+            listings.sort(key=lambda x: x.get('name'))
+            if limit:
+                listings = listings[:limit]
+            return [copy_document(project(x, fields), raw) for x in listings]
+
+
+    @instrumentation_service.instrumented
+    def list_featured_listings_by_slug(self, listing_slug, fields=None,
+        limit=None, public=True):
+        """List featured listings that have slugs beginning with a slug.
+
+        @param listing_slug: The slug to match
+        @type listing_slug: str
+        @keyword fields: The only fields to return for each listing or None to
+            return entire listings.
+        @type fields: list of str
+        @keyword limit: The maximum number of listings to return or None for
+            no limit.
+        @type limit: int
+        @keyword public: Ignored as there are no secondaries.
+        @type public: bool
+        @return: The published matching featured listings ordered by name.
+        @rtype: list of dict
+        """
+        with self.lock:
+            listings = [
+                x for x in self.get_public_listings(
+                    self.get_slug_ids(listing_slug)
+                )
+                if x.get('featured') == True
+            ]
+            listings.sort(key=lambda x: x.get('name'))
+            if limit:
+                listings = listings[:limit]
+            return [project(x, fields) for x in listings]
+
+
+    def store_listing(self, listing):
+        """Insert or replace a listing, enforcing the unique name index.
+
+        @param listing: The listing to store. An "_id" is assigned to it if it
+            does not already have one.
+        @type listing: dict
+        @raise pymongo.errors.DuplicateKeyError: Raised if another listing has
+            the same name.
+        """
+        if not '_id' in listing:
+            listing['_id'] = bson.ObjectId()
+        listing_id = listing['_id']
+
+        other_id = self.listing_id_by_name.get(listing.get('name'), listing_id)
+        if 'name' in listing and other_id != listing_id:
+            raise errors.DuplicateKeyError(
+                'E11000 duplicate key error index: name dup key: %s' %
+                listing['name'],
+                11000
+            )
+
+        old_listing = self.listings.get(listing_id, None)
+        stored_listing = copy.deepcopy(listing)
+        if old_listing != None:
+            self.remove_from_indices(old_listing)
+            stored_listing.pop('views', None)
+            if 'views' in old_listing:
+                stored_listing['views'] = old_listing['views']
+        self.listings[listing_id] = stored_listing
+        self.add_to_indices(stored_listing)
+
+
+    @instrumentation_service.instrumented
+    def upsert_listing(self, listing):
+        """Updates or inserts a listing.
+
+        @param listing: The listing to insert or update. If listing has an "_id"
+            then the existing listing with that "_id" is updated, otherwise a
+            new listing is inserted and given an "_id".
+        @type listing: dict
+        @raise pymongo.errors.DuplicateKeyError: Raised if another listing has
+            the same name.
+        """
+        self.ensure_limited_fields(listing, db_service.ALLOWED_LISTING_FIELDS)
+        with self.lock:
+            self.store_listing(listing)
+
+
+    @instrumentation_service.instrumented
+    def bulk_upsert_listings(self, listings,
+        batch_size=db_service.DEFAULT_BULK_BATCH_SIZE, ordered=False,
+        write_concern_profile=db_service.WRITE_CONCERN_BULK):
+        """Updates or inserts many listings.
+
+        @param listings: The listings to insert or update.
+        @type listings: iterable over dict
+        @keyword batch_size: Ignored as there are no round trips to save.
+        @type batch_size: int
+        @keyword ordered: If True, stop at the first error.
+        @type ordered: bool
+        @keyword write_concern_profile: Ignored as writes are always durable
+            for the life of the adapter.
+        @type write_concern_profile: str
+        @return: One entry per listing, in the order given: None if the listing
+            was written or a message describing why it was not.
+        @rtype: list
+        """
+        results = []
+        failed = False
+        with self.lock:
+            self.defer_slug_sort()
+            for listing in listings:
+                if failed:
+                    results.append(db_service.NOT_ATTEMPTED_MESSAGE)
+                    continue
+
+                try:
+                    self.ensure_limited_fields(
+                        listing,
+                        db_service.ALLOWED_LISTING_FIELDS
+                    )
+                    self.store_listing(listing)
+                    results.append(None)
+                except (ValueError, errors.DuplicateKeyError) as e:
+                    results.append(str(e))
+                    failed = ordered
+        return results
+
+
+    @instrumentation_service.instrumented
+    def delete_listing_by_slug(self, listing_slug):
+        """Deletes a listing by one of its fully qualified slugs.
+
+        @param listing_slug: A qualified slug of the listing to delete.
+        @type listing_slug: str
+        @raises: ValueError if multiple listings are matched by the given slug
+            ValueError if no listings are matched by the given slug
+        """
+        with self.lock:
+            listing_ids = self.listing_ids_by_slug.get(listing_slug, set())
+
+            if len(listing_ids) > 1:
+                raise ValueError(
+                    'Slug %s matched multiple listings' % listing_slug)
+
+            if len(listing_ids) == 0:
+                raise ValueError(
+                    'Slug %s did match any listings' % listing_slug)
+
+            self.delete_listing(list(listing_ids)[0])
+
+
+    @instrumentation_service.instrumented
+    def list_stale_about_listings(self, renderer_version, after_id=None,
+        limit=None):
+        """List listings whose about_html was rendered by another renderer.
+
+        @param renderer_version: The current about renderer version.
+        @type renderer_version: int
+        @keyword after_id: Only return listings with ids after this one.
+        @type after_id: bson.objectid.ObjectId
+        @keyword limit: The maximum number of listings to return or None for
+            no limit.
+        @type limit: int
+        @return: The "_id" and "about" of the matching listings ordered by id.
+        @rtype: list of dict
+        """
+        with self.lock:
+            listing_ids = sorted(
+                listing_id for (listing_id, listing) in self.listings.items()
+                if listing.get('about_renderer_version') != renderer_version
+                and (after_id == None or listing_id > after_id)
+            )
+            if limit:
+                listing_ids = listing_ids[:limit]
+            return [project(self.listings[x], ['about']) for x in listing_ids]
+
+
+    @instrumentation_service.instrumented
+    def set_about_html(self, listing_id, about, about_html, renderer_version):
+        """Store the rendered about section of a listing.
+
+        @param listing_id: The "_id" of the listing to update.
+        @type listing_id: bson.objectid.ObjectId
+        @param about: The about section which was rendered.
+        @type about: str
+        @param about_html: The rendered about section.
+        @type about_html: str
+        @param renderer_version: The version of the renderer used.
+        @type renderer_version: int
+        @return: True if the listing was updated, False if it no longer exists
+            or its about section has changed.
+        @rtype: bool
+        """
+        with self.lock:
+            listing = self.listings.get(listing_id, None)
+            if listing == None or listing.get('about') != about:
+                return False
+            listings = [listing] + self.get_public_listings([listing_id])
+            for listing in listings:
+                listing['about_html'] = about_html
+                listing['about_renderer_version'] = renderer_version
+            return True
+
+
+    @instrumentation_service.instrumented
+    def list_listing_batch(self, fields=None, after_id=None, upper_id=None,
+        limit=None):
+        """List a batch of listings in id order.
+
+        @keyword fields: The only fields to return for each listing or None to
+            return entire listings.
+        @type fields: list of str
+        @keyword after_id: Only return listings with ids after this one.
+        @type after_id: bson.objectid.ObjectId
+        @keyword upper_id: Only return listings with ids up to and including
+            this one.
+        @type upper_id: bson.objectid.ObjectId
+        @keyword limit: The maximum number of listings to return or None for
+            no limit.
+        @type limit: int
+        @return: The listings ordered by id.
+        @rtype: list of dict
+        """
+        with self.lock:
+            listing_ids = sorted(
+                x for x in self.listings.iterkeys()
+                if (after_id == None or x > after_id) and
+                    (upper_id == None or x <= upper_id)
+            )
+            if limit:
+                listing_ids = listing_ids[:limit]
+            return [project(self.listings[x], fields) for x in listing_ids]
+
+
+    @instrumentation_service.instrumented
+    def get_listing_id_split_points(self, count):
+        """Get the ids which split the listings into ranges of equal size.
+
+        @param count: The number of ranges.
+        @type count: int
+        @return: Up to count - 1 ids in ascending order (see
+            DBAdapter.get_listing_id_split_points).
+        @rtype: list of bson.objectid.ObjectId
+        """
+        with self.lock:
+            listing_ids = sorted(self.listings.iterkeys())
+            split_points = []
+            for i in range(1, count):
+                position = len(listing_ids) * i // count
+                if position == 0:
+                    continue
+                listing_id = listing_ids[position - 1]
+                if not listing_id in split_points:
+                    split_points.append(listing_id)
+            return split_points
+
+
+    @instrumentation_service.instrumented
+    def update_listing_fields(self, updates):
+        """Set fields of many listings if they have not changed since read.
+
+        @param updates: (listing id, expected fields, changed fields) triples
+            (see DBAdapter.update_listing_fields).
+        @type updates: list of tuple
+        @return: The number of listings updated.
+        @rtype: int
+        """
+        count = 0
+        with self.lock:
+            self.defer_slug_sort()
+            for (listing_id, expected, changes) in updates:
+                listing = self.listings.get(listing_id, None)
+                if listing == None or any(
+                    listing.get(k, None) != v for (k, v) in expected.iteritems()
+                ):
+                    continue
+
+                listing = dict(listing)
+                listing.update(changes)
+                self.store_listing(listing)
+                for public_listing in self.get_public_listings([listing_id]):
+                    for (k, v) in changes.iteritems():
+                        if k in db_service.PUBLIC_LISTING_FIELDS:
+                            public_listing[k] = copy.deepcopy(v)
+                count += 1
+        return count
+
+
+    @instrumentation_service.instrumented
+    def upsert_public_listing(self, listing):
+        """Insert or replace the public copy of a published listing.
+
+        An existing copy keeps its views.
+
+        @param listing: The saved listing, with an "_id". Only its
+            PUBLIC_LISTING_FIELDS are copied.
+        @type listing: dict
+        """
+        with self.lock:
+            public_listing = project(listing, db_service.PUBLIC_LISTING_FIELDS)
+            old_public_listing = self.public_listings.get(listing['_id'], None)
+            if old_public_listing != None:
+                public_listing.pop('views', None)
+                if 'views' in old_public_listing:
+                    public_listing['views'] = old_public_listing['views']
+            self.public_listings[listing['_id']] = public_listing
+
+
+    @instrumentation_service.instrumented
+    def delete_public_listing(self, listing_id):
+        """Remove a listing from the public read model if it is there.
+
+        @param listing_id: The "_id" of the listing to remove.
+        @type listing_id: bson.objectid.ObjectId
+        """
+        with self.lock:
+            self.public_listings.pop(listing_id, None)
+
+
+    @instrumentation_service.instrumented
+    def bulk_publish_listings(self, listings,
+        batch_size=db_service.DEFAULT_BULK_BATCH_SIZE,
+        write_concern_profile=db_service.WRITE_CONCERN_BULK):
+        """Bring the public copies of many listings up to date.
+
+        @param listings: The saved listings. Published listings are copied and
+            others (like those with only an "_id") are removed.
+        @type listings: iterable over dict
+        @keyword batch_size: Ignored as there are no round trips to save.
+        @type batch_size: int
+        @keyword write_concern_profile: Ignored as writes are always durable
+            for the life of the adapter.
+        @type write_concern_profile: str
+        """
+        with self.lock:
+            for listing in listings:
+                if listing.get('is_published', False):
+                    self.upsert_public_listing(listing)
+                else:
+                    self.delete_public_listing(listing['_id'])
+
+
+    @instrumentation_service.instrumented
+    def delete_listing(self, listing_id):
+        """Deletes a listing by its id.
+
+        @param listing_id: The "_id" of the listing to delete.
+        @type listing_id: bson.objectid.ObjectId
+        """
+        with self.lock:
+            listing = self.listings.pop(listing_id, None)
+            if listing != None:
+                self.remove_from_indices(listing)
+
+
+    @instrumentation_service.instrumented
+    def delete_listing_by_name(self, listing_name):
+        """Deletes a listing.
+
+        @param listing_name: The name of the listing to delete.
+        @type listing: str
+        """
+        with self.lock:
+            listing_id = self.listing_id_by_name.get(listing_name, None)
+            if listing_id != None:
+                self.delete_listing(listing_id)
+
+
+    @instrumentation_service.instrumented
+    def increment_listing_views(self, counts, public=False):
+        """Add to the view counts of listings.
+
+        @param counts: The number of views to add by listing id.
+        @type counts: dict
+        @keyword public: If True, add to the public copies of the listings
+            instead of the listings.
+        @type public: bool
+        @return: The counts which could not be added, by listing id, which
+            is always empty.
+        @rtype: dict
+        """
+        if public:
+            listings = self.public_listings
+        else:
+            listings = self.listings
+        with self.lock:
+            for (listing_id, count) in counts.iteritems():
+                listing = listings.get(listing_id, None)
+                if listing != None:
+                    listing['views'] = listing.get('views', 0) + count
+        return {}
+
+
+    @instrumentation_service.instrumented
+    def list_popular_listings(self, fields=None, limit=None):
+        """List the most viewed published listings.
+
+        @keyword fields: The only fields to return for each listing or None to
+            return entire listings.
+        @type fields: list of str
+        @keyword limit: The maximum number of listings to return or None for
+            no limit.
+        @type limit: int
+        @return: The viewed listings, most viewed first.
+        @rtype: list of dict
+        """
+        with self.lock:
+            listings = sorted(
+                (
+                    x for x in self.public_listings.itervalues()
+                    if x.get('views', 0) > 0
+                ),
+                key=lambda x: -x['views']
+            )
+            if limit:
+                listings = listings[:limit]
+            return [project(x, fields) for x in listings]
+
+
+    @instrumentation_service.instrumented
+    def list_archivable_listings(self, expired_before, unpublished_before,
+        after_id=None, limit=None):
+        """List the listings which expired or have long been unpublished.
+
+        @param expired_before: Find listings expiring on or before this time.
+        @type expired_before: datetime.datetime
+        @param unpublished_before: Find listings unpublished on or before this
+            time or None not to find listings by when they were unpublished.
+        @type unpublished_before: datetime.datetime
+        @keyword after_id: Only return listings with ids after this one.
+        @type after_id: bson.objectid.ObjectId
+        @keyword limit: The maximum number of listings to return or None for
+            no limit.
+        @type limit: int
+        @return: The matching listings ordered by id.
+        @rtype: list of dict
+        """
+        def is_archivable(listing):
+            expires_on = listing.get('expires_on', None)
+            unpublished_on = listing.get('unpublished_on', None)
+            return (expires_on != None and expires_on <= expired_before) or (
+                unpublished_before != None and unpublished_on != None and
+                unpublished_on <= unpublished_before
+            )
+
+        with self.lock:
+            listing_ids = sorted(
+                x for (x, listing) in self.listings.iteritems()
+                if (after_id == None or x > after_id) and
+                    is_archivable(listing)
+            )
+            if limit:
+                listing_ids = listing_ids[:limit]
+            return [copy.deepcopy(self.listings[x]) for x in listing_ids]
+
+
+    @instrumentation_service.instrumented
+    def archive_listings(self, listings):
+        """Move listings from the listing collection to the archive.
+
+        @param listings: The listings to archive, as read, with any archive
+            fields to store on the archived copies (see
+            DBAdapter.archive_listings).
+        @type listings: list of dict
+        @return: The ids of the archived listings.
+        @rtype: list of bson.objectid.ObjectId
+        """
+        listing_ids = []
+        with self.lock:
+            self.defer_slug_sort()
+            for listing in listings:
+                current = self.listings.get(listing['_id'], None)
+                if current == None or any(
+                    current.get(k, None) != listing.get(k, None)
+                    for k in ['expires_on', 'unpublished_on']
+                ):
+                    continue
+
+                self.archived_listings[listing['_id']] = copy.deepcopy(listing)
+                self.delete_listing(listing['_id'])
+                self.public_listings.pop(listing['_id'], None)
+                listing_ids.append(listing['_id'])
+        return listing_ids
+
+
+    @instrumentation_service.instrumented
+    def get_archived_listing_by_email(self, author_email):
+        """Find the most recently archived listing of an author.
+
+        @param author_email: The email address of the author.
+        @type author_email: str
+        @return: The archived listing or None if the author has none.
+        @rtype: dict or None
+        """
+        with self.lock:
+            listings = [
+                x for x in self.archived_listings.itervalues()
+                if x.get('author_email', None) == author_email
+            ]
+            if not listings:
+                return None
+            return copy.deepcopy(
+                max(listings, key=lambda x: x.get('archived_on', None))
+            )
+
+
+    @instrumentation_service.instrumented
+    def delete_archived_listing(self, listing_id):
+        """Remove a listing from the archive if it is there.
+
+        @param listing_id: The "_id" of the archived listing.
+        @type listing_id: bson.objectid.ObjectId
+        """
+        with self.lock:
+            self.archived_listings.pop(listing_id, None)
+
+
+    @instrumentation_service.instrumented
+    def get_category_summary(self, summary_id, public=False, raw=False):
+        """Get the summary of a category or subcategory.
+
+        @param summary_id: The normalized category or category / subcategory
+            slug of the summary.
+        @type summary_id: str
+        @keyword public: Ignored as there are no secondaries.
+        @type public: bool
+        @keyword raw: If True, return the summary as a RawBSONDocument.
+        @type raw: bool
+        @return: The summary or None if there is no summary with the id or
+            its category has no listings left.
+        @rtype: dict or None
+        """
+        with self.lock:
+            summary = self.category_summaries.get(summary_id, None)
+            if summary == None or not summary['listings']:
+                return None
+            return copy_document(summary, raw)
+
+
+    @instrumentation_service.instrumented
+    def upsert_category_summary(self, summary):
+        """Insert or replace the summary of a category or subcategory.
+
+        The summary is only written if the stored one has an older version.
+
+        @param summary: The summary, with its id under "_id" and its version
+            under "version".
+        @type summary: dict
+        @return: True if the summary was written and False if a newer one is
+            stored.
+        @rtype: bool
+        """
+        with self.lock:
+            stored = self.category_summaries.get(summary['_id'], None)
+            if stored != None and stored['version'] >= summary['version']:
+                return False
+            self.category_summaries[summary['_id']] = copy.deepcopy(summary)
+            return True
+
+
+    @instrumentation_service.instrumented
+    def delete_category_summary(self, summary_id, version):
+        """Delete the summary of a category or subcategory if it is not newer.
+
+        @param summary_id: The id of the summary to delete.
+        @type summary_id: str
+        @param version: The summary is kept if its version is newer than this.
+        @type version: int
+        """
+        with self.lock:
+            stored = self.category_summaries.get(summary_id, None)
+            if stored != None and stored['version'] <= version:
+                del self.category_summaries[summary_id]
+
+
+    @instrumentation_service.instrumented
+    def list_category_summary_ids(self):
+        """List the ids of all the stored category summaries.
+
+        @return: The ids, including those of summaries of categories with no
+            listings left.
+        @rtype: list of str
+        """
+        with self.lock:
+            return self.category_summaries.keys()
+
+
+    @instrumentation_service.instrumented
+    def list_listings_near(self, longitude, latitude, listing_slug=None,
+        max_distance=None, fields=None, skip=0, limit=None):
+        """List the published listings nearest to a point.
+
+        @param longitude: The longitude of the point in degrees.
+        @type longitude: float
+        @param latitude: The latitude of the point in degrees.
+        @type latitude: float
+        @keyword listing_slug: If given, only return listings with slugs
+            beginning with this slug.
+        @type listing_slug: str
+        @keyword max_distance: If given, only return listings at most this
+            many meters away.
+        @type max_distance: float
+        @keyword fields: The only fields to return for each listing (in
+            addition to "distance") or None to return entire listings.
+        @type fields: list of str
+        @keyword skip: The number of nearest listings to skip.
+        @type skip: int
+        @keyword limit: The maximum number of listings to return or None for
+            no limit.
+        @type limit: int
+        @return: The listings, with their distance from the point in meters
+            under "distance", nearest first.
+        @rtype: list of dict
+        """
+        with self.lock:
+            if listing_slug:
+                listings = self.get_public_listings(
+                    self.get_slug_ids(listing_slug)
+                )
+            else:
+                listings = self.public_listings.values()
+
+            found = []
+            for listing in listings:
+                location = listing.get('location', None)
+                if location == None:
+                    continue
+                distance = get_distance(
+                    [longitude, latitude],
+                    location['coordinates']
+                )
+                if max_distance == None or distance <= max_distance:
+                    found.append((distance, listing['_id'], listing))
+            found.sort(key=lambda x: x[:2])
+
+            found = found[skip:]
+            if limit:
+                found = found[:limit]
+
+            results = []
+            for (distance, listing_id, listing) in found:
+                result = project(listing, fields)
+                result['distance'] = distance
+                results.append(result)
+            return results
+
+
+    @instrumentation_service.instrumented
+    def get_tag_tree(self, listing_slug=None, public=True):
+        """Get the categories and subcategories of the published listings.
+
+        @keyword listing_slug: If given, only consider listings with slugs
+            beginning with this slug.
+        @type listing_slug: str
+        @keyword public: Ignored as there are no secondaries.
+        @type public: bool
+        @return: Dict from category name to its sorted subcategory names.
+        @rtype: dict
+        """
+        with self.lock:
+            if listing_slug == None:
+                listings = self.public_listings.itervalues()
+            else:
+                listings = self.get_public_listings(
+                    self.get_slug_ids(listing_slug)
+                )
+
+            categories = {}
+            for listing in listings:
+                for pair in get_field_values(listing, 'tag_pairs'):
+                    categories.setdefault(pair['cat_name'], set()).add(
+                        pair['sub_name'])
+            return dict((k, sorted(v)) for k, v in categories.iteritems())
+
+
+    @instrumentation_service.instrumented
+    def get_meta(self, name):
+        """Get a named bookkeeping document.
+
+        @param name: The name of the document.
+        @type name: str
+        @return: The document or None if there is no document with the name.
+        @rtype: dict or None
+        """
+        with self.lock:
+            return copy.deepcopy(self.meta.get(name, None))
+
+
+    @instrumentation_service.instrumented
+    def upsert_meta(self, document):
+        """Insert or replace a named bookkeeping document.
+
+        @param document: The document, with its name under "name".
+        @type document: dict
+        """
+        with self.lock:
+            self.meta[document['name']] = copy.deepcopy(document)
+
+
+    @instrumentation_service.instrumented
+    def get_next_sequence(self, name):
+        """Atomically increment a named counter and return its new value.
+
+        @param name: The name of the counter.
+        @type name: str
+        @return: The new value of the counter.
+        @rtype: int
+        """
+        with self.lock:
+            document = self.meta.setdefault(name, {'name': name, 'value': 0})
+            document['value'] += 1
+            return document['value']
+
+
+    @instrumentation_service.instrumented
+    def get_user_by_email(self, user_email):
+        """Find a user given an email address.
+
+        @param user_email: The email address of the user to be found.
+        @type user_email: str
+        @return: The user corresponding to the given email, or None if no user
+            is found.
+        @rtype: dict
+        """
+        with self.lock:
+            return copy.deepcopy(self.users.get(user_email, None))
+
+
+    @instrumentation_service.instrumented
+    def upsert_user(self, user_info):
+        """Updates or inserts a user, with checks for user validity.
+
+        @param user: The user to insert or update. Users are identified by
+            their "_id".
+        @type user: dict
+        @raise pymongo.errors.DuplicateKeyError: Raised if another user has
+            the same email address.
+        """
+        self.ensure_required_fields(
+            user_info,
+            db_service.MINIMUM_REQUIRED_USER_FIELDS
+        )
+        with self.lock:
+            if not '_id' in user_info:
+                user_info['_id'] = bson.ObjectId()
+            other_user = self.users.get(user_info['email'], user_info)
+            if other_user['_id'] != user_info['_id']:
+                raise errors.DuplicateKeyError(
+                    'E11000 duplicate key error index: email dup key: %s' %
+                    user_info['email'],
+                    11000
+                )
+            for email, user in self.users.items():
+                if user['_id'] == user_info['_id']:
+                    del self.users[email]
+            self.users[user_info['email']] = copy.deepcopy(user_info)
+
+
+    @instrumentation_service.instrumented
+    def delete_user(self, user_email):
+        """Delete a user given a that user's email address.
+
+        @param user_email: The email address of the user to delete.
+        @type user_email: str
+        """
+        with self.lock:
+            self.users.pop(user_email, None)
+
+
+    @instrumentation_service.instrumented
+    def distinct(self, key, listing_slug=None):
+        """Get the unique values of a listing field.
+
+        Like mongodb, list fields contribute each of their elements. Only
+        published listings are considered. Tags are served from the tag index
+        when not limited to a slug.
+
+        @param key: The listing field to get the values of.
+        @type key: str
+        @keyword listing_slug: If given, only consider listings with slugs
+            beginning with this slug.
+        @type listing_slug: str
+        @return: The unique values of the field.
+        @rtype: list
+        """
+        with self.lock:
+            if key == 'tags' and listing_slug == None:
+                tags = []
+                for tag, listing_ids in self.listing_ids_by_tag.iteritems():
+                    listings = self.get_public_listings(listing_ids)
+                    if listings:
+                        tags.append(self.get_first_listing_tag(tag, listings))
+                return tags
+
+            if listing_slug == None:
+                listings = self.public_listings.itervalues()
+            else:
+                listings = self.get_public_listings(
+                    self.get_slug_ids(listing_slug)
+                )
+
+            values = {}
+            for listing in listings:
+                for value in get_field_values(listing, key):
+                    values.setdefault(freeze(value), value)
+            return [copy.deepcopy(x) for x in values.itervalues()]
+
+
+    def get_first_listing_tag(self, tag, listings):
+        """Get a copy of an indexed tag from one of the listings with it.
+
+        @param tag: The frozen tag.
+        @type tag: tuple
+        @param listings: The public copies of the listings with the tag.
+        @type listings: list of dict
+        @return: The tag as stored in the listing.
+        @rtype: dict
+        """
+        listing = min(listings, key=lambda x: x['_id'])
+        for value in get_field_values(listing, 'tags'):
+            if freeze(value) == tag:
+                return copy.deepcopy(value)
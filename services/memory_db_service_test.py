@@ -0,0 +1,448 @@
+"""Tests for memory_db_service.
+
+@license: GNU GPLv3
+"""
+import copy
+
+import mox
+from bson import raw_bson
+from pymongo import errors
+
+try:
+    from tinyclassified import tiny_classified
+except:
+    import tiny_classified
+
+import cache_service
+import db_service
+import listing_service
+import memory_db_service
+
+
+def make_listing(name, tags, featured=False):
+    listing = {
+        'author_email': '%s@example.com' % name.lower(),
+        'name': name,
+        'about': 'About %s' % name,
+        'tags': tags,
+        'featured': featured,
+        'is_published': True
+    }
+    listing_service.calculate_slugs(listing)
+    return listing
+
+
+TEST_LISTINGS = [
+    make_listing('Bravo', {'Food': ['Pizza']}, featured=True),
+    make_listing('Alpha', {'Food': ['Pizza', 'Tacos']}),
+    make_listing('Charlie', {'Shops': ['Books']})
+]
+
+
+class MemoryDBAdapterTests(mox.MoxTestBase):
+
+    def setUp(self):
+        mox.MoxTestBase.setUp(self)
+        self.adapter = memory_db_service.MemoryDBAdapter()
+        for listing in copy.deepcopy(TEST_LISTINGS):
+            self.adapter.upsert_listing(listing)
+            self.adapter.upsert_public_listing(listing)
+
+    def get_names(self, listings):
+        return [x['name'] for x in listings]
+
+    def test_get_listing_by_id(self):
+        listing = self.adapter.get_listing_by_name('Alpha')
+        self.assertEqual(
+            listing,
+            self.adapter.get_listing_by_id(listing['_id'])
+        )
+        self.assertEqual(None, self.adapter.get_listing_by_id('unknown'))
+
+    def test_upsert_listing_assigns_id_and_copies(self):
+        listing = make_listing('Delta', {'Food': ['Pizza']})
+        self.adapter.upsert_listing(listing)
+        self.assertTrue('_id' in listing)
+
+        listing['about'] = 'Changed'
+        result = self.adapter.get_listing_by_name('Delta')
+        self.assertEqual('About Delta', result['about'])
+
+        result['about'] = 'Changed again'
+        result = self.adapter.get_listing_by_name('Delta')
+        self.assertEqual('About Delta', result['about'])
+
+    def test_upsert_listing_duplicate_name(self):
+        listing = make_listing('Alpha', {})
+        with self.assertRaises(errors.DuplicateKeyError):
+            self.adapter.upsert_listing(listing)
+
+    def test_upsert_listing_limited_fields(self):
+        listing = make_listing('Delta', {})
+        listing['not_allowed'] = True
+        with self.assertRaises(ValueError):
+            self.adapter.upsert_listing(listing)
+
+    def test_upsert_listing_reindexes(self):
+        listing = self.adapter.get_listing_by_name('Charlie')
+        listing['name'] = 'Charles'
+        listing['tags'] = {'Food': ['Tacos']}
+        listing_service.calculate_slugs(listing)
+        self.adapter.upsert_listing(listing)
+
+        self.assertEqual(None, self.adapter.get_listing_by_name('Charlie'))
+        self.assertEqual(None,
+            self.adapter.get_listing_by_slug('Shops/Books/Charlie'))
+        self.assertEqual('Charles',
+            self.adapter.get_listing_by_slug('Food/Tacos/Charles')['name'])
+        self.assertEqual([],
+            self.adapter.list_listings_by_slug('shops'))
+
+    def test_get_listing_by_slug_and_email(self):
+        result = self.adapter.get_listing_by_slug('Food/Pizza/Alpha')
+        self.assertEqual('Alpha', result['name'])
+        self.assertEqual(None, self.adapter.get_listing_by_slug('food/pizza'))
+
+        result = self.adapter.get_listing_by_email('bravo@example.com')
+        self.assertEqual('Bravo', result['name'])
+        self.assertEqual(None,
+            self.adapter.get_listing_by_email('other@example.com'))
+
+    def test_raw_reads(self):
+        listing = self.adapter.get_listing_by_name('Alpha')
+        result = self.adapter.get_listing_by_id(
+            listing['_id'],
+            public=True,
+            raw=True
+        )
+        self.assertTrue(isinstance(result, raw_bson.RawBSONDocument))
+        self.assertEqual('Alpha', result['name'])
+
+        result = self.adapter.list_listings_by_slug(
+            'food',
+            fields=db_service.LISTING_SUMMARY_FIELDS,
+            raw=True
+        )
+        self.assertTrue(isinstance(result[0], raw_bson.RawBSONDocument))
+        self.assertEqual(['Alpha', 'Bravo'], self.get_names(result))
+        self.assertEqual(
+            None,
+            self.adapter.get_listing_by_slug(
+                'food/pizza',
+                public=True,
+                raw=True
+            )
+        )
+
+    def test_list_listings_by_slug_prefix(self):
+        result = self.adapter.list_listings_by_slug('food')
+        self.assertEqual(['Alpha', 'Bravo'], self.get_names(result))
+
+        result = self.adapter.list_listings_by_slug('Food/Tacos')
+        self.assertEqual(['Alpha'], self.get_names(result))
+
+        result = self.adapter.list_listings_by_slug('')
+        self.assertEqual(['Alpha', 'Bravo', 'Charlie'], self.get_names(result))
+
+        result = self.adapter.list_listings_by_slug('Food.')
+        self.assertEqual([], result)
+
+        result = self.adapter.list_listings_by_slug('Foo')
+        self.assertEqual([], result)
+
+        result = self.adapter.list_listings_by_slug('food/pizza/b')
+        self.assertEqual(['Bravo'], self.get_names(result))
+
+    def test_list_listings_by_slug_page(self):
+        result = self.adapter.list_listings_by_slug(
+            '',
+            fields=db_service.LISTING_SUMMARY_FIELDS,
+            after_name='Alpha',
+            limit=1
+        )
+        self.assertEqual(['Bravo'], self.get_names(result))
+        self.assertFalse('about' in result[0])
+        self.assertTrue('_id' in result[0])
+
+    def test_list_featured_listings_by_slug(self):
+        result = self.adapter.list_featured_listings_by_slug('Food')
+        self.assertEqual(['Bravo'], self.get_names(result))
+        self.assertEqual([], self.adapter.list_featured_listings_by_slug('sh'))
+
+    def test_get_tags(self):
+        result = self.adapter.get_tags()
+        self.assertEqual(3, len(result))
+        self.assertTrue({'Shops': ['Books']} in result)
+
+        result = self.adapter.get_tags(listing_slug='food/tacos')
+        self.assertEqual([{'Food': ['Pizza', 'Tacos']}], result)
+
+    def test_get_tag_tree(self):
+        self.assertEqual(
+            {'Food': ['Pizza', 'Tacos'], 'Shops': ['Books']},
+            self.adapter.get_tag_tree()
+        )
+        self.assertEqual(
+            {'Food': ['Pizza', 'Tacos']},
+            self.adapter.get_tag_tree(listing_slug='FOOD/tacos')
+        )
+
+    def test_distinct(self):
+        result = self.adapter.distinct('featured', listing_slug='food')
+        self.assertEqual([False, True], sorted(result))
+
+    def test_public_reads_only_see_published_listings(self):
+        draft = make_listing('Delta', {'Food': ['Pizza']})
+        self.adapter.upsert_listing(draft)
+        self.assertEqual(
+            ['Alpha', 'Bravo'],
+            self.get_names(self.adapter.list_listings_by_slug('food'))
+        )
+        self.assertEqual(None, self.adapter.get_listing_by_id(
+            draft['_id'],
+            public=True
+        ))
+        self.assertEqual(4, len(self.adapter.index_listings()))
+        self.assertEqual(3, len(self.adapter.index_listings(public=True)))
+
+        self.adapter.upsert_public_listing(draft)
+        result = self.adapter.get_listing_by_slug(
+            'Food/Pizza/Delta',
+            public=True
+        )
+        self.assertEqual('Delta', result['name'])
+        self.assertFalse('is_published' in result)
+
+        self.adapter.set_about_html(draft['_id'], 'About Delta', 'html', 2)
+        result = self.adapter.get_listing_by_id(draft['_id'], public=True)
+        self.assertEqual('html', result['about_html'])
+
+        self.adapter.delete_public_listing(draft['_id'])
+        self.assertEqual(None, self.adapter.get_listing_by_slug(
+            'Food/Pizza/Delta',
+            public=True
+        ))
+        self.assertEqual(
+            ['Alpha', 'Bravo'],
+            self.get_names(self.adapter.list_listings_by_slug('food'))
+        )
+
+    def test_bulk_upsert_listings(self):
+        listings = [
+            make_listing('Delta', {}),
+            make_listing('Alpha', {}),
+            make_listing('Echo', {})
+        ]
+        results = self.adapter.bulk_upsert_listings(listings)
+        self.assertEqual(None, results[0])
+        self.assertTrue('duplicate key' in results[1])
+        self.assertEqual(None, results[2])
+        self.assertNotEqual(None, self.adapter.get_listing_by_name('Echo'))
+
+        listings = [make_listing('Alpha', {}), make_listing('Foxtrot', {})]
+        results = self.adapter.bulk_upsert_listings(listings, ordered=True)
+        self.assertEqual(db_service.NOT_ATTEMPTED_MESSAGE, results[1])
+        self.assertEqual(None, self.adapter.get_listing_by_name('Foxtrot'))
+
+    def test_bulk_upsert_listings_slug_index(self):
+        alpha = self.adapter.get_listing_by_name('Alpha')
+        alpha['tags'] = {'Food': ['Pizza']}
+        listing_service.calculate_slugs(alpha)
+        listings = [
+            alpha,
+            make_listing('Delta', {'Food': ['Pizza']}),
+            make_listing('Alpine', {'Food': ['Tacos']})
+        ]
+        self.adapter.bulk_upsert_listings(listings)
+        self.adapter.bulk_publish_listings(listings)
+        self.assertEqual(None, self.adapter.sorted_slugs)
+
+        result = self.adapter.list_listings_by_slug('Food/Pizza/Al')
+        self.assertEqual(['Alpha'], self.get_names(result))
+        result = self.adapter.list_listings_by_slug('Food/Tacos/Al')
+        self.assertEqual(['Alpine'], self.get_names(result))
+        self.assertEqual(
+            sorted(self.adapter.normalized_slugs),
+            self.adapter.sorted_slugs
+        )
+
+        alpaca = make_listing('Alpaca', {'Food': ['Pizza']})
+        self.adapter.upsert_listing(alpaca)
+        self.adapter.upsert_public_listing(alpaca)
+        self.adapter.delete_listing_by_name('Alpha')
+        result = self.adapter.list_listings_by_slug('Food/Pizza/Al')
+        self.assertEqual(['Alpaca'], self.get_names(result))
+        self.assertEqual(
+            sorted(self.adapter.normalized_slugs),
+            self.adapter.sorted_slugs
+        )
+
+    def test_delete_listing_by_slug(self):
+        self.adapter.delete_listing_by_slug('Food/Pizza/Bravo')
+        self.assertEqual(None, self.adapter.get_listing_by_name('Bravo'))
+        self.assertEqual(['Alpha'],
+            self.get_names(self.adapter.list_listings_by_slug('food')))
+        self.assertEqual(None,
+            self.adapter.get_listing_by_email('bravo@example.com'))
+
+        with self.assertRaises(ValueError):
+            self.adapter.delete_listing_by_slug('Food/Pizza/Bravo')
+
+    def test_delete_listing_by_name(self):
+        self.adapter.delete_listing_by_name('Charlie')
+        self.assertEqual(2, len(self.adapter.index_listings()))
+        self.assertEqual(2, len(self.adapter.get_tags()))
+
+    def test_category_summaries(self):
+        summary = {'_id': 'food', 'version': 1, 'listings': [{'name': 'A'}],
+            'subcategories': []}
+        self.assertTrue(self.adapter.upsert_category_summary(summary))
+        summary['subcategories'].append('Pizza')
+        self.assertEqual([], self.adapter.get_category_summary('food')[
+            'subcategories'])
+
+        self.assertFalse(self.adapter.upsert_category_summary(summary))
+        summary['version'] = 2
+        self.assertTrue(self.adapter.upsert_category_summary(summary))
+        self.assertEqual(summary, self.adapter.get_category_summary('food'))
+
+        self.adapter.upsert_category_summary(
+            {'_id': 'food', 'version': 3, 'listings': []})
+        self.assertEqual(None, self.adapter.get_category_summary('food'))
+        self.assertEqual(['food'], self.adapter.list_category_summary_ids())
+
+        self.adapter.delete_category_summary('food', 2)
+        self.assertEqual(['food'], self.adapter.list_category_summary_ids())
+        self.adapter.delete_category_summary('food', 3)
+        self.adapter.delete_category_summary('food', 3)
+        self.assertEqual([], self.adapter.list_category_summary_ids())
+
+    def test_get_next_sequence(self):
+        self.assertEqual(1, self.adapter.get_next_sequence('counter'))
+        self.assertEqual(2, self.adapter.get_next_sequence('counter'))
+        self.assertEqual(1, self.adapter.get_next_sequence('other'))
+
+    def test_list_listing_batch(self):
+        listings = self.adapter.list_listing_batch(fields=['name'])
+        listing_ids = [x['_id'] for x in listings]
+        self.assertEqual(sorted(listing_ids), listing_ids)
+        self.assertEqual([['_id', 'name']] * 3,
+            [sorted(x.keys()) for x in listings])
+
+        batch = self.adapter.list_listing_batch(
+            after_id=listing_ids[0],
+            upper_id=listing_ids[1]
+        )
+        self.assertEqual(listing_ids[1:2], [x['_id'] for x in batch])
+        batch = self.adapter.list_listing_batch(after_id=listing_ids[0],
+            limit=1)
+        self.assertEqual(listing_ids[1:2], [x['_id'] for x in batch])
+
+        self.assertEqual(listing_ids[:1],
+            self.adapter.get_listing_id_split_points(2))
+        self.assertEqual(listing_ids[:2],
+            self.adapter.get_listing_id_split_points(3))
+        self.assertEqual(listing_ids[:2],
+            self.adapter.get_listing_id_split_points(5))
+
+    def test_update_listing_fields(self):
+        alpha = self.adapter.get_listing_by_name('Alpha')
+        bravo = self.adapter.get_listing_by_name('Bravo')
+        count = self.adapter.update_listing_fields([
+            (alpha['_id'], {'about': 'About Alpha'}, {'about': 'New'}),
+            (bravo['_id'], {'about': 'Changed'}, {'about': 'New'})
+        ])
+
+        self.assertEqual(1, count)
+        self.assertEqual('New', self.adapter.get_listing_by_name('Alpha')[
+            'about'])
+        self.assertEqual('New', self.adapter.get_listing_by_id(alpha['_id'],
+            public=True)['about'])
+        self.assertEqual('About Bravo', self.adapter.get_listing_by_name(
+            'Bravo')['about'])
+
+    def test_list_listings_near(self):
+        for (name, latitude, longitude) in [
+            ('Alpha', 47.61, -122.33),
+            ('Bravo', 47.60, -122.33),
+            ('Charlie', 45.52, -122.68)
+        ]:
+            listing = self.adapter.get_listing_by_name(name)
+            listing['latitude'] = latitude
+            listing['longitude'] = longitude
+            listing_service.set_location(listing)
+            self.adapter.upsert_listing(listing)
+            self.adapter.upsert_public_listing(listing)
+
+        listings = self.adapter.list_listings_near(-122.33, 47.60,
+            fields=['name'])
+        self.assertEqual(['Bravo', 'Alpha', 'Charlie'],
+            self.get_names(listings))
+        self.assertEqual(0, listings[0]['distance'])
+        self.assertTrue(1100 < listings[1]['distance'] < 1120)
+        self.assertEqual(['_id', 'distance', 'name'],
+            sorted(listings[0].keys()))
+
+        self.assertEqual(['Alpha'], self.get_names(
+            self.adapter.list_listings_near(-122.33, 47.60, skip=1, limit=1)))
+        self.assertEqual(['Bravo', 'Alpha'], self.get_names(
+            self.adapter.list_listings_near(-122.33, 47.60,
+                max_distance=10000)))
+        self.assertEqual(['Bravo', 'Alpha'], self.get_names(
+            self.adapter.list_listings_near(-122.33, 47.60,
+                listing_slug='food')))
+        self.assertEqual(['Charlie'], self.get_names(
+            self.adapter.list_listings_near(-122.33, 47.60,
+                listing_slug='shops')))
+
+    def test_meta(self):
+        document = {'name': 'migration:test', 'done': False}
+        self.adapter.upsert_meta(document)
+        document['done'] = True
+        self.assertFalse(self.adapter.get_meta('migration:test')['done'])
+
+        self.adapter.upsert_meta(document)
+        self.assertEqual(document, self.adapter.get_meta('migration:test'))
+        self.assertEqual(None, self.adapter.get_meta('unknown'))
+
+    def test_users(self):
+        user = {
+            'email': 'test@example.com',
+            'password_hash': 'hash',
+            'is_admin': False
+        }
+        self.adapter.upsert_user(user)
+        self.assertEqual(user, self.adapter.get_user_by_email(user['email']))
+
+        other_user = copy.deepcopy(user)
+        del other_user['_id']
+        with self.assertRaises(errors.DuplicateKeyError):
+            self.adapter.upsert_user(other_user)
+
+        self.adapter.delete_user(user['email'])
+        self.assertEqual(None, self.adapter.get_user_by_email(user['email']))
+
+    def test_listing_service_through_adapter(self):
+        original_db_adapter = tiny_classified.get_db_adapter()
+        cache_service.CACHES['listing'] = cache_service.LRUCache(0, 0, 0)
+        tiny_classified.set_db_adapter(self.adapter)
+        try:
+            listing_service.create(make_listing('Delta', {'Food': ['Pie']}))
+            result = listing_service.list_by_slug('Food', page_size=2)
+            self.assertEqual(['Alpha', 'Bravo'],
+                self.get_names(result['listings']))
+
+            result = listing_service.list_by_slug(
+                'Food',
+                page_token=result['next_page_token'],
+                page_size=2
+            )
+            self.assertEqual(['Delta'], self.get_names(result['listings']))
+            self.assertEqual(None, result['next_page_token'])
+
+            result = listing_service.read_by_slug('Food/Pie/Delta')
+            listing_service.delete(result)
+            self.assertEqual(None, listing_service.read_by_email(
+                'delta@example.com'))
+        finally:
+            tiny_classified.set_db_adapter(original_db_adapter)
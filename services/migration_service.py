@@ -0,0 +1,527 @@
+"""Service for migrating saved listings to new schemas in the background.
+
+Migrations read the listing collection in id order, batch by batch, and only
+write the fields which changed. Each write is conditional on the fields the
+migration read so that it never overwrites a concurrent edit. Progress is kept
+in meta documents so that an interrupted migration resumes where it stopped
+and a finished one is not run again. The listing collection may be split into
+id ranges migrated in parallel, and the reads and writes of all of them are
+throttled to a target rate so that migrations can run on a live database.
+
+@license: GNU GPLv3
+"""
+import datetime
+import logging
+import threading
+import time
+
+try:
+    from tinyclassified import tiny_classified
+except:
+    import tiny_classified
+
+import cache_service
+import category_index_service
+import listing_service
+
+DEFAULT_MIGRATION_BATCH_SIZE = 100
+DEFAULT_MIGRATION_OPS_PER_SECOND = 200
+DEFAULT_MIGRATION_WORKERS = 1
+MIGRATION_META_PREFIX = 'migration:'
+
+# Fields which decide the categories a listing is listed under. Migrating them
+# changes category summaries and the category index.
+CATEGORY_FIELDS = ['slugs', 'slugs_normalized', 'categories', 'tag_pairs']
+
+DATE_FORMATS = [
+    '%Y-%m-%d %H:%M:%S',
+    '%Y-%m-%d %H:%M:%S.%f',
+    '%Y-%m-%dT%H:%M:%S',
+    '%Y-%m-%d',
+    '%m/%d/%Y %H:%M:%S',
+    '%m/%d/%Y %I:%M:%S %p',
+    '%m/%d/%Y'
+]
+
+
+class Migration:
+    """A named change applied to every saved listing."""
+
+    def __init__(self, name, fields, guard_fields, migrate):
+        """Create a new migration.
+
+        @param name: The unique name of the migration under which its progress
+            is saved.
+        @type name: str
+        @param fields: The listing fields read by the migration.
+        @type fields: list of str
+        @param guard_fields: The fields (of fields) which must not change
+            between reading and updating a listing for the update to apply.
+            Only give fields holding strings, numbers or lists of them as
+            documents are not compared reliably.
+        @type guard_fields: list of str
+        @param migrate: Function taking a listing with the given fields and
+            returning a dict of the fields to set on it (empty or None if the
+            listing is already migrated).
+        @type migrate: function
+        """
+        self.name = name
+        self.fields = fields
+        self.guard_fields = guard_fields
+        self.migrate = migrate
+
+
+def get_batch_size():
+    """Get the number of listings read by each migration query.
+
+    @return: The configured batch size.
+    @rtype: int
+    """
+    return tiny_classified.get_config().get(
+        'MIGRATION_BATCH_SIZE',
+        DEFAULT_MIGRATION_BATCH_SIZE
+    )
+
+
+def get_ops_per_second():
+    """Get the total rate of listing reads and writes of a migration.
+
+    @return: The configured number of listings read or written per second,
+        shared by all of a migration's workers.
+    @rtype: float
+    """
+    return tiny_classified.get_config().get(
+        'MIGRATION_OPS_PER_SECOND',
+        DEFAULT_MIGRATION_OPS_PER_SECOND
+    )
+
+
+def get_workers():
+    """Get the number of id ranges migrated in parallel by new migrations.
+
+    @return: The configured number of workers.
+    @rtype: int
+    """
+    return tiny_classified.get_config().get(
+        'MIGRATION_WORKERS',
+        DEFAULT_MIGRATION_WORKERS
+    )
+
+
+def parse_date(value):
+    """Parse a date saved as a string by the data importer.
+
+    @param value: The string to parse.
+    @type value: str
+    @return: The parsed date or None if value is not in one of DATE_FORMATS.
+    @rtype: datetime.datetime
+    """
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.datetime.strptime(value.strip(), date_format)
+        except ValueError:
+            pass
+    return None
+
+
+def migrate_coordinates(listing):
+    """Convert the latitude and longitude of a listing to numbers.
+
+    @param listing: The listing with its latitude and longitude.
+    @type listing: dict
+    @return: The coordinates saved as strings, as floats. Empty strings become
+        None and coordinates which are not numbers are left as they are.
+    @rtype: dict
+    """
+    changes = {}
+    for field in ['latitude', 'longitude']:
+        value = listing.get(field, None)
+        if not isinstance(value, basestring):
+            continue
+        if not value.strip():
+            changes[field] = None
+            continue
+        try:
+            changes[field] = float(value)
+        except ValueError:
+            logging.warning(
+                'Listing %s has a %s which is not a number: %r',
+                listing['_id'],
+                field,
+                value
+            )
+    return changes
+
+
+def migrate_dates(listing):
+    """Convert the creation and modification dates of a listing to dates.
+
+    @param listing: The listing with its datecreated and datemodified.
+    @type listing: dict
+    @return: The dates saved as strings, as datetimes. Dates which can not be
+        parsed are left as they are.
+    @rtype: dict
+    """
+    changes = {}
+    for field in ['datecreated', 'datemodified']:
+        value = listing.get(field, None)
+        if not isinstance(value, basestring):
+            continue
+        date = parse_date(value)
+        if date == None:
+            logging.warning(
+                'Listing %s has a %s which is not a date: %r',
+                listing['_id'],
+                field,
+                value
+            )
+        else:
+            changes[field] = date
+    return changes
+
+
+def migrate_slug_fields(listing):
+    """Calculate the slug and normalized tag fields missing from a listing.
+
+    @param listing: The listing with its name, tags and slug fields.
+    @type listing: dict
+    @return: The slug fields (see listing_service.calculate_slugs) which are
+        missing or out of date.
+    @rtype: dict
+    """
+    if not listing.get('name', None) or not isinstance(
+        listing.get('tags', None),
+        dict
+    ):
+        return {}
+
+    calculated = {'name': listing['name'], 'tags': listing['tags']}
+    listing_service.calculate_slugs(calculated)
+
+    changes = {}
+    for field in ['slugs', 'slugs_normalized']:
+        if not field in listing or \
+            sorted(listing[field]) != sorted(calculated[field]):
+            changes[field] = calculated[field]
+    for field in ['categories', 'tag_pairs']:
+        if listing.get(field, None) != calculated[field]:
+            changes[field] = calculated[field]
+    return changes
+
+
+def migrate_location(listing):
+    """Calculate the location of a listing from its coordinates.
+
+    @param listing: The listing with its latitude, longitude and location.
+    @type listing: dict
+    @return: The location (see listing_service.set_location) if it is missing
+        or out of date.
+    @rtype: dict
+    """
+    location = listing_service.get_location(listing)
+    if location == listing.get('location', None):
+        return {}
+    return {'location': location}
+
+
+MIGRATIONS = [
+    Migration(
+        'typed_coordinates',
+        ['latitude', 'longitude'],
+        ['latitude', 'longitude'],
+        migrate_coordinates
+    ),
+    Migration(
+        'typed_dates',
+        ['datecreated', 'datemodified'],
+        ['datecreated', 'datemodified'],
+        migrate_dates
+    ),
+    Migration(
+        'slug_fields',
+        [
+            'name',
+            'tags',
+            'slugs',
+            'slugs_normalized',
+            'categories',
+            'tag_pairs'
+        ],
+        ['name', 'slugs'],
+        migrate_slug_fields
+    ),
+    Migration(
+        'location',
+        ['latitude', 'longitude', 'location'],
+        ['latitude', 'longitude'],
+        migrate_location
+    )
+]
+
+
+def get_migration(name):
+    """Find a migration by name.
+
+    @param name: The name of the migration.
+    @type name: str
+    @return: The migration.
+    @rtype: Migration
+    @raise ValueError: If there is no migration with the given name.
+    """
+    for migration in MIGRATIONS:
+        if migration.name == name:
+            return migration
+    raise ValueError('Unknown migration: %s' % name)
+
+
+def get_plan_name(migration):
+    """Get the name of the meta document with a migration's id ranges.
+
+    @param migration: The migration.
+    @type migration: Migration
+    @return: The name of the migration's plan.
+    @rtype: str
+    """
+    return MIGRATION_META_PREFIX + migration.name
+
+
+def get_progress_name(migration, index):
+    """Get the name of the meta document with the progress in an id range.
+
+    @param migration: The migration.
+    @type migration: Migration
+    @param index: The index of the id range in the migration's plan.
+    @type index: int
+    @return: The name of the range's progress document.
+    @rtype: str
+    """
+    return '%s%s:%d' % (MIGRATION_META_PREFIX, migration.name, index)
+
+
+def plan_ranges(migration, workers):
+    """Get the plan of a migration, splitting listings into id ranges if new.
+
+    The ranges of a migration are kept from its first run so that progress in
+    each of them can be resumed, whatever the number of workers afterwards.
+
+    @param migration: The migration to plan.
+    @type migration: Migration
+    @param workers: The number of id ranges to split the listings into.
+    @type workers: int
+    @return: The plan, with a list of (after id, up to id) pairs under
+        "ranges" where None means the range is unbounded, and whether the
+        migration finished under "done".
+    @rtype: dict
+    """
+    db_adapter = tiny_classified.get_db_adapter()
+    plan_name = get_plan_name(migration)
+    plan = db_adapter.get_meta(plan_name)
+    if plan:
+        return plan
+
+    bounds = [None] + db_adapter.get_listing_id_split_points(workers) + [None]
+    plan = {
+        'name': plan_name,
+        'ranges': [[bounds[i], bounds[i + 1]] for i in range(len(bounds) - 1)],
+        'started': datetime.datetime.utcnow(),
+        'done': False
+    }
+    db_adapter.upsert_meta(plan)
+    return plan
+
+
+def migrate_range(migration, index, lower, upper, batch_size,
+    ops_per_second):
+    """Migrate the listings in an id range, resuming saved progress.
+
+    The category summaries of listings whose CATEGORY_FIELDS are migrated are
+    refreshed after each batch and the category index of this process is
+    reset. Other processes pick the changes up on their next index rebuild.
+
+    @param migration: The migration to run.
+    @type migration: Migration
+    @param index: The index of the id range in the migration's plan.
+    @type index: int
+    @param lower: Migrate listings with ids after this one or None to start
+        from the first listing.
+    @type lower: bson.objectid.ObjectId
+    @param upper: Migrate listings with ids up to and including this one or
+        None to continue to the last listing.
+    @type upper: bson.objectid.ObjectId
+    @param batch_size: The number of listings to read at a time.
+    @type batch_size: int
+    @param ops_per_second: The maximum number of listings to read or write per
+        second or None not to throttle.
+    @type ops_per_second: float
+    @return: The range's progress, with the number of listings read under
+        "scanned" and updated under "migrated".
+    @rtype: dict
+    """
+    db_adapter = tiny_classified.get_db_adapter()
+    cache = cache_service.get_listing_cache()
+    progress_name = get_progress_name(migration, index)
+    progress = db_adapter.get_meta(progress_name) or {
+        'name': progress_name,
+        'last_id': lower,
+        'scanned': 0,
+        'migrated': 0,
+        'done': False
+    }
+
+    start = time.time()
+    ops = 0
+    while not progress['done']:
+        listings = db_adapter.list_listing_batch(
+            fields=migration.fields,
+            after_id=progress['last_id'],
+            upper_id=upper,
+            limit=batch_size
+        )
+
+        updates = []
+        slugs = []
+        for listing in listings:
+            changes = migration.migrate(listing)
+            if changes:
+                expected = dict(
+                    (k, listing.get(k, None)) for k in migration.guard_fields
+                )
+                updates.append((listing['_id'], expected, changes))
+                if any(x in changes for x in CATEGORY_FIELDS):
+                    slugs.extend(listing.get('slugs', None) or [])
+                    slugs.extend(changes.get('slugs', None) or [])
+
+        migrated = db_adapter.update_listing_fields(updates)
+        listing_service.record_local_write(
+            [listing_id for (listing_id, expected, changes) in updates],
+            slugs
+        )
+        for (listing_id, expected, changes) in updates:
+            cache.invalidate_tag(listing_id)
+        if slugs:
+            listing_service.refresh_category_summaries(slugs)
+            category_index_service.reset()
+
+        progress['scanned'] += len(listings)
+        progress['migrated'] += migrated
+        if listings:
+            progress['last_id'] = listings[-1]['_id']
+        progress['done'] = len(listings) < batch_size
+        db_adapter.upsert_meta(progress)
+
+        ops += len(listings) + len(updates)
+        if ops_per_second:
+            wait = float(ops) / ops_per_second - (time.time() - start)
+            if wait > 0:
+                time.sleep(wait)
+
+    return progress
+
+
+def run_migration(name, workers=None, batch_size=None, ops_per_second=None):
+    """Run a migration to completion, resuming it if it was interrupted.
+
+    @param name: The name of the migration to run.
+    @type name: str
+    @keyword workers: The number of id ranges migrated in parallel when the
+        migration starts or None for MIGRATION_WORKERS. Resumed migrations
+        keep their first ranges.
+    @type workers: int
+    @keyword batch_size: The number of listings to read at a time or None
+        for MIGRATION_BATCH_SIZE.
+    @type batch_size: int
+    @keyword ops_per_second: The maximum number of listings read or written
+        per second by all workers or None for MIGRATION_OPS_PER_SECOND.
+    @type ops_per_second: float
+    @return: The total number of listings read under "scanned" and updated
+        under "migrated" by this and earlier runs.
+    @rtype: dict
+    @raise ValueError: If there is no migration with the given name.
+    """
+    migration = get_migration(name)
+    if workers == None:
+        workers = get_workers()
+    if batch_size == None:
+        batch_size = get_batch_size()
+    if ops_per_second == None:
+        ops_per_second = get_ops_per_second()
+
+    db_adapter = tiny_classified.get_db_adapter()
+    plan = plan_ranges(migration, workers)
+    ranges = plan['ranges']
+    range_ops_per_second = None
+    if ops_per_second:
+        range_ops_per_second = float(ops_per_second) / len(ranges)
+
+    results = [None] * len(ranges)
+    errors = []
+
+    def run(index):
+        (lower, upper) = ranges[index]
+        try:
+            results[index] = migrate_range(
+                migration,
+                index,
+                lower,
+                upper,
+                batch_size,
+                range_ops_per_second
+            )
+        except Exception as e:
+            logging.exception('Migration %s failed in range %d.', name, index)
+            errors.append(e)
+
+    if plan['done']:
+        results = [
+            db_adapter.get_meta(get_progress_name(migration, i))
+            for i in range(len(ranges))
+        ]
+    elif len(ranges) == 1:
+        results[0] = migrate_range(
+            migration,
+            0,
+            ranges[0][0],
+            ranges[0][1],
+            batch_size,
+            range_ops_per_second
+        )
+    else:
+        threads = [
+            threading.Thread(
+                target=run,
+                args=(i,),
+                name='migration_%s_%d' % (name, i)
+            )
+            for i in range(len(ranges))
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+
+    if not plan['done']:
+        plan['done'] = True
+        plan['finished'] = datetime.datetime.utcnow()
+        db_adapter.upsert_meta(plan)
+
+    results = [x for x in results if x]
+    return {
+        'scanned': sum(x['scanned'] for x in results),
+        'migrated': sum(x['migrated'] for x in results)
+    }
+
+
+def run_migrations(workers=None):
+    """Run every migration in MIGRATIONS in order.
+
+    @keyword workers: The number of id ranges migrated in parallel by new
+        migrations or None for MIGRATION_WORKERS.
+    @type workers: int
+    @return: The totals of each migration (see run_migration) by name.
+    @rtype: dict
+    """
+    return dict(
+        (x.name, run_migration(x.name, workers=workers)) for x in MIGRATIONS
+    )
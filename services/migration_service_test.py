@@ -0,0 +1,300 @@
+"""Tests for migration_service.
+
+@license: GNU GPLv3
+"""
+import datetime
+import time
+
+import mox
+
+try:
+    from tinyclassified import tiny_classified
+except:
+    import tiny_classified
+
+import cache_service
+import category_index_service
+import listing_service
+import memory_db_service
+import migration_service
+
+
+def make_listing(name, **fields):
+    listing = {
+        'author_email': '%s@example.com' % name.lower(),
+        'name': name,
+        'tags': {'Food': ['Pizza']},
+        'is_published': True
+    }
+    listing_service.calculate_slugs(listing)
+    listing.update(fields)
+    return listing
+
+
+class MigrationServiceTests(mox.MoxTestBase):
+
+    def setUp(self):
+        mox.MoxTestBase.setUp(self)
+        self.original_db_adapter = tiny_classified.get_db_adapter()
+        self.db_adapter = memory_db_service.MemoryDBAdapter()
+        tiny_classified.set_db_adapter(self.db_adapter)
+        cache_service.CACHES['listing'] = cache_service.LRUCache(0, 0, 0)
+
+    def tearDown(self):
+        tiny_classified.set_db_adapter(self.original_db_adapter)
+        category_index_service.reset()
+        mox.MoxTestBase.tearDown(self)
+
+    def add_listings(self, listings):
+        for listing in listings:
+            self.db_adapter.upsert_listing(listing)
+            self.db_adapter.upsert_public_listing(listing)
+
+    def test_migrate_coordinates(self):
+        self.assertEqual(
+            {'latitude': 47.5, 'longitude': None},
+            migration_service.migrate_coordinates(
+                {'_id': 1, 'latitude': ' 47.5', 'longitude': ''}
+            )
+        )
+        self.assertEqual(
+            {},
+            migration_service.migrate_coordinates(
+                {'_id': 1, 'latitude': 'north', 'longitude': -122.0}
+            )
+        )
+
+    def test_migrate_dates(self):
+        self.assertEqual(
+            {
+                'datecreated': datetime.datetime(2009, 3, 1, 12, 30),
+                'datemodified': datetime.datetime(2010, 4, 2)
+            },
+            migration_service.migrate_dates({
+                '_id': 1,
+                'datecreated': '2009-03-01 12:30:00',
+                'datemodified': '04/02/2010'
+            })
+        )
+        self.assertEqual(
+            {},
+            migration_service.migrate_dates(
+                {'_id': 1, 'datecreated': 'yesterday'}
+            )
+        )
+
+    def test_migrate_slug_fields(self):
+        listing = make_listing('Alpha')
+        self.assertEqual({}, migration_service.migrate_slug_fields(listing))
+
+        del listing['tag_pairs']
+        listing['slugs_normalized'] = []
+        self.assertEqual(
+            {
+                'slugs_normalized': ['food/pizza/alpha'],
+                'tag_pairs': listing_service.get_tag_pairs(listing['tags'])
+            },
+            migration_service.migrate_slug_fields(listing)
+        )
+
+    def test_migrate_location(self):
+        self.assertEqual(
+            {'location': {'type': 'Point', 'coordinates': [-122.0, 47.5]}},
+            migration_service.migrate_location(
+                {'_id': 1, 'latitude': '47.5', 'longitude': -122.0}
+            )
+        )
+        self.assertEqual(
+            {},
+            migration_service.migrate_location({
+                '_id': 1,
+                'latitude': 47.5,
+                'longitude': -122.0,
+                'location': {'type': 'Point', 'coordinates': [-122.0, 47.5]}
+            })
+        )
+        self.assertEqual(
+            {},
+            migration_service.migrate_location(
+                {'_id': 1, 'latitude': 91, 'longitude': -122.0}
+            )
+        )
+
+    def test_get_migration(self):
+        self.assertEqual(
+            'typed_dates',
+            migration_service.get_migration('typed_dates').name
+        )
+        with self.assertRaises(ValueError):
+            migration_service.get_migration('unknown')
+
+    def test_run_migration(self):
+        self.add_listings([
+            make_listing('Alpha', latitude='47.5', longitude='-122.25'),
+            make_listing('Bravo', latitude=47.5),
+            make_listing('Charlie', latitude='', longitude='-122.25')
+        ])
+
+        result = migration_service.run_migration(
+            'typed_coordinates',
+            batch_size=2,
+            ops_per_second=0
+        )
+
+        self.assertEqual({'scanned': 3, 'migrated': 2}, result)
+        listing = self.db_adapter.get_listing_by_name('Alpha')
+        self.assertEqual(47.5, listing['latitude'])
+        self.assertEqual(-122.25, listing['longitude'])
+        listing = self.db_adapter.get_listing_by_name('Charlie')
+        self.assertEqual(None, listing['latitude'])
+        self.assertEqual(
+            -122.25,
+            self.db_adapter.get_listing_by_id(listing['_id'], public=True)[
+                'longitude'
+            ]
+        )
+
+        self.db_adapter.upsert_listing(
+            make_listing('Delta', latitude='1.0', longitude='2.0')
+        )
+        result = migration_service.run_migration(
+            'typed_coordinates',
+            batch_size=2,
+            ops_per_second=0
+        )
+        self.assertEqual({'scanned': 3, 'migrated': 2}, result)
+        self.assertEqual(
+            '1.0',
+            self.db_adapter.get_listing_by_name('Delta')['latitude']
+        )
+
+    def test_run_migration_resumes(self):
+        listings = [
+            make_listing(name, datecreated='2009-03-01')
+            for name in ['Alpha', 'Bravo', 'Charlie']
+        ]
+        self.add_listings(listings)
+        migration = migration_service.get_migration('typed_dates')
+        self.db_adapter.upsert_meta({
+            'name': migration_service.get_progress_name(migration, 0),
+            'last_id': listings[0]['_id'],
+            'scanned': 1,
+            'migrated': 1,
+            'done': False
+        })
+        self.db_adapter.upsert_meta({
+            'name': migration_service.get_plan_name(migration),
+            'ranges': [[None, None]],
+            'done': False
+        })
+
+        result = migration_service.run_migration(
+            'typed_dates',
+            batch_size=10,
+            ops_per_second=0
+        )
+
+        self.assertEqual({'scanned': 3, 'migrated': 3}, result)
+        self.assertEqual(
+            '2009-03-01',
+            self.db_adapter.get_listing_by_name('Alpha')['datecreated']
+        )
+        self.assertEqual(
+            datetime.datetime(2009, 3, 1),
+            self.db_adapter.get_listing_by_name('Charlie')['datecreated']
+        )
+
+    def test_run_migration_in_parallel(self):
+        names = ['Listing%d' % i for i in range(10)]
+        self.add_listings([
+            make_listing(name, datemodified='2010-04-02 10:00:00')
+            for name in names
+        ])
+
+        result = migration_service.run_migration(
+            'typed_dates',
+            workers=3,
+            batch_size=2,
+            ops_per_second=0
+        )
+
+        self.assertEqual({'scanned': 10, 'migrated': 10}, result)
+        plan = self.db_adapter.get_meta('migration:typed_dates')
+        self.assertEqual(3, len(plan['ranges']))
+        self.assertTrue(plan['done'])
+        for name in names:
+            self.assertEqual(
+                datetime.datetime(2010, 4, 2, 10),
+                self.db_adapter.get_listing_by_name(name)['datemodified']
+            )
+
+    def test_run_migration_refreshes_category_summaries(self):
+        listing = make_listing('Alpha')
+        self.add_listings([listing])
+        listing_service.refresh_category_summaries(listing['slugs'])
+        listing['tags'] = {'Bars': ['Pub']}
+        self.add_listings([listing])
+
+        result = migration_service.run_migration(
+            'slug_fields',
+            ops_per_second=0
+        )
+
+        self.assertEqual({'scanned': 1, 'migrated': 1}, result)
+        self.assertEqual(None, self.db_adapter.get_category_summary('food'))
+        self.assertEqual(
+            ['Alpha'],
+            [x['name'] for x in self.db_adapter.get_category_summary(
+                'bars/pub')['listings']]
+        )
+        self.assertEqual(
+            {'Bars': ['Pub']},
+            listing_service.get_categories(home_only=False)
+        )
+
+    def test_run_migration_skips_concurrent_edits(self):
+        listing = make_listing('Alpha', latitude='47.5')
+        self.add_listings([listing])
+        original_update = self.db_adapter.update_listing_fields
+
+        def edit_then_update(updates):
+            edited = self.db_adapter.get_listing_by_id(listing['_id'])
+            edited['latitude'] = 12.0
+            self.db_adapter.upsert_listing(edited)
+            return original_update(updates)
+
+        self.db_adapter.update_listing_fields = edit_then_update
+        result = migration_service.run_migration(
+            'typed_coordinates',
+            ops_per_second=0
+        )
+
+        self.assertEqual({'scanned': 1, 'migrated': 0}, result)
+        self.assertEqual(
+            12.0,
+            self.db_adapter.get_listing_by_name('Alpha')['latitude']
+        )
+
+    def test_migrate_range_throttles(self):
+        self.add_listings([
+            make_listing(name, latitude='1.0')
+            for name in ['Alpha', 'Bravo', 'Charlie']
+        ])
+        migration = migration_service.get_migration('typed_coordinates')
+
+        self.mox.StubOutWithMock(time, 'sleep')
+        time.sleep(mox.Func(lambda x: 1.5 < x <= 2))
+        time.sleep(mox.Func(lambda x: 2.5 < x <= 3))
+        self.mox.ReplayAll()
+
+        progress = migration_service.migrate_range(
+            migration,
+            0,
+            None,
+            None,
+            2,
+            2
+        )
+
+        self.assertEqual(3, progress['migrated'])
+        self.assertTrue(progress['done'])
@@ -0,0 +1,240 @@
+"""Write-behind counting of listing page views.
+
+Counting views with a write per listing page would add a write to every
+read. Views are instead counted in a buffer in each process and a background
+thread adds the buffered counts to the listings' "views" every
+VIEW_FLUSH_SECONDS with one bulk write per collection. Listing saves never
+overwrite "views" (see db_service.get_replacement_update). Increments
+commute, so any number of threads and worker processes can count the same
+listing. A crash loses at most the views counted since the last flush.
+
+@license: GNU GPLv3
+"""
+import atexit
+import logging
+import os
+import threading
+
+try:
+    from tinyclassified import tiny_classified
+except:
+    import tiny_classified
+
+DEFAULT_VIEW_FLUSH_SECONDS = 10
+DEFAULT_VIEW_BUFFER_MAX_ENTRIES = 10000
+DEFAULT_POPULAR_LISTINGS_LIMIT = 20
+
+BUFFERS = {
+    'view_buffer': None,
+    'pid': None
+}
+BUFFERS_LOCK = threading.Lock()
+
+
+class ViewBuffer:
+    """Buffer of view counts by listing id, flushed on a background thread.
+
+    The buffer holds at most max_entries listings. Views of other listings
+    while it is full are dropped (and counted under "dropped") rather than
+    block the request, and the flush thread is woken to empty it early.
+
+    Counts are added to the listings and then to their public copies, in
+    separate writes. Counts already added to the listings but not yet to the
+    public copies are held in public_counts so that a failed public write is
+    retried without counting the views twice in the listings.
+    """
+
+    def __init__(self, max_entries, flush_interval):
+        """Create a new empty buffer.
+
+        @param max_entries: The maximum number of listings to count views of
+            between flushes.
+        @type max_entries: int
+        @param flush_interval: The number of seconds between flushes.
+        @type flush_interval: float
+        """
+        self.max_entries = max_entries
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self.counts = {}
+        self.public_counts = {}
+        self.dropped = 0
+        self.wake = threading.Event()
+        self.thread = None
+
+    def record(self, listing_id):
+        """Count a view of a listing.
+
+        @param listing_id: The "_id" of the viewed listing.
+        @type listing_id: bson.objectid.ObjectId
+        """
+        with self.lock:
+            if listing_id in self.counts:
+                self.counts[listing_id] += 1
+            elif len(self.counts) < self.max_entries:
+                self.counts[listing_id] = 1
+            else:
+                self.dropped += 1
+            full = len(self.counts) >= self.max_entries
+
+        if full:
+            self.wake.set()
+
+    def take(self):
+        """Empty the buffer.
+
+        @return: The buffered view counts by listing id and the counts only
+            left to add to the public copies, by listing id.
+        @rtype: tuple
+        """
+        with self.lock:
+            counts = self.counts
+            public_counts = self.public_counts
+            self.counts = {}
+            self.public_counts = {}
+            return (counts, public_counts)
+
+    def restore(self, counts, public_counts):
+        """Put back counts which could not be written, as far as they fit.
+
+        @param counts: View counts by listing id still to be added to both the
+            listings and their public copies.
+        @type counts: dict
+        @param public_counts: View counts by listing id only left to be added
+            to the public copies.
+        @type public_counts: dict
+        """
+        with self.lock:
+            for (buffered, restored) in [(self.counts, counts),
+                (self.public_counts, public_counts)]:
+                for (listing_id, count) in restored.iteritems():
+                    if listing_id in buffered or \
+                        len(buffered) < self.max_entries:
+                        buffered[listing_id] = \
+                            buffered.get(listing_id, 0) + count
+                    else:
+                        self.dropped += count
+
+    def flush(self):
+        """Add the buffered view counts to the listings and public copies.
+
+        Each collection gets one bulk write. Counts which could not be
+        written are kept for the next flush.
+
+        @return: The number of listings whose views were written.
+        @rtype: int
+        """
+        (counts, public_counts) = self.take()
+        if not counts and not public_counts:
+            return 0
+
+        db_adapter = tiny_classified.get_db_adapter()
+        try:
+            unwritten = db_adapter.increment_listing_views(counts)
+        except Exception:
+            self.restore(counts, public_counts)
+            raise
+
+        for (listing_id, count) in counts.iteritems():
+            if not listing_id in unwritten:
+                public_counts[listing_id] = \
+                    public_counts.get(listing_id, 0) + count
+        try:
+            unwritten_public = db_adapter.increment_listing_views(
+                public_counts,
+                public=True
+            )
+        except Exception:
+            self.restore(unwritten, public_counts)
+            raise
+
+        self.restore(unwritten, unwritten_public)
+        return len(counts) - len(unwritten)
+
+    def run(self):
+        """Flush the buffer every flush_interval or early when it fills up."""
+        while True:
+            self.wake.wait(self.flush_interval)
+            self.wake.clear()
+            try:
+                self.flush()
+            except Exception:
+                logging.exception('Could not write listing view counts.')
+
+    def start(self):
+        """Start flushing the buffer on a daemon thread."""
+        self.thread = threading.Thread(target=self.run, name='view_counter')
+        self.thread.daemon = True
+        self.thread.start()
+
+
+def get_flush_interval():
+    """Get the number of seconds between view count flushes.
+
+    @return: The configured interval, 0 to not count views.
+    @rtype: float
+    """
+    return tiny_classified.get_config().get(
+        'VIEW_FLUSH_SECONDS',
+        DEFAULT_VIEW_FLUSH_SECONDS
+    )
+
+
+def flush_at_exit():
+    """Flush the current process's buffer, if any, before it exits."""
+    view_buffer = BUFFERS['view_buffer']
+    if view_buffer != None and BUFFERS['pid'] == os.getpid():
+        try:
+            view_buffer.flush()
+        except Exception:
+            logging.exception('Could not write listing view counts.')
+
+
+def get_view_buffer():
+    """Get the view buffer of the current process, creating it if needed.
+
+    A buffer inherited from a parent process is not reused because its flush
+    thread does not survive a fork.
+
+    @return: The started buffer.
+    @rtype: ViewBuffer
+    """
+    pid = os.getpid()
+    with BUFFERS_LOCK:
+        if BUFFERS['view_buffer'] == None or BUFFERS['pid'] != pid:
+            max_entries = tiny_classified.get_config().get(
+                'VIEW_BUFFER_MAX_ENTRIES',
+                DEFAULT_VIEW_BUFFER_MAX_ENTRIES
+            )
+            view_buffer = ViewBuffer(max_entries, get_flush_interval())
+            view_buffer.start()
+            BUFFERS['view_buffer'] = view_buffer
+            BUFFERS['pid'] = pid
+        return BUFFERS['view_buffer']
+
+
+def record_view(listing_id):
+    """Count a view of a listing page.
+
+    @param listing_id: The "_id" of the viewed listing.
+    @type listing_id: bson.objectid.ObjectId
+    """
+    if get_flush_interval():
+        get_view_buffer().record(listing_id)
+
+
+def list_popular_listings(limit=DEFAULT_POPULAR_LISTINGS_LIMIT):
+    """List the most viewed published listings.
+
+    @keyword limit: The maximum number of listings to list.
+    @type limit: int
+    @return: The name, slugs and views of the listings, most viewed first.
+    @rtype: list of dict
+    """
+    return tiny_classified.get_db_adapter().list_popular_listings(
+        fields=['name', 'slugs', 'views'],
+        limit=limit
+    )
+
+
+atexit.register(flush_at_exit)
@@ -0,0 +1,191 @@
+"""Tests for view_counter_service.
+
+@license: GNU GPLv3
+"""
+import os
+
+import mox
+
+try:
+    from tinyclassified import tiny_classified
+except:
+    import tiny_classified
+
+import cache_service
+import category_index_service
+import listing_service
+import memory_db_service
+import view_counter_service
+
+
+def make_listing(name):
+    listing = {
+        'author_email': '%s@example.com' % name.lower(),
+        'name': name,
+        'tags': {'Food': ['Pizza']},
+        'is_published': True
+    }
+    listing_service.calculate_slugs(listing)
+    return listing
+
+
+class ViewCounterServiceTests(mox.MoxTestBase):
+
+    def setUp(self):
+        mox.MoxTestBase.setUp(self)
+        self.original_db_adapter = tiny_classified.get_db_adapter()
+        self.db_adapter = memory_db_service.MemoryDBAdapter()
+        tiny_classified.set_db_adapter(self.db_adapter)
+        cache_service.CACHES['listing'] = cache_service.LRUCache(0, 0, 0)
+
+        self.listing_ids = []
+        for name in ['Alpha', 'Bravo', 'Charlie']:
+            listing = make_listing(name)
+            self.db_adapter.upsert_listing(listing)
+            self.db_adapter.upsert_public_listing(listing)
+            self.listing_ids.append(listing['_id'])
+
+    def tearDown(self):
+        tiny_classified.set_db_adapter(self.original_db_adapter)
+        category_index_service.reset()
+        mox.MoxTestBase.tearDown(self)
+
+    def get_views(self, listing_id, public=False):
+        listing = self.db_adapter.get_listing_by_id(listing_id, public=public)
+        return listing.get('views', 0)
+
+    def test_flush(self):
+        (alpha_id, bravo_id, charlie_id) = self.listing_ids
+        view_buffer = view_counter_service.ViewBuffer(10, 60)
+        view_buffer.record(alpha_id)
+        view_buffer.record(alpha_id)
+        view_buffer.record(bravo_id)
+
+        self.assertEqual(2, view_buffer.flush())
+        self.assertEqual(0, view_buffer.flush())
+        view_buffer.record(alpha_id)
+        view_buffer.flush()
+
+        self.assertEqual(3, self.get_views(alpha_id))
+        self.assertEqual(3, self.get_views(alpha_id, public=True))
+        self.assertEqual(1, self.get_views(bravo_id))
+        self.assertEqual(0, self.get_views(charlie_id))
+
+    def test_record_is_bounded(self):
+        (alpha_id, bravo_id, charlie_id) = self.listing_ids
+        view_buffer = view_counter_service.ViewBuffer(2, 60)
+        view_buffer.record(alpha_id)
+        self.assertFalse(view_buffer.wake.is_set())
+        view_buffer.record(bravo_id)
+        self.assertTrue(view_buffer.wake.is_set())
+
+        view_buffer.record(charlie_id)
+        view_buffer.record(alpha_id)
+        self.assertEqual({alpha_id: 2, bravo_id: 1}, view_buffer.counts)
+        self.assertEqual(1, view_buffer.dropped)
+
+    def test_flush_keeps_counts_on_failure(self):
+        (alpha_id, bravo_id, charlie_id) = self.listing_ids
+        view_buffer = view_counter_service.ViewBuffer(10, 60)
+        view_buffer.record(alpha_id)
+
+        self.mox.StubOutWithMock(self.db_adapter, 'increment_listing_views')
+        self.db_adapter.increment_listing_views({alpha_id: 1}).AndRaise(
+            ValueError('test')
+        )
+        self.mox.ReplayAll()
+
+        with self.assertRaises(ValueError):
+            view_buffer.flush()
+        view_buffer.record(alpha_id)
+        self.assertEqual({alpha_id: 2}, view_buffer.counts)
+
+    def test_flush_retries_only_public_counts(self):
+        (alpha_id, bravo_id, charlie_id) = self.listing_ids
+        view_buffer = view_counter_service.ViewBuffer(10, 60)
+        view_buffer.record(alpha_id)
+        view_buffer.record(bravo_id)
+        original_increment = self.db_adapter.increment_listing_views
+
+        self.mox.StubOutWithMock(self.db_adapter, 'increment_listing_views')
+        self.db_adapter.increment_listing_views(
+            {alpha_id: 1, bravo_id: 1}).WithSideEffects(original_increment)
+        self.db_adapter.increment_listing_views(
+            {alpha_id: 1, bravo_id: 1},
+            public=True
+        ).AndRaise(ValueError('test'))
+        self.db_adapter.increment_listing_views({}).AndReturn({})
+        self.db_adapter.increment_listing_views(
+            {alpha_id: 1, bravo_id: 1},
+            public=True
+        ).WithSideEffects(original_increment)
+        self.mox.ReplayAll()
+
+        with self.assertRaises(ValueError):
+            view_buffer.flush()
+        self.assertEqual({}, view_buffer.counts)
+        self.assertEqual({alpha_id: 1, bravo_id: 1}, view_buffer.public_counts)
+
+        self.assertEqual(0, view_buffer.flush())
+        self.assertEqual(1, self.get_views(alpha_id))
+        self.assertEqual(1, self.get_views(alpha_id, public=True))
+        self.assertEqual(1, self.get_views(bravo_id, public=True))
+
+    def test_get_view_buffer_recreated_after_fork(self):
+        self.mox.StubOutWithMock(view_counter_service.ViewBuffer, 'start')
+        view_counter_service.ViewBuffer.start()
+        view_counter_service.ViewBuffer.start()
+        self.mox.StubOutWithMock(os, 'getpid')
+        os.getpid().AndReturn(100)
+        os.getpid().AndReturn(100)
+        os.getpid().AndReturn(101)
+        self.mox.ReplayAll()
+
+        view_counter_service.BUFFERS['view_buffer'] = None
+        view_buffer = view_counter_service.get_view_buffer()
+        self.assertTrue(view_buffer is view_counter_service.get_view_buffer())
+        self.assertFalse(view_buffer is view_counter_service.get_view_buffer())
+        view_counter_service.BUFFERS['view_buffer'] = None
+
+    def test_list_popular_listings(self):
+        (alpha_id, bravo_id, charlie_id) = self.listing_ids
+        self.db_adapter.increment_listing_views(
+            {alpha_id: 2, charlie_id: 5},
+            public=True
+        )
+
+        listings = view_counter_service.list_popular_listings(limit=5)
+        self.assertEqual(
+            [('Charlie', 5), ('Alpha', 2)],
+            [(x['name'], x['views']) for x in listings]
+        )
+
+    def test_update_keeps_saved_views(self):
+        alpha_id = self.listing_ids[0]
+        listing = self.db_adapter.get_listing_by_id(alpha_id)
+        self.db_adapter.increment_listing_views({alpha_id: 4})
+
+        self.db_adapter.increment_listing_views({alpha_id: 4}, public=True)
+
+        listing['views'] = 100
+        listing_service.update(listing)
+        self.assertEqual(4, self.get_views(alpha_id))
+        self.assertEqual(4, self.get_views(alpha_id, public=True))
+
+    def test_update_keeps_concurrent_views(self):
+        alpha_id = self.listing_ids[0]
+        listing = self.db_adapter.get_listing_by_id(alpha_id)
+        original_get = self.db_adapter.get_listing_by_id
+
+        def get_then_view(listing_id):
+            old_listing = original_get(listing_id)
+            self.db_adapter.increment_listing_views({alpha_id: 3})
+            self.db_adapter.increment_listing_views({alpha_id: 3},
+                public=True)
+            return old_listing
+
+        self.db_adapter.get_listing_by_id = get_then_view
+        listing_service.update(listing)
+        self.db_adapter.get_listing_by_id = original_get
+        self.assertEqual(3, self.get_views(alpha_id))
+        self.assertEqual(3, self.get_views(alpha_id, public=True))
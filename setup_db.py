@@ -0,0 +1,95 @@
+"""Command line utility for preparing the TinyClassified database.
+
+Usage: python setup_db.py [command ...]
+
+Runs every command if none are given.
+
+@license: GNU GPLv3
+"""
+import sys
+
+import tiny_classified
+
+import services
+
+
+def ensure_indices():
+    """Create the indices used by TinyClassified queries."""
+    print "Ensuring indices..."
+    tiny_classified.get_db_adapter().ensure_indices()
+
+
+def run_migrations():
+    """Migrate saved listings to the current listing schema."""
+    print "Running migrations..."
+    results = services.migration_service.run_migrations()
+    for (name, result) in sorted(results.iteritems()):
+        print "%s: migrated %d of %d listings" % (
+            name,
+            result['migrated'],
+            result['scanned']
+        )
+
+
+def render_abouts():
+    """Render about sections saved before or by an older renderer."""
+    print "Rendering about sections..."
+    count = services.listing_service.rerender_abouts()
+    print "Rendered %d about sections" % count
+
+
+def build_public_listings():
+    """Copy the published listings to the public read model."""
+    print "Building public listings..."
+    count = services.listing_service.rebuild_public_listings()
+    print "Published %d listings" % count
+
+
+def archive_listings():
+    """Archive the listings which expired or have long been unpublished."""
+    print "Archiving listings..."
+    count = services.archive_service.archive_listings()
+    print "Archived %d listings" % count
+
+
+def build_category_summaries():
+    """Build the category summaries read by the public category pages."""
+    print "Building category summaries..."
+    services.listing_service.rebuild_category_summaries()
+
+
+COMMANDS = [
+    ('indices', ensure_indices),
+    ('migrate', run_migrations),
+    ('render_abouts', render_abouts),
+    ('archive', archive_listings),
+    ('public_listings', build_public_listings),
+    ('category_summaries', build_category_summaries)
+]
+
+
+def main(args):
+    """Run the given setup commands or all of them if none are given.
+
+    @param args: The names of the commands to run.
+    @type args: list of str
+    """
+    command_names = [name for (name, command) in COMMANDS]
+    for arg in args:
+        if not arg in command_names:
+            print "Unknown command: %s (expected one of %s)" % (
+                arg,
+                ', '.join(command_names)
+            )
+            sys.exit(1)
+
+    for name, command in COMMANDS:
+        if not args or name in args:
+            command()
+
+    print "Success"
+
+
+if __name__ == '__main__':
+    tiny_classified.initialize_standalone()
+    main(sys.argv[1:])
@@ -97,6 +97,9 @@ def initialize_standalone():
     attach_blueprints(app)
     setup_template_functions(app)
 
+    if app.config.get('MONGO_ENSURE_INDICES', False):
+        get_db_adapter().ensure_indices()
+
 
 def set_render_common_template_vals(func):
     config_cache.get_config()['get_common_template_vals'] = func